@@ -38,11 +38,12 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.common import DetectMultiBackend
-from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
+from models.common import Candidates, DetectMultiBackend
+from models.yolo import Detect
+from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadRectBatches, LoadStreams, StreamScheduler
 from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xywhn2xyxy, xyxy2xywh)
-from utils.plots import Annotator, colors, save_one_box
+from utils.plots import ResultsWriter, colors, save_one_box
 from utils.torch_utils import select_device, time_sync
 from new_utils.anchor_statistics import altered_yolo_nms
 
@@ -62,6 +63,10 @@ import numpy as np
 from utils.augmentations import letterbox
 from new_utils.augmentations_utils import augmentation_policy
 from new_utils.uncertainty_ops import remove_detections, obtain_uncertainty_statistics
+from new_utils.anchor_statistics import output_redundancy_instances
+from new_utils.tiling import tiled_inference
+from new_utils.temporal import ClusterTracker, KeyframeScheduler, MotionGate
+from new_utils.multi_resolution import crop_batch, crops_to_original, merge_refined_instances, refinement_windows, uncertain_clusters
 
 @torch.no_grad()
 def run(
@@ -91,6 +96,29 @@ def run(
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        tta_samples=False,  # geometric TTA samples (scales and lr-flips) clustered as uncertainty samples
+        class_subset=None,  # restrict the model head to these classes, i.e. 0 1 2 3 5 7 for BDD
+        topk=0,  # decode only the top-k objectness candidates per detection level, 0 for all
+        low_imgsz=0,  # first-stage inference size, uncertain clusters are refined at imgsz, 0 to disable
+        refine_frac=0.5,  # re-run the whole frame at imgsz if more than this fraction of clusters is uncertain
+        tile=0,  # tiled inference tile size in original image pixels, 0 to disable
+        tile_overlap=0.2,  # fraction of overlap between neighbouring tiles
+        tile_batch=8,  # tiles per forward
+        track=False,  # smooth video clusters over frames with an IoU cluster tracker
+        keyframe_interval=0,  # video: maximum frames between full-model keyframes, 0 to run the full model every frame
+        motion_thres=0.0,  # video: skip inference below this frame difference and re-emit detections, 0 to disable
+        max_skip=10,  # video: maximum consecutive frames skipped by motion gating
+        static_stride=4,  # streams: frames grabbed per decoded frame while motion gating skips a stream
+        stream_buffer=0,  # streams: per-stream ring buffer size for deadline-aware batching, 0 for latest-frame batches
+        stream_deadline=0.05,  # streams: maximum wait (s) after the oldest pending frame before forming a batch
+        stream_batch=8,  # streams: maximum frames per deadline-aware batch
+        workers=0,  # image decode/letterbox threads prefetching ahead of inference, 0 to decode on the main thread
+        lazy_files=False,  # stream directory enumeration in directory order instead of listing and sorting upfront
+        vid_stride=1,  # video: process every vid_stride-th frame, skipped frames are not decoded
+        vid_start=0.0,  # video: start time (s)
+        vid_end=None,  # video: end time (s), None for the whole video
+        write_queue=0,  # render and encode results on a background thread with this queue size, 0 for synchronous
+        rect_batch=0,  # images: batch size of aspect-ratio grouped rectangular inference, 0 to disable
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -117,6 +145,8 @@ def run(
         inference_output_dir = 'code/yolov5/methods/mc_dropout'
     elif test_time_augment:
         inference_output_dir = 'code/yolov5/methods/test_time_aug'
+    elif tta_samples:
+        inference_output_dir = 'code/yolov5/methods/geometric_tta'
     else:
         inference_output_dir = 'code/yolov5/methods/output_redundancy'
     inference_output_dir = inference_output_dir + experiment
@@ -124,20 +154,35 @@ def run(
         os.makedirs(inference_output_dir)
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half, mc_enabled=mc_dropout)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half, mc_enabled=mc_dropout,
+                               class_subset=class_subset)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    low_imgsz = check_img_size(low_imgsz, s=stride) if low_imgsz else 0
+    if topk and pt:
+        for m in model.model.modules():
+            if isinstance(m, Detect):
+                m.topk, m.topk_conf = topk, conf_thres  # prune candidates on raw objectness logits
 
     # Dataloader
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt)
+        if stream_buffer:
+            dataset = StreamScheduler(source, img_size=imgsz, stride=stride, auto=pt, buffer=stream_buffer,
+                                      batch_size=stream_batch, deadline=stream_deadline)
+        else:
+            dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt)
         bs = len(dataset)  # batch_size
+    elif rect_batch:
+        dataset = LoadRectBatches(source, img_size=imgsz, stride=stride, batch_size=rect_batch, workers=workers)
+        bs = 1  # batch_size, results are still processed per image
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, test_time_augmentation=test_time_augment)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, test_time_augmentation=test_time_augment,
+                             workers=workers, lazy=lazy_files, vid_stride=vid_stride, vid_start=vid_start,
+                             vid_end=vid_end)
         bs = 1  # batch_size
-    vid_path, vid_writer = [None] * bs, [None] * bs
+    writer = ResultsWriter(write_queue, line_width=line_thickness, example=str(names))  # annotated results writer
 
     # Run inference
     model.warmup(imgsz=(1 if pt else bs, 3, *imgsz))  # warmup
@@ -145,6 +190,13 @@ def run(
     final_outputs_list_xywh = []
     final_outputs_list_xyxy = []
     seen, windows, dt = 0, [], [0.0, 0.0, 0.0]
+    tracker, video_path = ClusterTracker() if track else None, None  # video cluster tracker, current video
+    if keyframe_interval and not (pt and hasattr(model.model, 'forward_keyframe')):
+        LOGGER.warning('WARNING: --keyframe-interval needs a single PyTorch model, running the full model every frame')
+        keyframe_interval = 0
+    scheduler, uncertain_frac = KeyframeScheduler(keyframe_interval) if keyframe_interval else None, 0.0
+    gate = MotionGate(motion_thres, max_skip, stride=static_stride) if motion_thres else None  # static cameras
+    last_outputs = {}  # per stream: detections of the last inferred frame, re-emitted by motion gating
     #Decide if inference mode or just metrics calculation
     if inference_mode:
         for path, im, im0s, vid_cap, s in dataset:
@@ -154,8 +206,22 @@ def run(
 
             # Inference
             visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+            keys = dataset.stream_ids if webcam else [path]  # stream of every image of the batch
+            infer = [True] * len(keys)  # images of the batch running inference
+            if gate and dataset.mode != 'image':  # motion gating, one decision per stream
+                # streams without detections yet always run inference, i.e. the first frames of a new stream
+                infer = [gate(k, x) or k not in last_outputs for k, x in zip(keys, im0s if webcam else [im0s])]
+                for k, x in zip(keys, infer) if webcam else ():
+                    dataset.vid_stride[k] = 1 if x else gate.stride  # static streams only decode every stride-th frame
+            if not any(infer):
+                #Static scenes, re-emit the detections of the last inferred frames
+                if len(im.shape) == 3:
+                    im = im[None]  # expand for batch dim
+                t3 = time_sync()
+                dt[1] += t3 - t2
+                batch_outputs = [last_outputs[k] for k in keys]
             #MC DROPOUT
-            if mc_dropout:
+            elif mc_dropout:
                 im = torch.from_numpy(im).to(device)
                 im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
                 im /= 255  # 0 - 255 to 0.0 - 1.0
@@ -167,8 +233,8 @@ def run(
                     pred = model(im,augment=augment,visualize=visualize)
                     keep, output = altered_yolo_nms(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
                     pred = torch.squeeze(pred,dim=0)
-                    teste = pred[keep,:]
-                    accumulated_predictions = torch.cat((accumulated_predictions, pred[keep,:]))
+                    teste = pred[keep[0],:]
+                    accumulated_predictions = torch.cat((accumulated_predictions, pred[keep[0],:]))
                 t3 = time_sync()
                 dt[1] += t3 - t2
                 original_predictions = torch.clone(accumulated_predictions)
@@ -178,9 +244,7 @@ def run(
                 outputs = new_utils.anchor_statistics.pre_processing_anchor_stats(accumulated_predictions)
                 outputs = new_utils.anchor_statistics.compute_anchor_statistics(outputs,device,im0s,original_predictions, remove_uncertain_clusters)
                 outputs = new_utils.anchor_statistics.probabilistic_detector_postprocessing(outputs,im0s)
-                outputs_xywh, outputs_xyxy = new_utils.anchor_statistics.instances_to_json(outputs,dataset.count-1,kitti)
-                final_outputs_list_xywh.extend(outputs_xywh)
-                final_outputs_list_xyxy.extend(outputs_xyxy)
+                batch_outputs = [outputs]
             elif test_time_augment:
                 number_augments = 10
                 accumulated_predictions = torch.tensor([]).to(device)
@@ -215,8 +279,8 @@ def run(
                     pred = model(im,augment=augment,visualize=visualize)
                     keep, output = altered_yolo_nms(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
                     pred = torch.squeeze(pred,dim=0)
-                    teste = pred[keep,:]
-                    accumulated_predictions = torch.cat((accumulated_predictions, pred[keep,:]))
+                    teste = pred[keep[0],:]
+                    accumulated_predictions = torch.cat((accumulated_predictions, pred[keep[0],:]))
                 t3 = time_sync()
                 dt[1] += t3 - t2
                 original_predictions = torch.clone(accumulated_predictions)
@@ -226,36 +290,121 @@ def run(
                 outputs = new_utils.anchor_statistics.pre_processing_anchor_stats(accumulated_predictions)
                 outputs = new_utils.anchor_statistics.compute_anchor_statistics(outputs,device,im0s,original_predictions, remove_uncertain_clusters)
                 outputs = new_utils.anchor_statistics.probabilistic_detector_postprocessing(outputs,im0s,kitti)
-                outputs_xywh, outputs_xyxy = new_utils.anchor_statistics.instances_to_json(outputs,dataset.count-1)
-                final_outputs_list_xywh.extend(outputs_xywh)
-                final_outputs_list_xyxy.extend(outputs_xyxy)
-            else:
+                batch_outputs = [outputs]
+            elif tta_samples:
                 im = torch.from_numpy(im).to(device)
                 im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
                 im /= 255  # 0 - 255 to 0.0 - 1.0
                 if len(im.shape) == 3:
                     im = im[None]  # expand for batch dim
+                #Same-size augmentations (original and lr-flip) run as one batch, each sample in original coordinates
+                preds = model(im, augment=True, visualize=visualize, tta_samples=True)
+                accumulated_predictions = torch.tensor([]).to(device)
+                for pred in preds:
+                    keep, output = altered_yolo_nms(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+                    accumulated_predictions = torch.cat((accumulated_predictions, torch.squeeze(pred, dim=0)[keep[0], :]))
+                t3 = time_sync()
+                dt[1] += t3 - t2
+                original_predictions = torch.clone(accumulated_predictions)
+                original_predictions = torch.unsqueeze(original_predictions,dim=0)
+                accumulated_predictions[:, :4] = xywh2xyxy(accumulated_predictions[:, :4])
+                accumulated_predictions[:, :4] = scale_coords(im.shape[2:], accumulated_predictions[:, :4], im0s.shape).round()
+                outputs = new_utils.anchor_statistics.pre_processing_anchor_stats(accumulated_predictions)
+                outputs = new_utils.anchor_statistics.compute_anchor_statistics(outputs,device,im0s,original_predictions, remove_uncertain_clusters)
+                outputs = new_utils.anchor_statistics.probabilistic_detector_postprocessing(outputs,im0s)
+                batch_outputs = [outputs]
+            elif tile:
+                #Overlapping native resolution tiles, overlaps become extra members of the same clusters
+                #Candidates below the center threshold stay as cluster members down to the usual 0.01 objectness
+                pred = tiled_inference(model, im0s, tile, tile_overlap, tile_batch, conf_thres=min(conf_thres, 0.01),
+                                       augment=augment)
+                t3 = time_sync()
+                dt[1] += t3 - t2
+                outputs = output_redundancy_instances(pred, None, im0s, device, remove_uncertain_clusters,
+                                                      conf_thres=conf_thres, iou_thres=iou_thres)
+                batch_outputs = [outputs]
+                im = im[None]  # expand for batch dim
+            elif low_imgsz:
+                #Low resolution pass, only uncertain clusters are refined at full resolution
+                im_full = im
+                im = letterbox(im0s, low_imgsz, stride=stride, auto=pt)[0]
+                im = torch.from_numpy(np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])).to(device)
+                im = (im.half() if model.fp16 else im.float())[None] / 255  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
                 pred = model(im, augment=augment, visualize=visualize)
+                pred, anchor_idx = (pred.pred, pred.anchor_idx) if isinstance(pred, Candidates) else (pred, None)
+                outputs = output_redundancy_instances(pred, im.shape[2:], im0s, device, remove_uncertain_clusters,
+                                                      anchor_idx)
+                uncertain = uncertain_clusters(outputs)
+                if uncertain.sum() > refine_frac * len(outputs):  # too many uncertain, whole frame at imgsz
+                    im = torch.from_numpy(im_full).to(device)
+                    im = (im.half() if model.fp16 else im.float())[None] / 255
+                    pred = model(im, augment=augment, visualize=visualize)  # replaces the low resolution features
+                    pred, anchor_idx = (pred.pred, pred.anchor_idx) if isinstance(pred, Candidates) else (pred, None)
+                    outputs = output_redundancy_instances(pred, im.shape[2:], im0s, device, remove_uncertain_clusters,
+                                                          anchor_idx)
+                elif uncertain.any():  # crops around uncertain clusters at the imgsz resize gain
+                    refine_windows = refinement_windows(outputs.pred_boxes.tensor[uncertain], im0s.shape)
+                    gain = min(imgsz[0] / im0s.shape[0], imgsz[1] / im0s.shape[1])
+                    crops, gains = crop_batch(im0s, refine_windows, gain, stride=stride)
+                    crops = torch.from_numpy(crops).to(device)
+                    crops = (crops.half() if model.fp16 else crops.float()) / 255
+                    pred = model(crops, augment=augment)  # not visualized, crop features would overwrite the frame's
+                    pred = pred.pred if isinstance(pred, Candidates) else pred  # crop anchors are not the frame's
+                    pred = crops_to_original(pred, refine_windows, gains)
+                    refined = output_redundancy_instances(pred, None, im0s, device, remove_uncertain_clusters)
+                    outputs = merge_refined_instances(outputs, uncertain, refined, iou_thres)
+                t3 = time_sync()
+                dt[1] += t3 - t2
+                batch_outputs = [outputs]
+            else:
+                im = torch.from_numpy(im).to(device)
+                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
+                if len(im.shape) == 3:
+                    im = im[None]  # expand for batch dim
+                if not all(infer):  # motion gating, static streams re-emit their last detections
+                    im = im[[i for i, x in enumerate(infer) if x]]
+                if scheduler and dataset.mode == 'video':  # video, reuse deep features between keyframes
+                    if path != video_path:  # new video
+                        scheduler.reset()
+                    pred = model(im, keyframe=scheduler(im, uncertain_frac))
+                elif rect_batch:  # one forward per aspect-ratio batch, then this image's slice of it
+                    if dataset.batch_i == 0:
+                        ims = torch.from_numpy(dataset.batch).to(device)
+                        ims = (ims.half() if model.fp16 else ims.float()) / 255  # uint8 to fp16/32, 0-255 to 0.0-1.0
+                        batch_pred = model(ims, augment=augment, visualize=visualize)
+                    b = slice(dataset.batch_i, dataset.batch_i + 1)
+                    pred = batch_pred._replace(pred=batch_pred.pred[b], anchor_idx=batch_pred.anchor_idx[b]) \
+                        if isinstance(batch_pred, Candidates) else batch_pred[b]
+                else:
+                    pred = model(im, augment=augment, visualize=visualize)
+                # top-k candidates, candidate indices into the full anchor set
+                pred, anchor_idx = (pred.pred, pred.anchor_idx) if isinstance(pred, Candidates) else (pred, None)
                 t3 = time_sync()
                 dt[1] += t3 - t2
                 #########################
-                #Output Redundancy
-                #Convert output coordinates xywh to xyxy
-                # Rescale boxes from img_size to im0 size
-                pred_redundancy = torch.clone(pred)
-                pred_redundancy = torch.squeeze(pred_redundancy,dim=0)
-                pred_redundancy[:, :4] = xywh2xyxy(pred_redundancy[:, :4])
-                pred_redundancy[:, :4] = scale_coords(im.shape[2:], pred_redundancy[:, :4], im0s.shape).round()
-                # Rescale boxes from img_size to im0 size
-                outputs = new_utils.anchor_statistics.pre_processing_anchor_stats(pred_redundancy)
-                outputs = new_utils.anchor_statistics.compute_anchor_statistics(outputs,device,im0s,pred, remove_uncertain_clusters)
-                outputs = new_utils.anchor_statistics.probabilistic_detector_postprocessing(outputs,im0s)
-                outputs_xywh, outputs_xyxy = new_utils.anchor_statistics.instances_to_json(outputs,dataset.count-1,kitti)
-                #https://online.stat.psu.edu/stat505/book/export/html/645
-                #outputs = remove_detections(outputs)
-                #FUNCTION TO REMOVE UNCERTAIN DETECTIONS
-                final_outputs_list_xywh.extend(outputs_xywh)
-                final_outputs_list_xyxy.extend(outputs_xyxy)
+                #Output Redundancy, per image of the batch (StreamScheduler batches may hold several frames per stream)
+                batch_outputs, j = [], 0  # outputs, index of the next inferred image in pred
+                for i, k in enumerate(keys):
+                    if not infer[i]:
+                        batch_outputs.append(last_outputs[k])
+                        continue
+                    outputs = output_redundancy_instances(pred[j:j + 1], im.shape[2:], im0s[i] if webcam else im0s,
+                                                          device, remove_uncertain_clusters,
+                                                          None if anchor_idx is None else anchor_idx[j:j + 1])
+                    j += 1
+                    if tracker and dataset.mode == 'video':  # video, reuse the statistics of the previous frames
+                        if path != video_path:  # new video
+                            tracker.reset()
+                        outputs = tracker.update(outputs)
+                    if gate:  # later frames of the same stream in this batch re-emit these detections
+                        last_outputs[k] = outputs
+                    batch_outputs.append(outputs)
+                if scheduler:
+                    uncertain_frac = uncertain_clusters(outputs).float().mean().item() if len(outputs) else 0.0
+                video_path = path
+            if gate and not webcam:  # single image branches, the batched branch updates per frame
+                last_outputs[path] = batch_outputs[0]
             ##############################
             # NMS
             #pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
@@ -263,114 +412,69 @@ def run(
             # Second-stage classifier (optional)
             # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
             # Process predictions
-            draw_clusters = True
-            if draw_clusters:
+            if kitti:
+                names = ['car','truck','person','rider','bycicle']
+            else:
+                names = ['car','bus','truck','person','rider','bycicle','motorcycle']
+            for i, outputs in enumerate(batch_outputs):  # per image
+                outputs_xywh, outputs_xyxy = new_utils.anchor_statistics.instances_to_json(outputs,dataset.count-1,kitti,class_subset)
+                #https://online.stat.psu.edu/stat505/book/export/html/645
+                #outputs = remove_detections(outputs)
+                #FUNCTION TO REMOVE UNCERTAIN DETECTIONS
+                final_outputs_list_xywh.extend(outputs_xywh)
+                final_outputs_list_xyxy.extend(outputs_xyxy)
                 list_of_classes = []
-                if kitti:
-                    names = ['car','truck','person','rider','bycicle']
-                else:
-                    names = ['car','bus','truck','person','rider','bycicle','motorcycle']
                 seen += 1
-                if webcam:  # batch_size >= 1
+                if webcam:  # batch_size >= 1, i-th frame of stream dataset.stream_ids[i]
                     p, im0, frame = path[i], im0s[i].copy(), dataset.count
                     s += f'{i}: '
                 else:
                     p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-                annotator = Annotator(im0, line_width=line_thickness, example=str(names))
+                boxes = []  # (xyxy, label, color) drawn by the results writer
                 p = Path(p)  # to Path
                 save_path = str(save_dir / p.name)  # im.jpg
                 gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
                 txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
                 imc = im0.copy() if save_crop else im0  # for save_crop
-                for i, det in enumerate(outputs_xywh):  # per image
+                for det in outputs_xywh:  # per cluster
                     xyxy =  [det['bbox'][0], 
                              det['bbox'][1],
                              det['bbox'][0] + det['bbox'][2],
                              det['bbox'][1] + det['bbox'][3]]
                     c = int(det['category_id'])  # integer class
                     label = None if hide_labels else (names[c] if hide_conf else f'{names[c-1]} {det["score"]:.2f}')
-                    annotator.box_label(xyxy, label, color=colors(c, True))
+                    boxes.append((xyxy, label, colors(c, True)))
                     # Print results
                     list_of_classes.append(c)
                 s += '%gx%g ' % im.shape[2:]  # print string
                 for c in set(list_of_classes):
                     n = list_of_classes.count(c) # detections per class
                     s += f"{n} {names[int(c-1)]}{'s' * (n > 1)}, "  # add to string
-            else:
-                for i, det in enumerate(pred):  # per image
-                    seen += 1
-                    if webcam:  # batch_size >= 1
-                        p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                        s += f'{i}: '
-                    else:
-                        p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-                    p = Path(p)  # to Path
-                    save_path = str(save_dir / p.name)  # im.jpg
-                    txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-                    s += '%gx%g ' % im.shape[2:]  # print string
-                    ###########################
-                    #path_to_dataset = "../../media/Data/ruimag/bdd100k/labels"
-                    #preprocessed_gt_instances = get_preprocess_ground_truth_instances(path_to_dataset)
-                    #annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-                    #teste = preprocessed_gt_instances['gt_boxes'][0][0]
-                    ###for box in preprocessed_gt_instances['gt_boxes'][0]:
-                    ###    annotator.box_label(box, 'popo', (0,212,187))
-                    #im0 = annotator.result()
-                    #cv2.imwrite(save_path, im0)
-                    ###########################
-                    gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-                    imc = im0.copy() if save_crop else im0  # for save_crop
-                    annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-                    if len(det):
-                        # Rescale boxes from img_size to im0 size
-                        det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-                        # Print results
-                        for c in det[:, -1].unique():
-                            n = (det[:, -1] == c).sum()  # detections per class
-                            s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-                        # Write results
-                        for *xyxy, conf, cls in reversed(det):
-                            if save_txt:  # Write to file
-                                xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                                line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                                with open(f'{txt_path}.txt', 'a') as f:
-                                    f.write(('%g ' * len(line)).rstrip() % line + '\n')
-                            if save_img or save_crop or view_img:  # Add bbox to image
-                                c = int(cls)  # integer class
-                                label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                                annotator.box_label(xyxy, label, color=colors(c, True))
-                            if save_crop:
-                                save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-            # Stream results
-            im0 = annotator.result()
-            if view_img:
-                if p not in windows:
-                    windows.append(p)
-                    cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
-                    cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
+                # Stream results
+                if view_img:
+                    im0, boxes = writer.render(im0, boxes), []  # drawn here for display
+                    if p not in windows:
+                        windows.append(p)
+                        cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
+                        cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
+                    cv2.imshow(str(p), im0)
+                    cv2.waitKey(1)  # 1 millisecond
+                # Save results (image with detections)
+                if save_img:
+                    if dataset.mode == 'image':
+                        writer.write(im0, boxes, save_path)
+                    else:  # 'video' or 'stream'
                         if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                            fps = vid_cap.get(cv2.CAP_PROP_FPS) / getattr(dataset, 'vid_stride', 1)  # real-time
                             w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
                             h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
                         else:  # stream
                             fps, w, h = 30, im0.shape[1], im0.shape[0]
-                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                        writer.write(im0, boxes, save_path, dataset.stream_ids[i] if webcam else i, (fps, w, h))
             # Print time (inference-only)
             LOGGER.info(f'{s}Done. ({t3 - t2:.3f}s)')
-        
+        writer.close()  # flush queued results, release video writers
+
         ##################
         #SAVE INFERENCE RESULTS TO JSON
         print('xywh has ' + str(len(final_outputs_list_xywh)) + ' final predictions')
@@ -393,8 +497,8 @@ def run(
     matched_results = get_matched_results(inference_output_dir, preprocessed_gt_instances, preprocessed_pred_instances)
     teste = obtain_uncertainty_statistics(matched_results)
     mAP_results, optimal_score_threshold_f1  = compute_average_precision(inference_output_dir,path_to_dataset,kitti)
-    final_results_nll , final_results_per_class_nll = compute_nll(matched_results,kitti)
-    final_results_calibration = compute_calibration_uncertainty_errors(matched_results,kitti)
+    final_results_nll , final_results_per_class_nll = compute_nll(matched_results,kitti,class_subset)
+    final_results_calibration = compute_calibration_uncertainty_errors(matched_results,kitti,class_subset)
     ########################
     if inference_mode:
         # Print results
@@ -403,6 +507,9 @@ def run(
         if save_txt or save_img:
             s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
             LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
+        if isinstance(dataset, StreamScheduler):
+            for src, (n, dropped, p50, p99) in dataset.stats().items():
+                LOGGER.info(f'{src}: {n} frames, {dropped} dropped, latency p50 {p50 * 1E3:.1f}ms p99 {p99 * 1E3:.1f}ms')
         if update:
             strip_optimizer(weights)  # update model (to fix SourceChangeWarning)
 
@@ -435,6 +542,29 @@ def parse_opt():
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--class-subset', nargs='+', type=int, help='restrict model head to classes: --class-subset 0 1 2 3 5 7')
+    parser.add_argument('--topk', type=int, default=0, help='decode only top-k objectness candidates per level, 0 for all')
+    parser.add_argument('--low-imgsz', type=int, default=0, help='first-stage inference size for uncertainty-guided refinement')
+    parser.add_argument('--refine-frac', type=float, default=0.5, help='uncertain cluster fraction to re-run the full frame')
+    parser.add_argument('--tile', type=int, default=0, help='tiled inference tile size (pixels), 0 to disable')
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help='tiled inference overlap fraction')
+    parser.add_argument('--tile-batch', type=int, default=8, help='tiles per forward')
+    parser.add_argument('--track', action='store_true', help='track and smooth uncertainty clusters across video frames')
+    parser.add_argument('--keyframe-interval', type=int, default=0, help='video: max frames between full-model keyframes')
+    parser.add_argument('--motion-thres', type=float, default=0.0, help='video: skip frames below this difference, 0 off')
+    parser.add_argument('--max-skip', type=int, default=10, help='video: maximum consecutive motion-gated frames')
+    parser.add_argument('--static-stride', type=int, default=4, help='streams: decode every n-th frame while gated')
+    parser.add_argument('--stream-buffer', type=int, default=0, help='streams: per-stream ring buffer size, 0 off')
+    parser.add_argument('--stream-deadline', type=float, default=0.05, help='streams: batching deadline (s)')
+    parser.add_argument('--stream-batch', type=int, default=8, help='streams: maximum frames per batch')
+    parser.add_argument('--workers', type=int, default=0, help='image decode threads prefetching ahead of inference')
+    parser.add_argument('--lazy-files', action='store_true', help='stream directory listing instead of sorting upfront')
+    parser.add_argument('--vid-stride', type=int, default=1, help='video: process every n-th frame')
+    parser.add_argument('--vid-start', type=float, default=0.0, help='video: start time (s)')
+    parser.add_argument('--vid-end', type=float, default=None, help='video: end time (s)')
+    parser.add_argument('--write-queue', type=int, default=0, help='background results writer queue size, 0 sync')
+    parser.add_argument('--rect-batch', type=int, default=0, help='images: aspect-ratio grouped batch size, 0 off')
+    parser.add_argument('--tta-samples', action='store_true', help='cluster batched geometric TTA samples for uncertainty')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
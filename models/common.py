@@ -28,6 +28,11 @@ from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import copy_attr, time_sync
 
 
+# Detect() top-k inference output: decoded candidates (bs,k,no), training output, candidate indices into the full
+# anchor set (bs,k) of every detection level concatenated
+Candidates = namedtuple('Candidates', ('pred', 'train_out', 'anchor_idx'))
+
+
 def autopad(k, p=None):  # kernel, padding
     # Pad to 'same'
     if p is None:
@@ -305,7 +310,8 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, mc_enabled=False):
+    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, mc_enabled=False,
+                 class_subset=None):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -333,6 +339,8 @@ class DetectMultiBackend(nn.Module):
         if pt:  # PyTorch
             if mc_enabled:
                 model = attempt_load(weights if isinstance(weights, list) else w, device=device)
+                if class_subset:
+                    self._select_classes(model, class_subset)
                 print(model)
                 layers_name = [name for name, _ in model.named_modules()][1:]
                 teste = model.model[24].m[0]
@@ -347,6 +355,8 @@ class DetectMultiBackend(nn.Module):
                 self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
             else:
                 model = attempt_load(weights if isinstance(weights, list) else w, device=device)
+                if class_subset:
+                    self._select_classes(model, class_subset)
                 stride = max(int(model.stride.max()), 32)  # model stride
                 names = model.module.names if hasattr(model, 'module') else model.names  # get class names
                 model.half() if fp16 else model.float()
@@ -456,16 +466,26 @@ class DetectMultiBackend(nn.Module):
                 output_details = interpreter.get_output_details()  # outputs
             elif tfjs:
                 raise Exception('ERROR: YOLOv5 TF.js inference is not supported')
+        if class_subset and not pt:
+            LOGGER.warning('WARNING: class_subset is only supported for PyTorch *.pt models, ignoring')
         self.__dict__.update(locals())  # assign all variables to self
 
-    def forward(self, im, augment=False, visualize=False, val=False):
+    def forward(self, im, augment=False, visualize=False, val=False, tta_samples=False, keyframe=None):
         # YOLOv5 MultiBackend inference
         b, ch, h, w = im.shape  # batch, channel, height, width
         if self.fp16 and im.dtype != torch.float16:
             im = im.half()  # to FP16
 
         if self.pt:  # PyTorch
-            y = self.model(im, augment=augment, visualize=visualize)[0]
+            if keyframe is not None and hasattr(self.model, 'forward_keyframe'):  # video, reuse keyframe features
+                y = self.model.forward_keyframe(im, keyframe)
+            else:
+                y = self.model(im, augment=augment, visualize=visualize, tta_samples=tta_samples)
+            if isinstance(y, Candidates):  # Detect() top-k candidates and their anchor indices
+                return (y.pred, []) if val else y._replace(train_out=None)
+            y = y[0]
+            if isinstance(y, list):  # per-augmentation TTA samples
+                return (y, []) if val else y
         elif self.jit:  # TorchScript
             y = self.model(im)[0]
         elif self.dnn:  # ONNX OpenCV DNN
@@ -539,6 +559,14 @@ class DetectMultiBackend(nn.Module):
         tflite &= not edgetpu  # *.tflite
         return pt, jit, onnx, xml, engine, coreml, saved_model, pb, tflite, edgetpu, tfjs
 
+    @staticmethod
+    def _select_classes(model, classes):
+        # Restrict a loaded PyTorch model or ensemble to a class subset
+        for m in model if isinstance(model, nn.ModuleList) else [model]:
+            m.select_classes(classes)
+        if isinstance(model, nn.ModuleList):  # Ensemble
+            model.names, model.nc = model[0].names, model[0].nc
+
     @staticmethod
     def _load_metadata(f='path/to/meta.yaml'):
         # Load metadata from meta.yaml if it exists
@@ -556,6 +584,7 @@ class AutoShape(nn.Module):
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
     amp = False  # Automatic Mixed Precision (AMP) inference
+    reduced_decode = False  # decode JPEG files at reduced scale (PIL draft), results refer to the decoded images
 
     def __init__(self, model, verbose=True):
         super().__init__()
@@ -602,6 +631,9 @@ class AutoShape(nn.Module):
             f = f'image{i}'  # filename
             if isinstance(im, (str, Path)):  # filename or uri
                 im, f = Image.open(requests.get(im, stream=True).raw if str(im).startswith('http') else im), im
+                g = size / max(im.size)  # gain
+                if self.reduced_decode and g < 1:
+                    im.draft(im.mode, (math.ceil(im.width * g), math.ceil(im.height * g)))  # JPEG DCT scaling
                 im = np.asarray(exif_transpose(im))
             elif isinstance(im, Image.Image):  # PIL Image
                 im, f = np.asarray(exif_transpose(im)), getattr(im, 'filename', f) or f
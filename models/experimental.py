@@ -8,7 +8,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-from models.common import Conv
+from models.common import Candidates, Conv
 from utils.downloads import attempt_download
 
 
@@ -63,8 +63,18 @@ class Ensemble(nn.ModuleList):
     def __init__(self):
         super().__init__()
 
-    def forward(self, x, augment=False, profile=False, visualize=False):
-        y = [module(x, augment, profile, visualize)[0] for module in self]
+    def forward(self, x, augment=False, profile=False, visualize=False, tta_samples=False):
+        y = [module(x, augment, profile, visualize, tta_samples) for module in self]
+        if all(isinstance(yi, Candidates) for yi in y):  # top-k candidates, offset indices into the stacked anchor sets
+            pred, anchor_idx, n = [], [], 0
+            for yi in y:
+                pred.append(yi.pred)
+                anchor_idx.append(yi.anchor_idx + n)
+                n += sum(xi[0, ..., 0].numel() for xi in yi.train_out)  # anchors of this model
+            return Candidates(torch.cat(pred, 1), None, torch.cat(anchor_idx, 1))
+        y = [yi[0] for yi in y]
+        if augment and tta_samples:
+            return [yi for ym in y for yi in ym], None  # per-augmentation samples of every model
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
         y = torch.cat(y, 1)  # nms ensemble
@@ -10,6 +10,7 @@ import argparse
 import os
 import platform
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 
@@ -38,6 +39,9 @@ class Detect(nn.Module):
     stride = None  # strides computed during build
     onnx_dynamic = False  # ONNX export parameter
     export = False  # export mode
+    topk = 0  # inference candidates decoded per level, 0 to decode every anchor
+    topk_conf = 0.0  # inference objectness threshold applied on raw logits before top-k decoding
+    grid_cache = 8  # grids kept per detection layer for recently seen shapes (LRU), 0 to rebuild on every shape change
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -53,6 +57,7 @@ class Detect(nn.Module):
 
     def forward(self, x):
         z = []  # inference output
+        c, n = [], 0  # top-k candidate anchor indices, anchor offset of current level
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -60,7 +65,14 @@ class Detect(nn.Module):
 
             if not self.training:  # inference
                 if self.onnx_dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                    self.grid[i], self.anchor_grid[i] = self._cached_grid(nx, ny, i)
+
+                if self.topk and not self.export:  # decode top-k candidates only
+                    y, j = self._topk_decode(x[i], i)
+                    z.append(y)
+                    c.append(j + n)
+                    n += self.na * ny * nx
+                    continue
 
                 y = x[i].sigmoid()
                 if self.inplace:
@@ -73,8 +85,47 @@ class Detect(nn.Module):
                     y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, -1, self.no))
 
+        if c:  # top-k inference output, training output, candidate indices into the full anchor set
+            return Candidates(torch.cat(z, 1), x, torch.cat(c, 1))
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def _topk_decode(self, xi, i):
+        # Sigmoid and decode only the top-k objectness candidates of level i, x(bs,3,20,20,85) to y(bs,k,85), j(bs,k)
+        xi = xi.view(xi.shape[0], -1, self.no)
+        v, j = xi[..., 4].topk(min(self.topk, xi.shape[1]), 1)  # sorted objectness logits
+        if self.topk_conf > 0:  # sigmoid is monotonic, so threshold logits and drop columns below it in every image
+            j = j[:, :int((v > math.log(self.topk_conf / (1 - self.topk_conf))).sum(1).max())]
+        y = xi.gather(1, j[..., None].expand(-1, -1, self.no)).sigmoid()
+        xy, wh, conf = y.split((2, 2, self.nc + 1), 2)
+        xy = (xy * 2 + self.grid[i].reshape(-1, 2)[j]) * self.stride[i]  # xy
+        wh = (wh * 2) ** 2 * self.anchor_grid[i].reshape(-1, 2)[j]  # wh
+        return torch.cat((xy, wh, conf), 2), j
+
+    def select_classes(self, classes):
+        # Restrict the output convs to a class subset, new class i is old class classes[i]
+        k = torch.tensor([*range(5), *(5 + c for c in classes)], device=self.anchors.device)  # kept channels
+        k = (k + torch.arange(self.na, device=k.device).view(-1, 1) * self.no).view(-1)  # for every anchor
+        for mi in self.m:
+            mi.weight = nn.Parameter(mi.weight.data[k], requires_grad=mi.weight.requires_grad)
+            mi.bias = nn.Parameter(mi.bias.data[k], requires_grad=mi.bias.requires_grad)
+            mi.out_channels = len(k)
+        self.nc = len(classes)  # number of classes
+        self.no = self.nc + 5  # number of outputs per anchor
+
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # LRU cache of _make_grid() per layer and shape, keyed on anchor device and dtype to stay valid after .to()/.half()
+        if self.onnx_dynamic or not self.grid_cache:
+            return self._make_grid(nx, ny, i)
+        cache = self.__dict__.setdefault('grids', [OrderedDict() for _ in range(self.nl)])  # models from older *.pt
+        k = nx, ny, self.anchors.device, self.anchors.dtype
+        if k in cache[i]:
+            cache[i].move_to_end(k)
+        else:
+            cache[i][k] = self._make_grid(nx, ny, i)
+            if len(cache[i]) > self.grid_cache:
+                cache[i].popitem(last=False)  # least recently used
+        return cache[i][k]
+
     def _make_grid(self, nx=20, ny=20, i=0):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -129,22 +180,28 @@ class Model(nn.Module):
         self.info()
         LOGGER.info('')
 
-    def forward(self, x, augment=False, profile=False, visualize=False):
+    def forward(self, x, augment=False, profile=False, visualize=False, tta_samples=False):
         if augment:
-            return self._forward_augment(x)  # augmented inference, None
+            return self._forward_augment(x, tta_samples)  # augmented inference, None
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
-    def _forward_augment(self, x):
+    def _forward_augment(self, x, tta_samples=False):
         img_size = x.shape[-2:]  # height, width
         s = [1, 0.83, 0.67]  # scales
         f = [None, 3, None]  # flips (2-ud, 3-lr)
-        y = []  # outputs
-        for si, fi in zip(s, f):
-            xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
+        if tta_samples:  # every scale paired with its lr-flip, returned as separate TTA samples
+            s, f = [1, 1, 0.83, 0.83], [None, 3, None, 3]
+        y = [None] * len(s)  # outputs
+        gs = int(self.stride.max())  # grid size (max stride)
+        for si in dict.fromkeys(s):  # unique scales, same-size augmentations share one batched forward
+            j = [k for k, sk in enumerate(s) if sk == si]  # augmentation indices at this scale
+            xi = scale_img(torch.cat([x.flip(f[k]) if f[k] else x for k in j], 0), si, gs=gs)
             yi = self._forward_once(xi)[0]  # forward
             # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-            yi = self._descale_pred(yi, fi, si, img_size)
-            y.append(yi)
+            for n, k in enumerate(j):  # split batch back per augmentation
+                y[k] = self._descale_pred(yi[n * len(x):(n + 1) * len(x)], f[k], si, img_size)
+        if tta_samples:
+            return y, None  # list of per-augmentation predictions in original coordinates, train
         y = self._clip_augmented(y)  # clip augmented tails
         return torch.cat(y, 1), None  # augmented inference, train
 
@@ -161,6 +218,37 @@ class Model(nn.Module):
                 feature_visualization(x, m.type, m.i, save_dir=visualize)
         return x
 
+    def forward_keyframe(self, x, keyframe=True, split=5):
+        # Video inference reusing deep features, keyframes run the full model and cache the deep layers (backbone
+        # layers >= split and head layers fed only by them), other frames recompute shallow layers and head only
+        if getattr(self, 'deep', (None,))[0] != split:
+            nb = len(self.yaml['backbone'])  # number of backbone layers
+            deep = set()
+            for m in self.model:
+                f = [m.f] if isinstance(m.f, int) else m.f
+                if split <= m.i < nb or (m.i >= nb and all((m.i + j if j < 0 else j) in deep for j in f)):
+                    deep.add(m.i)
+            used = {m.i + j if j < 0 else j for m in self.model if m.i not in deep for j in
+                    ([m.f] if isinstance(m.f, int) else m.f)}  # layers consumed by recomputed layers
+            self.deep = split, deep, deep & used
+        _, deep, cached = self.deep
+        cache = getattr(self, 'feature_cache', None)
+        if cache is None or cache['shape'] != x.shape:
+            keyframe, cache = True, {'shape': x.shape}  # no features to reuse
+        y = []  # outputs
+        for m in self.model:
+            if m.i in deep and not keyframe:
+                x = cache.get(m.i)  # reused feature, None if not consumed by recomputed layers
+            else:
+                if m.f != -1:  # if not from previous layer
+                    x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+                x = m(x)  # run
+                if keyframe and m.i in cached:
+                    cache[m.i] = x
+            y.append(x if m.i in self.save or m.i in cached else None)  # save output
+        self.feature_cache = cache
+        return x
+
     def _descale_pred(self, p, flips, scale, img_size):
         # de-scale predictions following augmented inference (inverse operation)
         if self.inplace:
@@ -234,6 +322,16 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def select_classes(self, classes):  # restrict Detect() to a subset of classes, i.e. [0, 1, 2, 3, 5, 7]
+        LOGGER.info(f'Restricting model to classes {list(classes)}... ')
+        m = self.model[-1]  # Detect()
+        m.select_classes(classes)
+        self.names = [self.names[c] for c in classes]  # class names
+        self.yaml['nc'] = m.nc  # update yaml value
+        if hasattr(self, 'nc'):
+            self.nc = m.nc  # attached number of classes
+        return self
+
     def info(self, verbose=False, img_size=640):  # print model information
         model_info(self, verbose, img_size)
 
@@ -2,7 +2,7 @@ import torch
 import torchvision
 from torchvision.ops import batched_nms
 from utils.metrics import box_iou, fitness
-from utils.general import xywh2xyxy
+from utils.general import box_members, non_max_suppression, xywh2xyxy, scale_coords
 #Detectron imports 
 #Possiveis soluções: restart connection; install versoes anteriores; clone do repositorio localmente; escrever funçao iou
 from detectron2.detectron2.structures import BoxMode, Boxes, pairwise_iou, Instances
@@ -77,76 +77,19 @@ def altered_yolo_nms(prediction,
                         multi_label=False,
                         labels=(),
                         max_det=300):
-
-    
-    bs = prediction.shape[0]  # batch size
-    nc = prediction.shape[2] - 5  # number of classes
-    xc = candidates = prediction[..., 4] > conf_thres  # candidates
-    #print(candidates.sum())
-    indices_candidates = candidates[0].nonzero()
-    #xc = prediction[..., 4] > 0  # using all possible boxes
-    # Checks
-    assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
-    assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
-
-    # Settings
-    # min_wh = 2  # (pixels) minimum box width and height
-    max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    redundant = True  # require redundant detections
-    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
-
-    output = [torch.zeros((0, 6), device=prediction.device)] * bs
-    for xi, x in enumerate(prediction):  # image index, image inference
-        x = x[xc[xi]]  # confidence
-
-        # If none remain process next image
-        if not x.shape[0]:
-            final_indices = []
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        conf, j = x[:, 5:].max(1, keepdim=True)
-        x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-        indices_candidates = indices_candidates[conf.view(-1) > conf_thres]
-        #x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > 0]#usando todas deteçoes
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            final_indices = []
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-        teste = indices_candidates[i]
-        final_indices = torch.squeeze(indices_candidates[i],dim=1)
-        output[xi] = x[i]
-    return final_indices, output
+    #YOLO NMS over the whole batch that also returns, for every image, the anchor indices (rows of prediction[i]) of the
+    #kept detections. These are the cluster centers of the output redundancy method
+    output, indices = non_max_suppression(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                          max_det, return_indices=True)
+    return indices, output
 
 def compute_anchor_statistics(outputs, device, image_size, original_predictions_yolo, remove_uncertain_detections,
-                                nms_threshold = 0.5, max_detections_per_image = 100,affinity_threshold = 0.95):
-        
+                                nms_threshold = 0.5, max_detections_per_image = 100,affinity_threshold = 0.95,
+                                anchor_idx=None, conf_thres=0.25, iou_thres=0.45):
+    #anchor_idx: (1,N) index of every prediction into the full anchor set when yolo only decoded its top-k candidates,
+    #the clusters then record the anchor of their center in the anchor_idxs field
+    #conf_thres, iou_thres: thresholds of the cluster centers nms
+    
     predicted_boxes, predicted_boxes_covariance, predicted_prob, classes_idxs, predicted_prob_vectors = outputs
     # Get cluster centers using standard nms. Much faster than sequential
     # clustering.
@@ -160,19 +103,20 @@ def compute_anchor_statistics(outputs, device, image_size, original_predictions_
     ##aqui estamos apenas a limitar o numero maximo de bboxes
     #keep = keep[: max_detections_per_image]
     #UTILIZANDO O NMS ALTERADO DO YOLO!
-    conf_thres = 0.25
-    iou_thres = 0.45
     classes = None
     agnostic_nms = False
     max_det = 1000
     keep, output = altered_yolo_nms(original_predictions_yolo, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
     #Limit the number of possible detections/cluster centers per image (essencial for mc dropout?)
-    keep = keep[:max_detections_per_image]
+    keep = keep[0][:max_detections_per_image]
     #for i in range(81):
     #    print(predicted_prob_vectors[0][i])
     # Get pairwise iou matrix
     #obtem matriz MxN com iou entre boxes (diagonal é 1 e é simetrica)
-    match_quality_matrix = pairwise_iou(Boxes(predicted_boxes[keep,:]), Boxes(predicted_boxes))
+    #match_quality_matrix = pairwise_iou(Boxes(predicted_boxes[keep,:]), Boxes(predicted_boxes))
+    #Sparse version: only the (cluster center, member) pairs above the affinity threshold, sorted by center then member
+    k, j = box_members(predicted_boxes, keep, affinity_threshold)
+    clusters_inds = j.split(torch.bincount(k, minlength=len(keep)).tolist())
 
     #seleciona os ious das bbox que sobraram
     #fica uma matriz com 100 bbox(as melhores) por 1957 bbox(todas as outras possibilidades)
@@ -181,18 +125,18 @@ def compute_anchor_statistics(outputs, device, image_size, original_predictions_
     #por linha esta matriz vai te dizer quais sao as bbox que partilham bastante o espaço
     #com essa bbox da linha, que vai ser o cluster center
     #clusters_inds = clusters_inds > affinity_threshold
-    clusters_inds = match_quality_matrix > affinity_threshold
     # Compute mean and covariance for every cluster.
     predicted_prob_vectors_list = []
     predicted_boxes_list = []
     predicted_boxes_covariance_list = []
+    center_idxs_list = []
     #o cluster_idxs vai buscar linha a linha da matriz 
     #ou seja, a lista das bbox que estao acima do affinity_threshold
     #o center_idx vai buscar o indice da bbox que vai ser o centro do cluster
     for cluster_idxs, center_idx in zip(
             clusters_inds, keep):
 
-        if cluster_idxs.sum(0) >= 2: #se houver pelo menos mais uma bbox naquela zona
+        if len(cluster_idxs) >= 2: #se houver pelo menos mais uma bbox naquela zona
             # Make sure to only select cluster members of same class as center
             cluster_center_classes_idx = classes_idxs[center_idx] #vai buscar a classe atribuida À bbox do cluster center
             cluster_classes_idxs = classes_idxs[cluster_idxs] #vai buscar as classes atribuidas às bboxs do cluster
@@ -243,6 +187,7 @@ def compute_anchor_statistics(outputs, device, image_size, original_predictions_
             predicted_boxes_list.append(cluster_mean) #lista que vai conter a media de cada cluster 
             predicted_boxes_covariance_list.append(cluster_covariance) #lista que vai conter a cov de cada cluster
             predicted_prob_vectors_list.append(cluster_probs_vector) #list que vai conter a media das classes de cada cluster
+            center_idxs_list.append(center_idx)
         else:
             print('nao adicionei o cluster')
         
@@ -260,6 +205,7 @@ def compute_anchor_statistics(outputs, device, image_size, original_predictions_
         result.pred_cls_probs = predicted_prob_vectors #lista as probs de cada classe para cada cluster center 100,7
         result.pred_boxes_covariance = torch.stack( 
             predicted_boxes_covariance_list, 0) ##lista com a matriz cov para cada cluster center 100, 4,4
+        keep = torch.stack(center_idxs_list)
     else:
         result.pred_boxes = Boxes(predicted_boxes[keep,:])
         result.scores = torch.zeros(predicted_boxes[keep,:].shape[0]).to(device)
@@ -267,6 +213,8 @@ def compute_anchor_statistics(outputs, device, image_size, original_predictions_
         result.pred_cls_probs = predicted_prob_vectors[keep,:]
         result.pred_boxes_covariance = torch.empty(
             (predicted_boxes[keep,:].shape + (4,))).to(device)
+    if anchor_idx is not None:
+        result.anchor_idxs = anchor_idx.view(-1)[keep]
     return result
 
 def probabilistic_detector_postprocessing(outputs, image_size):
@@ -330,6 +278,33 @@ def probabilistic_detector_postprocessing(outputs, image_size):
         outputs.pred_boxes_covariance = output_boxes_covariance
     return outputs
 
+def output_redundancy_instances(pred, im_shape, im0, device, remove_uncertain_detections=False, anchor_idx=None,
+                                conf_thres=0.25, iou_thres=0.45):
+    """
+    Run the whole output redundancy pipeline on a single image prediction.
+
+    Args:
+        pred (Tensor): yolo prediction (1,N,85) with xywh boxes, used as is for the cluster centers nms.
+        im_shape (tuple): (height, width) of the network input the boxes refer to. None if the boxes are already
+        in original image pixels.
+        im0 (ndarray): original image.
+        anchor_idx (Tensor): (1,N) index of every prediction into the full anchor set when yolo only decoded its
+        top-k candidates, None otherwise.
+        conf_thres, iou_thres (float): confidence and IoU thresholds of the cluster centers nms.
+
+    Returns:
+        outputs (Instances): clusters with mean boxes (xyxy in im0 pixels), covariances and class probabilities.
+    """
+    pred_redundancy = torch.squeeze(torch.clone(pred), dim=0)
+    pred_redundancy[:, :4] = xywh2xyxy(pred_redundancy[:, :4])
+    if im_shape is not None:
+        # Rescale boxes from img_size to im0 size
+        pred_redundancy[:, :4] = scale_coords(im_shape, pred_redundancy[:, :4], im0.shape).round()
+    outputs = pre_processing_anchor_stats(pred_redundancy)
+    outputs = compute_anchor_statistics(outputs, device, im0, pred, remove_uncertain_detections, anchor_idx=anchor_idx,
+                                        conf_thres=conf_thres, iou_thres=iou_thres)
+    return probabilistic_detector_postprocessing(outputs, im0)
+
 def covar_xyxy_to_xywh(output_boxes_covariance):
     """
     Converts covariance matrices from top-left bottom-right corner representation to top-left corner
@@ -355,13 +330,15 @@ def covar_xyxy_to_xywh(output_boxes_covariance):
 
     return output_boxes_covariance
 
-def instances_to_json(instances,img_id,kitti):
+def instances_to_json(instances,img_id,kitti,class_subset=None):
     """
     Dump an "Instances" object to a COCO-format json that's used for evaluation.
 
     Args:
         instances (Instances): detectron2 instances
         img_id (int): the image id
+        class_subset (list): YOLO class ids kept by a class-restricted model, predicted class i is YOLO class
+        class_subset[i]. None if the model predicts all classes.
         cat_mapping_dict (dict): dictionary to map between raw category id from net and dataset id. very important if
         performing inference on different dataset than that used for training.
 
@@ -409,7 +386,9 @@ def instances_to_json(instances,img_id,kitti):
         cat_mapping_dict = {2: 1, 7: 2, 0: 3, 1: 5}
     else:
         cat_mapping_dict = {2: 1, 5: 2, 7: 3, 0: 4, 1: 6, 3: 7}
-    
+    if class_subset:
+        #Model restricted to a class subset, remap its contiguous class ids to the original YOLO ids first
+        cat_mapping_dict = {i: cat_mapping_dict[c] for i, c in enumerate(class_subset) if c in cat_mapping_dict}
 
     boxes_xyxy = instances.pred_boxes.tensor.cpu().numpy()
     boxes_xywh = BoxMode.convert(boxes_xyxy, BoxMode.XYXY_ABS, BoxMode.XYWH_ABS)
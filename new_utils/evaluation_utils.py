@@ -378,7 +378,11 @@ def get_matched_results(path_to_results, preprocessed_gt_instances, preprocessed
 
         return matched_results
 
-def compute_nll(matched_results_,kitti = False):
+def class_subset_index(class_subset):
+    #Position of each YOLO class id inside the output of a model restricted to class_subset
+    return {class_idx: i for i, class_idx in enumerate(class_subset)}
+
+def compute_nll(matched_results_,kitti = False,class_subset = None):
     #Category mapping YOLO to BDD
     #cat_mapping_dict = {2: 1, 5: 2, 7: 3, 0: 4, 1: 6, 3: 7}
     #É preciso ter em atençao que nas ground truths a categoria "rider" nao existe no yolo. sera que devia entao de tirá-la das gt???
@@ -414,6 +418,12 @@ def compute_nll(matched_results_,kitti = False):
                 #NEste caso tu tens de fazer o equivalente mas para o YOLO, tens de ir buscar os indexes na lista das classes que contem os cs que queres
                 gt_converted_cat_idxs = torch.as_tensor([cat_mapping_dict[class_idx.cpu(
                 ).tolist()] for class_idx in gt_converted_cat_idxs]).to(device)
+                if class_subset:
+                    #Predictions of a class-restricted model only carry the subset, so index into it.
+                    #Ground truths of a category left out of the subset become -1 and never match a class below
+                    subset_idx = class_subset_index(class_subset)
+                    gt_converted_cat_idxs = torch.as_tensor([subset_idx.get(class_idx.cpu(
+                    ).tolist(), -1) for class_idx in gt_converted_cat_idxs], dtype=torch.int64).to(device)
                 matched_results[matched_results_key]['gt_converted_cat_idxs'] = gt_converted_cat_idxs.to(
                     device)
                 #print(torch.unique(gt_converted_cat_idxs))
@@ -424,7 +434,7 @@ def compute_nll(matched_results_,kitti = False):
                     # detections.
                     #Este passo aqui vai obter o CS que a previsao tem para a categoria que é suposto ser da ground truth
                     matched_results[matched_results_key]['predicted_score_of_gt_category'] = torch.gather(
-                        predicted_cls_probs, 1, gt_converted_cat_idxs.unsqueeze(1)).squeeze(1)
+                        predicted_cls_probs, 1, gt_converted_cat_idxs.clamp(min=0).unsqueeze(1)).squeeze(1)
                 matched_results[matched_results_key]['gt_cat_idxs'] = gt_converted_cat_idxs
             else:
                 # For false positives, the correct category is background. For retinanet, since no explicit
@@ -454,6 +464,9 @@ def compute_nll(matched_results_,kitti = False):
             meta_catalog = [0,1,2,7]
         else:    
             meta_catalog = [0,1,2,3,5,7]
+        if class_subset:
+            subset_idx = class_subset_index(class_subset)
+            meta_catalog = [subset_idx[class_idx] for class_idx in meta_catalog if class_idx in subset_idx]
         #print(torch.unique(true_positives['gt_converted_cat_idxs']))
         #print(torch.unique(false_positives['predicted_cat_idxs']))
         for class_idx in meta_catalog:
@@ -552,7 +565,7 @@ def compute_nll(matched_results_,kitti = False):
     print(table)
     return final_average_output_dict, final_accumulated_output_dict
 
-def compute_calibration_uncertainty_errors(matched_results,kitti):
+def compute_calibration_uncertainty_errors(matched_results,kitti,class_subset = None):
     #YOLO | BDD | kitti
     #2 car | 1 car | 1 car
     #5 bus | 2 bus | ----
@@ -573,6 +586,12 @@ def compute_calibration_uncertainty_errors(matched_results,kitti):
         cat_mapping_dict = {5: 1, 4: 0, 3: 0, 2: 7, 1: 2}
     else:
         cat_mapping_dict = {7: 3, 6: 1, 5: 0, 4: 0, 3: 7, 2: 5, 1: 2}
+    #YOLO categories that are evaluated, restricted to the ones a class-restricted model actually predicts
+    categories, columns = [0, 1, 2, 7] if kitti else [0, 1, 2, 3, 5, 7], [0, 1, 2, 3, 5, 7]
+    if class_subset:
+        subset_idx = class_subset_index(class_subset)
+        categories = [class_idx for class_idx in categories if class_idx in subset_idx]
+        columns = [subset_idx[class_idx] for class_idx in columns if class_idx in subset_idx]
     with torch.no_grad():
         # Build preliminary dicts required for computing classification scores.
         for matched_results_key in matched_results.keys():
@@ -586,13 +605,11 @@ def compute_calibration_uncertainty_errors(matched_results,kitti):
                 #gt_converted_cat_idxs = matched_results[matched_results_key]['gt_cat_idxs']
                 gt_converted_cat_idxs = torch.as_tensor([cat_mapping_dict[class_idx.cpu(
                 ).tolist()] for class_idx in gt_converted_cat_idxs]).to(device)
-                #convert from 0,1,2,3,5,7 to 0,1,2,3,4,5
-                if kitti: #convert from 0,1,2,7 to 0,1,2,3
-                    yolo_to_0_5_dict = {0: 0, 1: 1, 2: 2, 7: 3}
-                else: #convert from 0,1,2,3,5,7 to 0,1,2,3,4,5
-                    yolo_to_0_5_dict = {0: 0, 1: 1, 2: 2, 3: 3, 5: 4, 7: 5}
-                gt_converted_cat_idxs = torch.as_tensor([yolo_to_0_5_dict[class_idx.cpu(
-                ).tolist()] for class_idx in gt_converted_cat_idxs]).to(device)
+                #convert from 0,1,2,3,5,7 to 0,1,2,3,4,5 (kitti: 0,1,2,7 to 0,1,2,3), ground truths of a category
+                #left out of the class subset become -1 and never match a class below
+                yolo_to_0_5_dict = {class_idx: i for i, class_idx in enumerate(categories)}
+                gt_converted_cat_idxs = torch.as_tensor([yolo_to_0_5_dict.get(class_idx.cpu(
+                ).tolist(), -1) for class_idx in gt_converted_cat_idxs]).to(device)
                 matched_results[matched_results_key]['gt_converted_cat_idxs'] = gt_converted_cat_idxs.to(
                     device)
                 matched_results[matched_results_key]['gt_cat_idxs'] = gt_converted_cat_idxs
@@ -610,7 +627,8 @@ def compute_calibration_uncertainty_errors(matched_results,kitti):
                 #Esta parte afinal é necessaria porque precisamos disto para calcular os calibration errors, que apenas sao relevantes para estas classes
                 #Neste momento as classes que serão predicted vao do 0 ate ao 5 inclusive
                 #0-person/rider|1-bycicle|2-car|3-motorcycle|4-bus|5-truck
-                matched_results[matched_results_key]['predicted_cls_probs'] = matched_results[matched_results_key]['predicted_cls_probs'][:,[0,1,2,3,5,7]]
+                #A class-restricted model already carries only its subset, so the columns are looked up inside it
+                matched_results[matched_results_key]['predicted_cls_probs'] = matched_results[matched_results_key]['predicted_cls_probs'][:,columns]
                 predicted_class_probs, predicted_cat_idxs = matched_results[
                     matched_results_key]['predicted_cls_probs'].max(1)
                 #teste_probs, teste_idxs = teste.max(1)
@@ -636,13 +654,14 @@ def compute_calibration_uncertainty_errors(matched_results,kitti):
              false_positives['predicted_cls_probs'].flatten()),
             0)
 
+        #Ground truths left out of the class subset (-1) get an all-zero one-hot row
         all_gt_scores = torch.cat(
             (torch.nn.functional.one_hot(
-                true_positives['gt_cat_idxs'],
-                true_positives['predicted_cls_probs'].shape[1]).flatten().to(device),
+                true_positives['gt_cat_idxs'] + 1,
+                true_positives['predicted_cls_probs'].shape[1] + 1)[:, 1:].flatten().to(device),
                 torch.nn.functional.one_hot(
-                duplicates['gt_cat_idxs'],
-                true_positives['predicted_cls_probs'].shape[1]).flatten().to(device),
+                duplicates['gt_cat_idxs'] + 1,
+                true_positives['predicted_cls_probs'].shape[1] + 1)[:, 1:].flatten().to(device),
                 torch.zeros_like(
                 false_positives['predicted_cls_probs'].type(
                     torch.LongTensor).flatten()).to(device)),
@@ -657,10 +676,7 @@ def compute_calibration_uncertainty_errors(matched_results,kitti):
         #Nesta secção vamos classe a classe calcular regression calibration error, minimum uncertainty error tanto para cls como reg.
         #No fim, faz-se uma média de todas as classes
         #for class_idx in cat_mapping_dict.values():
-        if kitti:
-            categories_list = [0,1,2,3]
-        else:
-            categories_list = [0,1,2,3,4,5]
+        categories_list = list(range(len(categories)))
 
         for class_idx in categories_list:
             true_positives_valid_idxs = true_positives['gt_converted_cat_idxs'] == class_idx
@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+import torch
+#Detectron imports
+from detectron2.detectron2.structures import Instances, pairwise_iou
+
+
+#Uncertainty guided refinement: a frame is first processed at a low input size, and only the clusters that come out
+#uncertain are processed again at full resolution, either on crops around them or on the whole frame.
+def cluster_uncertainty(instances):
+    """
+    Total variance (trace of the box covariance) and Shannon entropy (of the class probability vector) of every
+    cluster, the same quantities used to remove uncertain detections in compute_anchor_statistics.
+    """
+    if len(instances) == 0:
+        return torch.zeros(0), torch.zeros(0)
+    total_variance = torch.diagonal(instances.pred_boxes_covariance, dim1=1, dim2=2).sum(1)
+    shannon_entropy = torch.distributions.categorical.Categorical(instances.pred_cls_probs).entropy()
+    return total_variance, shannon_entropy
+
+def uncertain_clusters(instances, max_total_variance=33, max_entropy=0.95):
+    #Boolean mask of the clusters that need to be refined at full resolution
+    total_variance, shannon_entropy = cluster_uncertainty(instances)
+    return (total_variance > max_total_variance) | (shannon_entropy > max_entropy)
+
+def refinement_windows(boxes, shape, margin=1.0, min_size=64):
+    """
+    Crop windows around uncertain clusters.
+
+    Args:
+        boxes (Tensor): (n,4) xyxy cluster boxes in original image pixels.
+        shape (tuple): original image shape.
+        margin (float): context added on each side, as a fraction of the box width/height.
+        min_size (int): minimum window size in original image pixels.
+
+    Returns:
+        list of [x1, y1, x2, y2] integer windows clipped to the image.
+    """
+    c = (boxes[:, :2] + boxes[:, 2:]) / 2  # centers
+    wh = ((boxes[:, 2:] - boxes[:, :2]) * (1 + 2 * margin)).clamp(min=min_size)  # window sizes
+    windows = torch.cat((c - wh / 2, c + wh / 2), 1)
+    windows[:, [0, 2]] = windows[:, [0, 2]].clamp(0, shape[1])
+    windows[:, [1, 3]] = windows[:, [1, 3]].clamp(0, shape[0])
+    return windows.round().int().tolist()
+
+def crop_batch(im0, windows, gain, stride=32):
+    """
+    Resize every window of im0 by gain (the resize applied by the full resolution letterbox) and pad them into
+    a single batch, so all crops go through the network in one forward.
+
+    Returns:
+        batch (ndarray): (n,3,h,w) uint8 RGB crops, h and w stride multiples.
+        gains (list): (x, y) factors that map crop pixels back to original image pixels.
+    """
+    sizes = [(max(round((y2 - y1) * gain), 1), max(round((x2 - x1) * gain), 1)) for x1, y1, x2, y2 in windows]
+    h = int(np.ceil(max(s[0] for s in sizes) / stride) * stride)
+    w = int(np.ceil(max(s[1] for s in sizes) / stride) * stride)
+    batch = np.full((len(windows), h, w, 3), 114, dtype=np.uint8)
+    gains = []
+    for i, ((x1, y1, x2, y2), (ch, cw)) in enumerate(zip(windows, sizes)):
+        batch[i, :ch, :cw] = cv2.resize(im0[y1:y2, x1:x2], (cw, ch), interpolation=cv2.INTER_LINEAR)
+        gains.append(((x2 - x1) / cw, (y2 - y1) / ch))
+    batch = np.ascontiguousarray(batch.transpose((0, 3, 1, 2))[:, ::-1])  # BHWC to BCHW, BGR to RGB
+    return batch, gains
+
+def crops_to_original(pred, windows, gains):
+    #Map crop predictions (n,N,85) with xywh boxes to original image pixels and join them as a single image (1,n*N,85)
+    pred = torch.clone(pred)
+    for i, ((x1, y1, _, _), (gx, gy)) in enumerate(zip(windows, gains)):
+        pred[i, :, [0, 2]] *= gx
+        pred[i, :, [1, 3]] *= gy
+        pred[i, :, 0] += x1
+        pred[i, :, 1] += y1
+    return pred.view(1, -1, pred.shape[-1])
+
+def merge_refined_instances(instances, uncertain, refined, iou_thres=0.45):
+    """
+    Replace the uncertain low resolution clusters by the refined full resolution ones. Certain clusters that
+    overlap a refined cluster are also dropped, since the crops see them again at a higher resolution.
+    """
+    certain = instances[~uncertain]
+    if len(certain) and len(refined):
+        certain = certain[pairwise_iou(certain.pred_boxes, refined.pred_boxes).max(1)[0] < iou_thres]
+    return Instances.cat([certain, refined])
@@ -0,0 +1,193 @@
+import math
+
+import torch
+import torch.distributed as dist
+
+from utils.general import box_members, scale_coords, xywh2xyxy
+from utils.metrics import box_iou
+
+# Covariance regularisation of the offline pipeline, applied at the same stages
+SINGLE_EPS = 1e-4  # compute_anchor_statistics(), covariance of a cluster without other members
+OUTPUT_EPS = 1e-4  # probabilistic_detector_postprocessing(), added to every output cluster covariance
+SCORE_EPS = 1e-2  # scoring_rules.compute_reg_scores() and compute_reg_scores_fp(), NLL and entropy
+MUE_EPS = 1e-4  # evaluation_utils.compute_calibration_uncertainty_errors(), minimum uncertainty error entropy
+
+PROB_KEYS = ('prob/tp_cls_nll', 'prob/tp_reg_nll', 'prob/tp_reg_mse', 'prob/fp_cls_nll', 'prob/fp_reg_entropy',
+             'prob/cls_ce', 'prob/reg_ece', 'prob/reg_mce', 'prob/cls_mue', 'prob/reg_mue')
+
+
+def redundancy_clusters(boxes, probs, keep, affinity_threshold=0.95):
+    """
+    Output redundancy clusters of one image, the vectorized equivalent of compute_anchor_statistics() followed by
+    probabilistic_detector_postprocessing() without detectron2 structures.
+
+    Args:
+        boxes (Tensor): (N, 4) xyxy boxes of all the anchors.
+        probs (Tensor): (N, nc) class probability vectors (objectness * class score) of all the anchors.
+        keep (Tensor): anchor indices of the cluster centers, i.e. the NMS survivors.
+
+    Returns:
+        means (Tensor): (K, 4) cluster mean boxes.
+        covariances (Tensor): (K, 4, 4) cluster covariances as output by probabilistic_detector_postprocessing(), the
+            sample covariance (SINGLE_EPS * I for clusters of a single member) plus OUTPUT_EPS * I.
+        cluster_probs (Tensor): (K, nc) mean class probability vectors.
+    """
+    classes = probs.argmax(1)
+    k, j = box_members(boxes, keep, affinity_threshold)
+    single = torch.bincount(k, minlength=len(keep)) < 2  # no other anchor above the affinity threshold
+    m = classes[j] == classes[keep[k]]  # members of the same class as the center
+    k, j = k[m], j[m]
+    n = torch.bincount(k, minlength=len(keep)).clamp(min=1).to(boxes.dtype)[:, None]
+    means = torch.zeros((len(keep), 4), device=boxes.device).index_add_(0, k, boxes[j]) / n
+    cluster_probs = torch.zeros((len(keep), probs.shape[1]), device=boxes.device).index_add_(0, k, probs[j]) / n
+    r = boxes[j] - means[k]  # residuals
+    covariances = torch.zeros((len(keep), 4, 4), device=boxes.device).index_add_(0, k, r[:, :, None] * r[:, None])
+    covariances /= (n - 1).clamp(min=1)[..., None]
+    eye = torch.eye(4, device=boxes.device)
+    covariances[single] = SINGLE_EPS * eye
+    covariances += OUTPUT_EPS * eye  # well conditioned
+    i = (means[:, 2] > means[:, 0]) & (means[:, 3] > means[:, 1])  # non-empty boxes
+    return means[i], covariances[i], cluster_probs[i]
+
+
+def gaussian_nll_entropy(means, covariances, x=None):
+    # Negative log likelihood of x and entropy of 4-D Gaussians, nan where the covariance is not positive definite
+    L, info = torch.linalg.cholesky_ex(covariances.double())
+    ok = info == 0
+    half_logdet = L.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+    entropy = 2 * (1 + math.log(2 * math.pi)) + half_logdet
+    nll = None
+    if x is not None:
+        z = torch.linalg.solve_triangular(L, (x - means).double()[..., None], upper=False)[..., 0]
+        nll = 0.5 * (4 * math.log(2 * math.pi) + (z ** 2).sum(-1)) + half_logdet
+        nll[~ok] = math.nan
+    entropy[~ok] = math.nan
+    return nll, entropy
+
+
+class ProbabilisticStats:
+    """
+    Streaming output redundancy probabilistic metrics of val.py, the incremental counterpart of compute_nll() and
+    compute_calibration_uncertainty_errors() over the matches of get_matched_results().
+
+    Every image adds its true positives, duplicates and false positives to per-class sums and histograms on the input
+    device, so memory is constant in the number of images and nothing is written to JSON. NLLs, MSE, entropies and the
+    regression calibration counts are exact. The classification marginal calibration error uses fixed equal-width bins
+    and the minimum uncertainty errors are evaluated at histogram bin edges.
+    """
+
+    def __init__(self, nc, iou_min=0.1, iou_correct=0.7, conf_thres=0.25, iou_thres=0.45, max_det=100,
+                 affinity_threshold=0.95, cal_bins=15, mue_bins=1000, entropy_range=(-20.0, 60.0)):
+        self.nc = nc
+        self.iou_min, self.iou_correct = iou_min, iou_correct  # false positive / negative and true positive IoUs
+        self.conf_thres, self.iou_thres, self.max_det = conf_thres, iou_thres, max_det  # cluster center NMS
+        self.affinity_threshold = affinity_threshold  # cluster member IoU
+        self.cal_bins, self.mue_bins, self.entropy_range = cal_bins, mue_bins, entropy_range
+        self.stats = None
+
+    def init_stats(self, device):
+        kw = {'device': device, 'dtype': torch.float64}
+        self.stats = {
+            'sums': torch.zeros((self.nc, 7), **kw),  # tp n, cls nll, reg nll, mse, fp n, cls nll, reg entropy
+            'cal': torch.zeros((self.cal_bins, 3), **kw),  # classification calibration bins n, sum p, sum y
+            'reg_n': torch.zeros(self.nc, **kw),  # tp + duplicates
+            'reg_cdf': torch.zeros((self.nc, 4, self.cal_bins - 1), **kw),  # cdf(gt) below each step (i + 1) / bins
+            'mue': torch.zeros((2, self.nc, self.mue_bins, 2), **kw)}  # cls/reg, class, entropy bin, tp/others
+        return self.stats
+
+    def update(self, pred, keep, im_shape, shape, ratio_pad, labels):
+        """
+        Args:
+            pred (Tensor): (N, 5 + nc) raw Detect output of one image, xywh boxes in network input pixels.
+            keep (Tensor): anchor indices kept by non_max_suppression(return_indices=True) for this image.
+            im_shape (tuple): network input (height, width).
+            shape, ratio_pad: original image shape and letterbox ratio and padding, as in val.py.
+            labels (Tensor): (M, 5) native-space labels class, x1, y1, x2, y2.
+        """
+        s = self.stats or self.init_stats(pred.device)
+        boxes = scale_coords(im_shape, xywh2xyxy(pred[:, :4].float()), shape, ratio_pad).round()
+        probs = pred[:, 5:].float() * pred[:, 4:5].float()
+        means, covs, probs = redundancy_clusters(boxes, probs, keep[:self.max_det], self.affinity_threshold)
+        score, pcls = probs.max(1)
+
+        # Match, true positives are the highest scoring cluster of every label above iou_correct, the others duplicates
+        iou = box_iou(labels[:, 1:], means)
+        fp = (iou <= self.iou_min).all(0)
+        i, j = (iou >= self.iou_correct).nonzero(as_tuple=True)
+        o = score[j].argsort(descending=True)
+        o = o[i[o].sort(stable=True)[1]]  # by label, then by score
+        i, j = i[o], j[o]
+        tp = torch.ones_like(i, dtype=torch.bool)
+        tp[1:] = i[1:] != i[:-1]  # first of every label
+        tcls = labels[i, 0].long()
+
+        # NLL, true positives by label class and false positives by predicted class
+        jt, ct, gt = j[tp], tcls[tp], labels[i[tp], 1:]
+        eye = torch.eye(4, device=covs.device)
+        nll, _ = gaussian_nll_entropy(means[jt], covs[jt] + SCORE_EPS * eye, gt)
+        x = torch.stack((torch.ones_like(nll), -probs[jt, ct].double().log(), nll,
+                         ((means[jt] - gt) ** 2).mean(1).double()), 1)
+        s['sums'][:, :4].index_add_(0, ct, x)
+        _, entropy = gaussian_nll_entropy(means[fp], covs[fp] + SCORE_EPS * eye)
+        x = torch.stack((torch.ones_like(entropy), -score[fp].double().log(), entropy), 1)
+        s['sums'][:, 4:].index_add_(0, pcls[fp], x)
+
+        # Classification calibration, one-hot targets of true positives and duplicates, zeros for false positives
+        rows = torch.cat((j, fp.nonzero()[:, 0]))
+        p = probs[rows]
+        y = torch.zeros_like(p)
+        y[torch.arange(len(i), device=y.device), tcls] = 1.0
+        b = (p * self.cal_bins).long().clamp(max=self.cal_bins - 1).view(-1)
+        x = torch.stack((torch.ones_like(b, dtype=torch.float64), p.view(-1).double(), y.view(-1).double()), 1)
+        s['cal'].index_add_(0, b, x)
+
+        # Regression calibration of true positives and duplicates, per box dimension
+        var = covs[j].diagonal(dim1=-2, dim2=-1)
+        cdf = torch.distributions.Normal(means[j], var.sqrt()).cdf(labels[i, 1:])
+        steps = torch.arange(1, self.cal_bins, device=cdf.device) / self.cal_bins
+        s['reg_n'].index_add_(0, tcls, torch.ones_like(tcls, dtype=torch.float64))
+        s['reg_cdf'].index_add_(0, tcls, (cdf[..., None] < steps).double())
+
+        # Minimum uncertainty errors, true positives against duplicates and false positives
+        c = torch.cat((tcls, pcls[fp]))
+        y = torch.cat((tp, torch.zeros_like(fp[fp])))
+        _, entropy = gaussian_nll_entropy(means[rows], covs[rows] + MUE_EPS * eye)
+        lo, hi = self.entropy_range
+        entropy = (entropy.nan_to_num(nan=hi) - lo) / (hi - lo)  # regression entropy to [0, 1]
+        for k, e in enumerate((1 - score[rows].double(), entropy)):  # both increasing with the entropy
+            b = (e * self.mue_bins).long().clamp(0, self.mue_bins - 1)
+            s['mue'][k].index_put_((c, b, (~y).long()), torch.ones_like(e), accumulate=True)
+
+    def all_reduce(self, device):
+        # Sum the statistics of all ranks of a sharded run
+        for x in (self.stats or self.init_stats(device)).values():
+            dist.all_reduce(x)
+
+    def result(self):
+        """Returns the PROB_KEYS metrics, class averages ignoring classes without samples"""
+        if self.stats is None:
+            return (math.nan,) * len(PROB_KEYS)
+        s = {k: v.cpu() for k, v in self.stats.items()}
+        nanmean = lambda x: x[~x.isnan()].mean().item() if (~x.isnan()).any() else math.nan
+        sums = s['sums']
+        tp = sums[:, 1:4] / sums[:, :1]  # nan for classes without true positives
+        fp = sums[:, 5:] / sums[:, 4:5]
+
+        # Classification marginal calibration error (L2 over equal-width bins)
+        n, sp, sy = s['cal'].T
+        i = n > 0
+        ce = ((n[i] / n.sum()) * (sp[i] / n[i] - sy[i] / n[i]) ** 2).sum().sqrt().item() if i.any() else math.nan
+
+        # Regression calibration errors from "Accurate uncertainties for deep learning using calibrated regression"
+        steps = torch.arange(1, self.cal_bins, dtype=torch.float64) / self.cal_bins
+        err = (s['reg_cdf'] / s['reg_n'][:, None, None] - steps) ** 2  # (nc, 4, steps)
+
+        # Minimum uncertainty errors over entropy thresholds at the bin edges
+        pos, neg = s['mue'].cumsum(2).unbind(-1)  # (2, nc, bins)
+        total_pos, total_neg = pos[..., -1:], neg[..., -1:]
+        u = 0.5 * (total_pos - pos) / total_pos + 0.5 * neg / total_neg
+        u[(pos + neg) == 0] = math.inf  # empty prefixes
+        mue = u.min(-1)[0]
+        mue[mue.isinf()] = math.nan
+        return (nanmean(tp[:, 0]), nanmean(tp[:, 1]), nanmean(tp[:, 2]), nanmean(fp[:, 0]), nanmean(fp[:, 1]), ce,
+                nanmean(err.mean(-1)), nanmean(err.max(-1)[0]), nanmean(mue[0]), nanmean(mue[1]))
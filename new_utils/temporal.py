@@ -0,0 +1,172 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+#Detectron imports
+from detectron2.detectron2.structures import Boxes, Instances, pairwise_iou
+
+
+class ClusterTracker:
+    """
+    Lightweight IoU tracker of output redundancy clusters across the frames of a video.
+
+    Every cluster of the current frame is associated to the track of the previous frames with the highest IoU (same
+    class, above iou_thres). The track statistics are then updated recursively as a two component Gaussian mixture
+    weighted by alpha, so the mean, covariance and class probabilities of a cluster are temporally smoothed instead of
+    being estimated from a single frame. Tracks not seen for more than max_age frames are dropped.
+
+    Smoothing only: the output redundancy clustering still runs in full on every frame and the previous frames are not
+    used to seed or prune it, so the tracker adds the (small) association cost on top of it instead of saving work.
+    """
+
+    def __init__(self, iou_thres=0.5, alpha=0.5, max_age=5):
+        self.iou_thres = iou_thres  # minimum IoU to associate a cluster to a track
+        self.alpha = alpha  # weight of the current frame in the recursive update
+        self.max_age = max_age  # frames a track survives without being associated
+        self.reset()
+
+    def reset(self):
+        # Start a new video
+        self.boxes = torch.zeros((0, 4))  # track means xyxy
+        self.covariances = torch.zeros((0, 4, 4))  # track covariances
+        self.cls_probs = torch.zeros((0, 0))  # track class probability vectors
+        self.classes = torch.zeros(0, dtype=torch.int64)  # track classes
+        self.age = torch.zeros(0, dtype=torch.int64)  # frames since last association
+
+    def associate(self, boxes, classes):
+        # Greedy IoU association, returns the track index of every cluster (-1 for new clusters)
+        matches = torch.full((len(boxes),), -1, dtype=torch.int64)
+        if not len(boxes) or not len(self.boxes):
+            return matches
+        iou = pairwise_iou(Boxes(boxes), Boxes(self.boxes.to(boxes.device))).cpu()
+        iou[classes.cpu()[:, None] != self.classes[None]] = 0  # same class only
+        for _ in range(min(iou.shape)):
+            v, k = iou.view(-1).max(0)
+            if v < self.iou_thres:
+                break
+            i, j = k // iou.shape[1], k % iou.shape[1]
+            matches[i] = j
+            iou[i, :], iou[:, j] = 0, 0  # one to one
+        return matches
+
+    def update(self, instances):
+        """
+        Args:
+            instances (Instances): output redundancy clusters of the current frame.
+
+        Returns:
+            instances (Instances): the same clusters with temporally smoothed boxes, covariances and probabilities.
+        """
+        boxes = instances.pred_boxes.tensor
+        covariances, cls_probs = instances.pred_boxes_covariance, instances.pred_cls_probs
+        device = boxes.device
+        matches = self.associate(boxes, instances.pred_classes)
+        m, j = matches >= 0, matches[matches >= 0]
+        if m.any():
+            a = self.alpha
+            prev_boxes, prev_cov = self.boxes[j].to(device), self.covariances[j].to(device)
+            d = (boxes[m] - prev_boxes).unsqueeze(2)  # mean difference
+            covariances = covariances.clone()
+            covariances[m] = a * covariances[m] + (1 - a) * prev_cov + a * (1 - a) * torch.matmul(d, d.transpose(2, 1))
+            boxes = boxes.clone()
+            boxes[m] = a * boxes[m] + (1 - a) * prev_boxes
+            cls_probs = cls_probs.clone()
+            cls_probs[m] = a * cls_probs[m] + (1 - a) * self.cls_probs[j].to(device)
+
+        # Update tracks: associated and new clusters are refreshed, the rest ages
+        seen = torch.zeros(len(self.boxes), dtype=torch.bool)
+        seen[j.cpu()] = True
+        self.age += 1
+        old = ~seen & (self.age <= self.max_age)
+        self.boxes = torch.cat((self.boxes[old], boxes.detach().cpu()))
+        self.covariances = torch.cat((self.covariances[old], covariances.detach().cpu()))
+        self.cls_probs = torch.cat((self.cls_probs[old].view(-1, cls_probs.shape[1]), cls_probs.detach().cpu()))
+        self.classes = torch.cat((self.classes[old], instances.pred_classes.cpu()))
+        self.age = torch.cat((self.age[old], torch.zeros(len(boxes), dtype=torch.int64)))
+
+        result = Instances(instances.image_size)
+        result.pred_boxes = Boxes(boxes)
+        result.scores, result.pred_classes = cls_probs.max(1)
+        result.pred_cls_probs = cls_probs
+        result.pred_boxes_covariance = covariances
+        if instances.has('anchor_idxs'):
+            result.anchor_idxs = instances.anchor_idxs
+        return result
+
+
+class KeyframeScheduler:
+    """
+    Decides which video frames are keyframes, i.e. run the full model instead of reusing the deep features cached
+    on the last keyframe (see Model.forward_keyframe).
+
+    A frame becomes a keyframe after max_interval frames, when the scene changes (mean absolute difference of a
+    16x16 thumbnail against the keyframe above scene_thres) or when the previous frame came out too uncertain
+    (fraction of uncertain clusters above uncertain_thres).
+    """
+
+    def __init__(self, max_interval=5, scene_thres=0.05, uncertain_thres=0.3):
+        self.max_interval = max_interval  # maximum frames between keyframes
+        self.scene_thres = scene_thres  # thumbnail difference (0-1 pixel range) forcing a keyframe
+        self.uncertain_thres = uncertain_thres  # uncertain cluster fraction forcing a keyframe
+        self.reset()
+
+    def reset(self):
+        # Start a new video
+        self.thumbnail = None  # keyframe thumbnail
+        self.count = 0  # frames since last keyframe
+
+    def __call__(self, im, uncertain_frac=0.0):
+        """
+        Args:
+            im (Tensor): (1,3,h,w) network input in 0-1 range.
+            uncertain_frac (float): fraction of uncertain clusters in the previous frame.
+
+        Returns:
+            keyframe (bool): True if the full model has to run on this frame.
+        """
+        thumbnail = F.adaptive_avg_pool2d(im.float(), 16)
+        keyframe = self.thumbnail is None or self.thumbnail.shape != thumbnail.shape or \
+            self.count >= self.max_interval or uncertain_frac > self.uncertain_thres or \
+            (thumbnail - self.thumbnail).abs().mean() > self.scene_thres
+        if keyframe:
+            self.thumbnail, self.count = thumbnail, 0
+        self.count += 1
+        return bool(keyframe)
+
+
+class MotionGate:
+    """
+    Motion gating of static camera streams: inference only runs when a frame differs from the last inferred frame of
+    the same stream, otherwise the last detections are re-emitted.
+
+    The difference is the mean absolute difference of size-wide grayscale thumbnails (0-1 range). A stream is never
+    skipped more than max_skip frames in a row. While a live stream is static, its loader only decodes every
+    stride-th frame (see LoadStreams.vid_stride).
+    """
+
+    def __init__(self, thres=0.01, max_skip=10, size=64, stride=4):
+        self.thres = thres  # thumbnail difference above which inference runs
+        self.max_skip = max_skip  # maximum consecutive skipped frames per stream
+        self.size = size  # thumbnail width
+        self.stride = stride  # frames grabbed per decoded frame while a live stream is static
+        self.thumbnails, self.skipped = {}, {}  # per stream: last inferred thumbnail, frames skipped since
+
+    def __call__(self, stream, im0):
+        """
+        Args:
+            stream: stream key, i.e. the stream index of a live source or the video path.
+            im0 (ndarray): original BGR frame.
+
+        Returns:
+            infer (bool): True if inference has to run on this frame.
+        """
+        h, w = im0.shape[:2]
+        thumbnail = cv2.resize(cv2.cvtColor(im0, cv2.COLOR_BGR2GRAY), (self.size, max(round(self.size * h / w), 1)),
+                               interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+        last = self.thumbnails.get(stream)
+        if last is None or last.shape != thumbnail.shape or self.skipped[stream] >= self.max_skip or \
+                np.abs(thumbnail - last).mean() > self.thres:
+            self.thumbnails[stream], self.skipped[stream] = thumbnail, 0
+            return True
+        self.skipped[stream] += 1
+        return False
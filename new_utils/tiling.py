@@ -0,0 +1,51 @@
+import torch
+
+from new_utils.multi_resolution import crop_batch, crops_to_original
+
+
+#Tiled inference for images much larger than the network input. Tiles overlap, so an object close to a tile border
+#is seen by more than one tile, and all those predictions become members of the same output redundancy cluster.
+def tile_windows(shape, tile=640, overlap=0.2):
+    """
+    Overlapping tiles covering an image, the last row and column are aligned to the image border.
+
+    Args:
+        shape (tuple): image shape (height, width, ...).
+        tile (int): tile size in image pixels.
+        overlap (float): fraction of the tile shared with the next tile.
+
+    Returns:
+        list of [x1, y1, x2, y2] tiles.
+    """
+    h, w = shape[:2]
+    step = max(int(tile * (1 - overlap)), 1)
+    xs = list(range(0, max(w - tile, 0) + 1, step))
+    ys = list(range(0, max(h - tile, 0) + 1, step))
+    if xs[-1] + tile < w:
+        xs.append(w - tile)
+    if ys[-1] + tile < h:
+        ys.append(h - tile)
+    return [[x, y, min(x + tile, w), min(y + tile, h)] for y in ys for x in xs]
+
+def tiled_inference(model, im0, tile=640, overlap=0.2, batch_size=8, conf_thres=0.01, augment=False):
+    """
+    Run the model on overlapping native resolution tiles of im0, batch_size tiles per forward.
+
+    Only the candidates with objectness above conf_thres are kept from each batch, so memory is bounded by the
+    number of candidates and not by the image size.
+
+    Returns:
+        pred (Tensor): (1,N,85) predictions with xywh boxes in im0 pixels, ready for output redundancy.
+    """
+    windows = tile_windows(im0.shape, tile, overlap)
+    preds = []
+    for i in range(0, len(windows), batch_size):
+        batch_windows = windows[i:i + batch_size]
+        im, gains = crop_batch(im0, batch_windows, 1.0, stride=int(model.stride))
+        im = torch.from_numpy(im).to(model.device)
+        im = (im.half() if model.fp16 else im.float()) / 255  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+        pred = model(im, augment=augment)
+        pred = pred[0] if isinstance(pred, tuple) else pred  # drop top-k candidate indices
+        pred = crops_to_original(pred, batch_windows, gains)[0]
+        preds.append(pred[pred[:, 4] > conf_thres])
+    return torch.cat(preds)[None]
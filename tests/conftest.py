@@ -0,0 +1,15 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+pytest configuration
+
+Usage:
+    $ python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
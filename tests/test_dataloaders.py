@@ -0,0 +1,166 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tests for utils/dataloaders.py
+
+Usage:
+    $ python -m pytest tests/test_dataloaders.py
+"""
+
+import multiprocessing as mp
+import pickle
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from utils.dataloaders import (CompressedImageCache, ImageArena, LoadImages, LoadImagesAndLabels, LoadRectBatches,
+                               ShardedBatchSampler, shared_cache_dir)
+
+
+def random_images(n=5, seed=0):
+    # Random (im, hw_original, hw_resized) images of different shapes, as LoadImagesAndLabels.load_image() returns
+    rng = np.random.default_rng(seed)
+    ims = [rng.integers(0, 256, (*rng.integers(8, 64, 2), 3), dtype=np.uint8) for _ in range(n)]
+    return [(im, (2 * im.shape[0], 2 * im.shape[1]), im.shape[:2]) for im in ims]
+
+
+@pytest.mark.parametrize('n, batch_size, world_size', [(100, 16, 2), (97, 16, 3), (5, 16, 4), (64, 8, 8), (0, 4, 2)])
+def test_sharded_batch_sampler(n, batch_size, world_size):
+    # Every rank gets the whole single-process batches b % world_size == rank, together every index exactly once
+    batches = list(BatchSampler(SequentialSampler(range(n)), batch_size, drop_last=False))
+    seen = []
+    for rank in range(world_size):
+        sampler = ShardedBatchSampler(n, batch_size, rank, world_size)
+        assert len(list(sampler)) == len(sampler)
+        assert list(BatchSampler(sampler, batch_size, drop_last=False)) == batches[rank::world_size]
+        seen += list(sampler)
+    assert sorted(seen) == list(range(n))
+
+
+def test_image_arena(tmp_path):
+    # Built arenas map the images back unchanged, as read-only views, and pickle without the mapped images
+    images, file = random_images(), tmp_path / 'images.arena'
+    arena = ImageArena.build(file, iter(images), len(images))
+    assert len(arena) == len(images) and arena.nbytes == sum(im.nbytes for im, _, _ in images)
+    assert arena.hw0 == [hw0 for _, hw0, _ in images] and arena.hw == [hw for _, _, hw in images]
+    for i, (im, _, _) in enumerate(images):
+        assert np.array_equal(arena[i], im) and not arena[i].flags.writeable
+    x = pickle.loads(pickle.dumps(arena))  # dataloader worker
+    assert x.buffer is None and np.array_equal(x[3], images[3][0])
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['images.arena', 'images.index.npy']
+
+
+def test_shared_cache_dir():
+    # Arenas larger than the free shared memory go to the temporary directory
+    assert shared_cache_dir(1 << 62) == Path(tempfile.gettempdir())
+    assert shared_cache_dir(0) in (Path('/dev/shm'), Path(tempfile.gettempdir()))
+
+
+def test_compressed_image_cache_budget():
+    # Images are admitted first come while they fit within the byte budget and never evicted
+    im = np.zeros((10, 10, 3), dtype=np.uint8)  # 300 bytes
+    cache = CompressedImageCache(5, 1000, fmt='raw', flush=1)
+    for i in range(4):
+        cache.put(i, im + i, (20, 20))
+    assert cache.nbytes == 900 and cache.get(3) is None  # 3 does not fit
+    for i in range(3):
+        x = cache.get(i)
+        assert np.array_equal(x[0], im + i) and x[1] == (20, 20)
+    cache.get(0)[0][:] = 255  # copies, augmentation never writes into the cache
+    assert np.array_equal(cache.get(0)[0], im)
+    cache.put(4, np.zeros((1, 1, 3), dtype=np.uint8), (1, 1))  # fits, but the budget was exhausted
+    assert cache.get(4) is None and list(cache.counts) == [5, 2] and cache.hit_rate == 5 / 7
+    cache.unlink()
+
+
+def test_compressed_image_cache_shared():
+    # Dataloader workers fill one cache, counts are aggregated every `flush` lookups and on worker exit
+    images, cache = random_images(), CompressedImageCache(5, 1E6, flush=4)
+
+    def worker():
+        for i, (im, hw0, _) in enumerate(images):
+            cache.get(i)
+            cache.put(i, im, hw0)
+        for i in range(2):
+            cache.get(i)
+
+    p = mp.get_context('fork').Process(target=worker)
+    p.start()
+    p.join()
+    assert list(cache.counts) == [2, 5]
+    for i, (im, hw0, _) in enumerate(images):
+        x = cache.get(i)
+        assert np.array_equal(x[0], im) and x[1] == hw0
+    assert cache.local == [1, 0] and repr(cache).startswith('58.3% hit rate (7 hits, 5 misses')
+    cache.unlink()
+
+
+def test_compressed_image_cache_png():
+    # Encoded images decode losslessly and are counted by their encoded size
+    im = random_images(1)[0][0]
+    cache = CompressedImageCache(1, 1E6)
+    cache.put(0, im, (1, 1))
+    assert np.array_equal(cache.get(0)[0], im) and cache.nbytes == cache.header[0, 1]
+    cache.unlink()
+
+
+def test_image_arena_failed_build(tmp_path):
+    # A failed build leaves no partial files behind
+    def images():
+        yield from random_images(2)
+        raise OSError('unreadable image')
+
+    with pytest.raises(OSError):
+        ImageArena.build(tmp_path / 'images.arena', images(), 3)
+    assert not any(tmp_path.iterdir())
+
+
+def test_image_arena_hash(tmp_path):
+    # A persistent arena only maps with the hash it was built with, rebuilding replaces it
+    file = tmp_path / 'images.arena'
+    ImageArena.build(file, iter(random_images()), 5, hash='a')
+    assert len(ImageArena(file, 'a')) == 5
+    with pytest.raises(AssertionError, match='stale image arena'):
+        ImageArena(file, 'b')
+    images = random_images(3, seed=1)
+    ImageArena.build(file, iter(images), 3, hash='b')
+    arena = ImageArena(file, 'b')
+    assert len(arena) == 3 and np.array_equal(arena[2], images[2][0])
+    ImageArena.unlink(file)
+    assert not any(tmp_path.iterdir())
+
+
+def test_cache_images_to_arena_rebuild(tmp_path):
+    # Stale arenas are rebuilt, unreadable ones are errors rather than silent rebuilds
+    images = random_images()
+    dataset = SimpleNamespace(im_files=[f'{i}.jpg' for i in range(5)], img_size=64, augment=False, n=5,
+                              load_image=lambda i: images[i])
+    file = tmp_path / 'images.arena'
+    ImageArena.build(file, iter(random_images(seed=1)), 5, hash='stale')
+    arena = LoadImagesAndLabels.cache_images_to_arena(dataset, file)
+    assert all(np.array_equal(arena[i], im) for i, (im, _, _) in enumerate(images))
+    assert len(LoadImagesAndLabels.cache_images_to_arena(dataset, file)) == 5  # mapped, not rebuilt
+    ImageArena.index_file(file).write_bytes(b'truncated')
+    with pytest.raises(pickle.UnpicklingError):
+        LoadImagesAndLabels.cache_images_to_arena(dataset, file)
+
+
+@pytest.mark.parametrize('loader', [LoadImages, LoadRectBatches])
+def test_load_images_pool(tmp_path, loader):
+    # Decode threads run for one pass, stopped when it ends or by close() after a pass that ended early
+    for i, (im, _, _) in enumerate(random_images()):
+        cv2.imwrite(str(tmp_path / f'{i}.png'), im)
+    dataset = loader(tmp_path, img_size=64, workers=2)
+    assert dataset.pool is None
+    paths = [path for path, *_ in dataset]
+    assert len(paths) == 5 and dataset.pool is None
+    next(iter(dataset))
+    assert dataset.pool is not None
+    assert sorted(path for path, *_ in dataset) == sorted(paths) and dataset.pool is None  # restarted pass
+    next(iter(dataset))
+    dataset.close()
+    assert dataset.pool is None
@@ -0,0 +1,95 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tests for utils/general.py
+
+Usage:
+    $ python -m pytest tests/test_general.py
+"""
+
+import pytest
+import torch
+
+from utils.general import box_members, non_max_suppression, xywh2xyxy
+from utils.metrics import box_iou
+
+
+def random_prediction(bs=4, n=500, nc=3, seed=0):
+    # Random (bs, n, 5 + nc) model output, xywh boxes in a 320x320 image
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand(bs, n, 2, generator=g) * 320
+    wh = torch.rand(bs, n, 2, generator=g) * 60 + 4
+    conf = torch.rand(bs, n, 1 + nc, generator=g)
+    return torch.cat((xy, wh, conf), 2)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'agnostic': True}, {'multi_label': True}, {'classes': [0, 2]}, {'max_det': 5},
+                                    {'merge': True}])
+def test_nms_batched_matches_per_image(kwargs):
+    # One batched NMS over the whole batch returns the per-image results
+    pred = random_prediction()
+    out, idx = non_max_suppression(pred, conf_thres=0.1, iou_thres=0.45, return_indices=True, **kwargs)
+    assert len(out) == len(pred)
+    for b in range(len(pred)):
+        out_b, idx_b = non_max_suppression(pred[b:b + 1], conf_thres=0.1, iou_thres=0.45, return_indices=True, **kwargs)
+        assert torch.equal(out[b], out_b[0])
+        assert torch.equal(idx[b], idx_b[0])
+
+
+def test_nms_indices_point_to_anchors():
+    # Kept anchor indices recover the detection boxes from the raw prediction
+    pred = random_prediction()
+    out, idx = non_max_suppression(pred, conf_thres=0.1, return_indices=True)
+    for b, (det, i) in enumerate(zip(out, idx)):
+        assert len(det)
+        assert torch.allclose(det[:, :4], xywh2xyxy(pred[b, i, :4]))
+        assert torch.equal(det[:, 4], det[:, 4].sort(descending=True)[0])  # sorted by decreasing confidence
+
+
+def test_nms_class_groups():
+    # Overlapping boxes only suppress each other within a class, or across classes when agnostic
+    pred = torch.zeros(1, 3, 7)
+    pred[0, :, :4] = torch.tensor([[50, 50, 40, 40], [52, 50, 40, 40], [150, 150, 40, 40]])  # xywh
+    pred[0, :, 4] = torch.tensor([0.9, 0.8, 0.7])  # obj
+    pred[0, :, 5:] = torch.tensor([[1, 0], [0, 1], [1, 0]])  # cls
+    assert len(non_max_suppression(pred)[0]) == 3
+    assert non_max_suppression(pred, agnostic=True)[0][:, 4].tolist() == pytest.approx([0.9, 0.7])
+    pred[0, 1, 5:] = torch.tensor([1, 0])
+    assert len(non_max_suppression(pred)[0]) == 2
+
+
+def test_nms_max_det_per_image():
+    # max_det limits every image separately
+    out = non_max_suppression(random_prediction(bs=3), conf_thres=0.01, max_det=7)
+    assert [len(x) for x in out] == [7, 7, 7]
+
+
+def dense_members(boxes, keep, iou_thres, groups=None):
+    # Reference box_members() from the dense (len(keep), n) IoU matrix
+    m = box_iou(boxes[keep], boxes) > iou_thres
+    if groups is not None:
+        m &= groups[keep, None] == groups[None]
+    return m.nonzero(as_tuple=True)
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 256])
+@pytest.mark.parametrize('grouped', [False, True])
+def test_box_members_matches_dense(chunk, grouped):
+    # Sparse windowed membership equals the dense IoU matrix, pairs sorted by kept box then member
+    g = torch.Generator().manual_seed(1)
+    boxes = xywh2xyxy(torch.cat((torch.rand(400, 2, generator=g) * 320, torch.rand(400, 2, generator=g) * 80 + 2), 1))
+    groups = torch.randint(0, 3, (400,), generator=g) if grouped else None
+    keep = torch.randperm(400, generator=g)[:60]
+    for iou_thres in 0.0, 0.3, 0.7:
+        k, j = box_members(boxes, keep, iou_thres, groups, chunk=chunk)
+        k0, j0 = dense_members(boxes, keep, iou_thres, groups)
+        assert torch.equal(k, k0) and torch.equal(j, j0)
+
+
+def test_box_members_empty():
+    # No boxes or no kept boxes give empty index tensors
+    boxes = torch.tensor([[0.0, 0.0, 10.0, 10.0]])
+    for b, keep in (boxes[:0], []), (boxes, []):
+        k, j = box_members(b, keep, 0.5)
+        assert k.shape == j.shape == (0,)
+    k, j = box_members(boxes, [0], 0.5)  # a box is its own member
+    assert k.tolist() == j.tolist() == [0]
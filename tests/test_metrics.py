@@ -0,0 +1,181 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tests for utils/metrics.py and val.py statistics
+
+Usage:
+    $ python -m pytest tests/test_metrics.py
+"""
+
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+
+from utils.general import xywh2xyxy
+from utils.metrics import ConfusionMatrix, StatsAccumulator, StreamInterp, ap_per_class, box_iou
+from val import process_batch
+
+
+def random_image(g, nc=3, nl=8, nd=20):
+    # Random labels (nl, 5) class, xyxy and detections (nd, 6) xyxy, conf, class sorted by decreasing conf, most of
+    # the detections jittered copies of the labels
+    lb = torch.cat((torch.rand(nl, 2, generator=g) * 200, torch.rand(nl, 2, generator=g) * 40 + 10), 1)
+    labels = torch.cat((torch.randint(0, nc, (nl, 1), generator=g).float(), xywh2xyxy(lb)), 1)
+    i = torch.randint(0, nl, (nd,), generator=g)
+    db = lb[i] + torch.randn(nd, 4, generator=g) * 4
+    db[nd // 2:] = torch.cat((torch.rand(nd - nd // 2, 2, generator=g) * 200, db[nd // 2:, 2:]), 1)  # some random
+    cls = torch.where(torch.rand(nd, generator=g) < 0.8, labels[i, 0], torch.randint(0, nc, (nd,), generator=g).float())
+    conf = torch.rand(nd, generator=g).sort(descending=True)[0]
+    return torch.cat((xywh2xyxy(db), conf[:, None], cls[:, None]), 1), labels
+
+
+def reference_process_batch(detections, labels, iouv):
+    # Per IoU level matching of the original val.process_batch()
+    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
+    iou = box_iou(labels[:, 1:], detections[:, :4])
+    correct_class = labels[:, 0:1] == detections[:, 5]
+    for i in range(len(iouv)):
+        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
+        if x[0].shape[0]:
+            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
+            if x[0].shape[0] > 1:
+                matches = matches[matches[:, 2].argsort()[::-1]]
+                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+            correct[matches[:, 1].astype(int), i] = True
+    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+
+
+def reference_confusion_matrix(matrix, detections, labels, nc, conf=0.25, iou_thres=0.45):
+    # Matching of the original ConfusionMatrix.process_batch(), updates matrix (nc + 1, nc + 1) in place
+    detections = detections[detections[:, 4] > conf]
+    gt_classes = labels[:, 0].int()
+    detection_classes = detections[:, 5].int()
+    iou = box_iou(labels[:, 1:], detections[:, :4])
+    x = torch.where(iou > iou_thres)
+    if x[0].shape[0]:
+        matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
+        if x[0].shape[0] > 1:
+            matches = matches[matches[:, 2].argsort()[::-1]]
+            matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+            matches = matches[matches[:, 2].argsort()[::-1]]
+            matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+    else:
+        matches = np.zeros((0, 3))
+    n = matches.shape[0] > 0
+    m0, m1, _ = matches.transpose().astype(int)
+    for i, gc in enumerate(gt_classes):
+        j = m0 == i
+        if n and sum(j) == 1:
+            matrix[detection_classes[m1[j]], gc] += 1  # correct
+        else:
+            matrix[nc, gc] += 1  # background FP
+    if n:
+        for i, dc in enumerate(detection_classes):
+            if not any(m1 == i):
+                matrix[dc, nc] += 1  # background FN
+
+
+def test_process_batch_matches_reference():
+    # Vectorized matching equals the per IoU level loop, including the first detection per label rule
+    g = torch.Generator().manual_seed(0)
+    iouv = torch.linspace(0.5, 0.95, 10)
+    for _ in range(200):
+        detections, labels = random_image(g, nd=int(torch.randint(0, 30, (1,), generator=g)))
+        assert torch.equal(process_batch(detections, labels, iouv), reference_process_batch(detections, labels, iouv))
+
+
+def test_process_batch_empty():
+    # No labels gives no correct detections
+    detections, _ = random_image(torch.Generator().manual_seed(0))
+    correct = process_batch(detections, torch.zeros((0, 5)), torch.linspace(0.5, 0.95, 10))
+    assert correct.shape == (len(detections), 10) and not correct.any()
+
+
+def test_confusion_matrix_matches_reference():
+    # Device-side scatter-added counts equal the original per label and per detection loops
+    g, nc = torch.Generator().manual_seed(1), 3
+    cm, matrix = ConfusionMatrix(nc), np.zeros((nc + 1, nc + 1))
+    for _ in range(200):
+        detections, labels = random_image(g, nc=nc, nd=int(torch.randint(0, 30, (1,), generator=g)))
+        cm.process_batch(detections, labels)
+        reference_confusion_matrix(matrix, detections, labels, nc)
+    cm.sync()
+    assert np.array_equal(cm.matrix, matrix)
+    tp, fp = cm.tp_fp()
+    assert np.array_equal(tp, matrix.diagonal()[:-1])
+
+
+def random_stats(n=60, nc=4, niou=10, seed=0):
+    # Random val.py (correct, conf, pcls, tcls) per image, correct likelier at high conf and at low IoU thresholds
+    g = torch.Generator().manual_seed(seed)
+    stats = []
+    for _ in range(n):
+        nd, nl = (int(x) for x in torch.randint(0, 40, (2,), generator=g))
+        conf = torch.rand(nd, generator=g)
+        correct = torch.rand(nd, 1, generator=g) < conf[:, None] * torch.linspace(1, 0.2, niou)
+        stats.append((correct, conf, torch.randint(0, nc, (nd,), generator=g).float(),
+                      torch.randint(0, nc, (nl,), generator=g).float()))
+    return stats
+
+
+def accumulate(stats, nc=4, **kwargs):
+    # ap_per_class() results of a StatsAccumulator fed with stats
+    a = StatsAccumulator(nc, **kwargs)
+    for x in stats:
+        a.append(x)
+        a.mark()
+    args, kw, nt = a.result()
+    if 'chunks' in kw:  # small blocks so every class spans several merge steps
+        kw['chunks'] = partial(kw['chunks'], block=7)
+    results = ap_per_class(*args, names={i: str(i) for i in range(nc)}, **kw)
+    a.close()
+    return results, nt
+
+
+@pytest.mark.parametrize('chunk', [50, 400, 10 ** 6])
+def test_stats_disk_matches_list(chunk):
+    # Disk mode merges its sorted runs into exactly the in-memory curves, with one or several runs
+    stats = random_stats()
+    (ref, nt_ref), (x, nt) = accumulate(stats), accumulate(stats, mode='disk', chunk=chunk)
+    assert np.array_equal(nt, nt_ref)
+    for a, b in zip(x, ref):
+        assert np.array_equal(a, b)
+
+
+def test_stats_hist_close_to_list():
+    # Hist mode counts are exact, AP is only binned in confidence
+    stats = random_stats()
+    (ref, nt_ref), (x, nt) = accumulate(stats), accumulate(stats, mode='hist')
+    assert np.array_equal(nt, nt_ref)
+    assert np.array_equal(x[-1], ref[-1])  # classes
+    assert np.abs(x[5] - ref[5]).max() < 0.01  # AP per class and IoU level
+
+
+def test_stats_empty():
+    # No predictions gives no ap_per_class() arguments in every mode
+    for mode in 'list', 'hist', 'disk':
+        a = StatsAccumulator(3, mode=mode)
+        a.append((torch.zeros((0, 10), dtype=torch.bool), torch.zeros(0), torch.zeros(0), torch.tensor([0.0, 2.0])))
+        args, _, nt = a.result()
+        a.close()
+        assert args == ()
+        assert mode == 'list' or list(nt) == [1, 0, 1]
+
+
+@pytest.mark.parametrize('envelope', [False, True])
+def test_stream_interp_matches_np_interp(envelope):
+    # Chunked interpolation equals np.interp() over the whole stream, including repeated xp and out of range queries
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n = int(rng.integers(1, 50))
+        xp = np.sort(rng.choice(rng.random(int(rng.integers(1, n + 1))), n))  # ties
+        fp, x = rng.random(n), rng.random(int(rng.integers(0, 30))) * 1.2 - 0.1
+        x[:len(x) // 4] = rng.choice(xp, len(x) // 4)  # queries on xp points
+        left, right = (None, None) if rng.random() < 0.5 else rng.random(2)
+        s = StreamInterp(x, left=left, right=right, envelope=envelope)
+        for c in np.split(np.arange(n), np.sort(rng.integers(0, n, 3))):
+            s.update(xp[c], fp[c])
+        y = np.flip(np.maximum.accumulate(np.flip(fp))) if envelope else fp
+        assert np.array_equal(s.result(), np.interp(x, xp, y, left=left, right=right))
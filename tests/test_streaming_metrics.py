@@ -0,0 +1,109 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tests for new_utils/streaming_metrics.py against the offline output redundancy evaluation
+
+Usage:
+    $ python -m pytest tests/test_streaming_metrics.py
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from new_utils import scoring_rules
+from new_utils.streaming_metrics import ProbabilisticStats, redundancy_clusters
+from utils.general import non_max_suppression, scale_coords, xywh2xyxy
+from utils.metrics import box_iou
+
+IM_SHAPE = (640, 640)  # network input and original image, no letterbox
+
+
+def random_image(nc=3, seed=0):
+    # Raw (N, 5 + nc) Detect output of one image and its (M, 5) labels: a cluster of anchors around every label, a
+    # cluster of another class on some labels (duplicates), isolated anchors away from the labels (single member false
+    # positives) and low score background anchors
+    g = torch.Generator().manual_seed(seed)
+    lxy, lwh = torch.rand(4, 2, generator=g) * 250 + 40, torch.rand(4, 2, generator=g) * 60 + 30
+    lcls = torch.randint(0, nc, (4,), generator=g)
+    xywh, cls, obj = [], [], []
+    for i in range(4):
+        n = 6 if i else 1  # label 0 is found by a single anchor
+        xywh.append(torch.cat((lxy[i], lwh[i])) + torch.randn(n, 4, generator=g) * 0.4)
+        cls += [lcls[i]] * n
+        obj.append(torch.rand(n, generator=g) * 0.2 + 0.75)
+    for i in range(1, 3):  # duplicates, other class clusters on labels 1 and 2
+        xywh.append(torch.cat((lxy[i] + 2, lwh[i])) + torch.randn(4, 4, generator=g) * 0.4)
+        cls += [(lcls[i] + 1) % nc] * 4
+        obj.append(torch.rand(4, generator=g) * 0.2 + 0.4)
+    xywh.append(torch.cat((torch.rand(3, 2, generator=g) * 150 + 450, torch.full((3, 2), 40.0)), 1))  # singles
+    cls += list(torch.randint(0, nc, (3,), generator=g))
+    obj.append(torch.rand(3, generator=g) * 0.3 + 0.5)
+    xywh, obj = torch.cat(xywh), torch.cat(obj)
+    scores = torch.rand(len(xywh), nc, generator=g) * 0.1
+    scores[torch.arange(len(xywh)), torch.stack(cls)] = torch.rand(len(xywh), generator=g) * 0.1 + 0.85
+    background = torch.cat((torch.rand(50, 2, generator=g) * 600, torch.rand(50, 2, generator=g) * 50 + 10,
+                            torch.rand(50, 1 + nc, generator=g) * 0.1), 1)
+    pred = torch.cat((torch.cat((xywh, obj[:, None], scores), 1), background))
+    labels = torch.cat((lcls[:, None].float(), xywh2xyxy(torch.cat((lxy, lwh), 1))), 1)
+    return pred, labels
+
+
+def offline_matches(means, probs, labels, iou_min=0.1, iou_correct=0.7):
+    # True positive, duplicate and false positive cluster indices as assigned by evaluation_utils.get_matched_results()
+    iou = box_iou(labels[:, 1:], means)
+    score = probs.max(1)[0]
+    tp, dup = [], []
+    for i in range(len(labels)):
+        j = torch.nonzero(iou[i] >= iou_correct)[:, 0]
+        if len(j):
+            j = j[score[j].topk(len(j))[1]]
+            tp.append((i, j[0]))
+            dup += [(i, x) for x in j[1:]]
+    return tp, dup, (iou <= iou_min).all(0)
+
+
+def test_streaming_metrics_match_offline_scoring_rules():
+    # Per class TP/FP NLLs, MSE and entropy equal the offline scoring rules on the same clusters and matches
+    nc = 3
+    pred, labels = random_image(nc)
+    keep = non_max_suppression(pred[None], 0.25, 0.45, max_det=1000, return_indices=True)[1][0]
+    stats = ProbabilisticStats(nc)
+    stats.update(pred, keep, IM_SHAPE, IM_SHAPE, None, labels)
+    sums = stats.stats['sums']
+
+    boxes = scale_coords(IM_SHAPE, xywh2xyxy(pred[:, :4]), IM_SHAPE).round()
+    means, covs, probs = redundancy_clusters(boxes, pred[:, 5:] * pred[:, 4:5], keep[:stats.max_det])
+    tp, dup, fp = offline_matches(means, probs, labels)
+    assert len(tp) == len(labels) and len(dup) and fp.sum() >= 3  # every partition is exercised
+    i, j = (torch.tensor(x) for x in zip(*tp))
+    tcls, (score, pcls) = labels[i, 0].long(), probs.max(1)
+    true_positives = {'predicted_box_means': means[j], 'predicted_box_covariances': covs[j],
+                      'predicted_cls_probs': probs[j], 'predicted_score_of_gt_category': probs[j, tcls],
+                      'gt_box_means': labels[i, 1:]}
+    false_positives = {'predicted_box_means': means[fp], 'predicted_box_covariances': covs[fp],
+                       'predicted_cls_probs': probs[fp], 'predicted_score_of_gt_category': 1 - score[fp]}
+    for c in range(nc):
+        t, f = tcls == c, pcls[fp] == c
+        if t.any():
+            x = [scoring_rules.compute_cls_scores(true_positives, t)['ignorance_score_mean'],
+                 *scoring_rules.compute_reg_scores(true_positives, t).values()]  # NLL, MSE
+            assert np.allclose((sums[c, 1:4] / sums[c, 0]).numpy(), x, rtol=1e-4)
+        if f.any():
+            x = [scoring_rules.compute_cls_scores_fp(false_positives, f)['ignorance_score_mean'],
+                 scoring_rules.compute_reg_scores_fp(false_positives, f)['total_entropy_mean']]
+            assert np.allclose((sums[c, 5:] / sums[c, 4]).numpy(), x, rtol=1e-4)
+    assert sums[:, 0].sum() == len(tp) and sums[:, 4].sum() == fp.sum()
+
+
+def test_redundancy_clusters_match_offline_clusters():
+    # Clusters equal compute_anchor_statistics() followed by probabilistic_detector_postprocessing()
+    anchor_statistics = pytest.importorskip('new_utils.anchor_statistics')  # needs detectron2
+    nc = 3
+    pred, _ = random_image(nc)
+    keep = non_max_suppression(pred[None], 0.25, 0.45, max_det=1000, return_indices=True)[1][0]
+    boxes = scale_coords(IM_SHAPE, xywh2xyxy(pred[:, :4]), IM_SHAPE).round()
+    means, covs, probs = redundancy_clusters(boxes, pred[:, 5:] * pred[:, 4:5], keep[:100])
+    outputs = anchor_statistics.output_redundancy_instances(pred[None], IM_SHAPE, np.zeros((*IM_SHAPE, 3)), 'cpu')
+    assert torch.allclose(outputs.pred_boxes.tensor, means)
+    assert torch.allclose(outputs.pred_boxes_covariance, covs, atol=1e-6)
+    assert torch.allclose(outputs.pred_cls_probs, probs)
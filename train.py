@@ -18,8 +18,10 @@ import os
 import random
 import sys
 import time
+from collections import deque
 from copy import deepcopy
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import numpy as np
@@ -40,6 +42,7 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 import val  # for end-of-epoch mAP
 from models.experimental import attempt_load
 from models.yolo import Model
+from new_utils.streaming_metrics import PROB_KEYS
 from utils.autoanchor import check_anchors
 from utils.autobatch import check_train_batch_size
 from utils.callbacks import Callbacks
@@ -181,7 +184,10 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)  # plot_lr_scheduler(optimizer, scheduler, epochs)
 
     # EMA
-    ema = ModelEMA(model) if RANK in {-1, 0} else None
+    shard_val = opt.shard_val and RANK != -1  # validate on every rank, EMA weights broadcast from rank 0
+    async_val = opt.async_val if RANK in {-1, 0} else 0  # max EMA snapshots validated in the background
+    assert not (opt.async_val and shard_val), '--async-val is not compatible with --shard-val'
+    ema = ModelEMA(model) if RANK in {-1, 0} or shard_val else None
 
     # Resume
     start_epoch, best_fitness = 0, 0.0
@@ -226,6 +232,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                                               hyp=hyp,
                                               augment=True,
                                               cache=None if opt.cache == 'val' else opt.cache,
+                                              cache_gb=opt.cache_gb,
                                               rect=opt.rect,
                                               rank=LOCAL_RANK,
                                               workers=workers,
@@ -237,8 +244,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     nb = len(train_loader)  # number of batches
     assert mlc < nc, f'Label class {mlc} exceeds nc={nc} in {data}. Possible class labels are 0-{nc - 1}'
 
-    # Process 0
-    if RANK in {-1, 0}:
+    # Valloader
+    if RANK in {-1, 0} or shard_val:
         val_loader = create_dataloader(val_path,
                                        imgsz,
                                        batch_size // WORLD_SIZE * 2,
@@ -246,12 +253,16 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                                        single_cls,
                                        hyp=hyp,
                                        cache=None if noval else opt.cache,
+                                       cache_gb=opt.cache_gb,
                                        rect=True,
-                                       rank=-1,
+                                       rank=LOCAL_RANK if shard_val else -1,
                                        workers=workers * 2,
                                        pad=0.5,
-                                       prefix=colorstr('val: '))[0]
+                                       prefix=colorstr('val: '),
+                                       shard=(RANK, WORLD_SIZE) if shard_val else None)[0]
 
+    # Process 0
+    if RANK in {-1, 0}:
         if not resume:
             labels = np.concatenate(dataset.labels, 0)
             # c = torch.tensor(labels[:, 0])  # classes
@@ -292,178 +303,265 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     last_opt_step = -1
     maps = np.zeros(nc)  # mAP per class
     results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, cls)
+    if opt.prob_metrics:
+        results += (0,) * len(PROB_KEYS)  # NLL, calibration errors, MUE
     scheduler.last_epoch = start_epoch - 1  # do not move
     scaler = torch.cuda.amp.GradScaler(enabled=amp)
     stopper, stop = EarlyStopping(patience=opt.patience), False
     compute_loss = ComputeLoss(model)  # init loss class
+    # background validation on a thread, not a process: the EMA snapshot, val_loader and CUDA context are shared
+    # without pickling or a second context, at the cost of competing with training for the GIL and the GPU
+    val_pool, val_jobs, fi = ThreadPool(1) if async_val else None, deque(), 0.0
     callbacks.run('on_train_start')
     LOGGER.info(f'Image sizes {imgsz} train, {imgsz} val\n'
                 f'Using {train_loader.num_workers * WORLD_SIZE} dataloader workers\n'
                 f"Logging results to {colorstr('bold', save_dir)}\n"
                 f'Starting training for {epochs} epochs...')
-    for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
-        callbacks.run('on_train_epoch_start')
-        model.train()
-
-        # Update image weights (optional, single-GPU only)
-        if opt.image_weights:
-            cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-            iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
-            dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-
-        # Update mosaic border (optional)
-        # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
-        # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
-
-        mloss = torch.zeros(3, device=device)  # mean losses
-        if RANK != -1:
-            train_loader.sampler.set_epoch(epoch)
-        pbar = enumerate(train_loader)
-        LOGGER.info(('\n' + '%10s' * 7) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'labels', 'img_size'))
-        if RANK in {-1, 0}:
-            pbar = tqdm(pbar, total=nb, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
-        optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
-            callbacks.run('on_train_batch_start')
-            ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
-
-            # Warmup
-            if ni <= nw:
-                xi = [0, nw]  # x interp
-                # compute_loss.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
-                accumulate = max(1, np.interp(ni, xi, [1, nbs / batch_size]).round())
-                for j, x in enumerate(optimizer.param_groups):
-                    # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                    x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 0 else 0.0, x['initial_lr'] * lf(epoch)])
-                    if 'momentum' in x:
-                        x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
-
-            # Multi-scale
-            if opt.multi_scale:
-                sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
-                sf = sz / max(imgs.shape[2:])  # scale factor
-                if sf != 1:
-                    ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
-                    imgs = nn.functional.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
-
-            # Forward
-            with torch.cuda.amp.autocast(amp):
-                pred = model(imgs)  # forward
-                loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
-                if RANK != -1:
-                    loss *= WORLD_SIZE  # gradient averaged between devices in DDP mode
-                if opt.quad:
-                    loss *= 4.
-
-            # Backward
-            scaler.scale(loss).backward()
-
-            # Optimize
-            if ni - last_opt_step >= accumulate:
-                scaler.step(optimizer)  # optimizer.step
-                scaler.update()
-                optimizer.zero_grad()
-                if ema:
-                    ema.update(model)
-                last_opt_step = ni
-
-            # Log
+    try:
+        for epoch in range(start_epoch, epochs):  # epoch --------------------------------------------------------------
+            callbacks.run('on_train_epoch_start')
+            model.train()
+
+            # Update image weights (optional, single-GPU only)
+            if opt.image_weights:
+                cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
+                iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
+                dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
+
+            # Update mosaic border (optional)
+            # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
+            # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
+
+            mloss = torch.zeros(3, device=device)  # mean losses
+            if RANK != -1:
+                train_loader.sampler.set_epoch(epoch)
+            pbar = enumerate(train_loader)
+            LOGGER.info(('\n' + '%10s' * 7) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'labels', 'img_size'))
             if RANK in {-1, 0}:
-                mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
-                mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
-                pbar.set_description(('%10s' * 2 + '%10.4g' * 5) %
-                                     (f'{epoch}/{epochs - 1}', mem, *mloss, targets.shape[0], imgs.shape[-1]))
-                callbacks.run('on_train_batch_end', ni, model, imgs, targets, paths, plots)
-                if callbacks.stop_training:
-                    return
-            # end batch ------------------------------------------------------------------------------------------------
-
-        # Scheduler
-        lr = [x['lr'] for x in optimizer.param_groups]  # for loggers
-        scheduler.step()
-
-        if RANK in {-1, 0}:
-            # mAP
-            callbacks.run('on_train_epoch_end', epoch=epoch)
-            ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
-            final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
-            if not noval or final_epoch:  # Calculate mAP
-                results, maps, _ = val.run(data_dict,
-                                           batch_size=batch_size // WORLD_SIZE * 2,
-                                           imgsz=imgsz,
-                                           model=ema.ema,
-                                           single_cls=single_cls,
-                                           dataloader=val_loader,
-                                           save_dir=save_dir,
-                                           plots=False,
-                                           callbacks=callbacks,
-                                           compute_loss=compute_loss)
-
-            # Update best mAP
-            fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
-            stop = stopper(epoch=epoch, fitness=fi)  # early stop check
-            if fi > best_fitness:
-                best_fitness = fi
-            log_vals = list(mloss) + list(results) + lr
-            callbacks.run('on_fit_epoch_end', log_vals, epoch, best_fitness, fi)
-
-            # Save model
-            if (not nosave) or (final_epoch and not evolve):  # if save
-                ckpt = {
-                    'epoch': epoch,
-                    'best_fitness': best_fitness,
-                    'model': deepcopy(de_parallel(model)).half(),
-                    'ema': deepcopy(ema.ema).half(),
-                    'updates': ema.updates,
-                    'optimizer': optimizer.state_dict(),
-                    'wandb_id': loggers.wandb.wandb_run.id if loggers.wandb else None,
-                    'date': datetime.now().isoformat()}
-
-                # Save last, best and delete
-                torch.save(ckpt, last)
-                if best_fitness == fi:
-                    torch.save(ckpt, best)
-                if opt.save_period > 0 and epoch % opt.save_period == 0:
-                    torch.save(ckpt, w / f'epoch{epoch}.pt')
-                del ckpt
-                callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
-
-        # EarlyStopping
-        if RANK != -1:  # if DDP training
-            broadcast_list = [stop if RANK == 0 else None]
-            dist.broadcast_object_list(broadcast_list, 0)  # broadcast 'stop' to all ranks
-            if RANK != 0:
-                stop = broadcast_list[0]
-        if stop:
-            break  # must break all DDP ranks
-
-        # end epoch ----------------------------------------------------------------------------------------------------
+                pbar = tqdm(pbar, total=nb, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
+            optimizer.zero_grad()
+            for i, (imgs, targets, paths, _) in pbar:  # batch ---------------------------------------------------------
+                callbacks.run('on_train_batch_start')
+                ni = i + nb * epoch  # number integrated batches (since train start)
+                imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
+
+                # Warmup
+                if ni <= nw:
+                    xi = [0, nw]  # x interp
+                    # compute_loss.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
+                    accumulate = max(1, np.interp(ni, xi, [1, nbs / batch_size]).round())
+                    for j, x in enumerate(optimizer.param_groups):
+                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                        x['lr'] = np.interp(ni, xi,
+                                            [hyp['warmup_bias_lr'] if j == 0 else 0.0, x['initial_lr'] * lf(epoch)])
+                        if 'momentum' in x:
+                            x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+
+                # Multi-scale
+                if opt.multi_scale:
+                    sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
+                    sf = sz / max(imgs.shape[2:])  # scale factor
+                    if sf != 1:
+                        ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (gs-multiple)
+                        imgs = nn.functional.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
+
+                # Forward
+                with torch.cuda.amp.autocast(amp):
+                    pred = model(imgs)  # forward
+                    loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
+                    if RANK != -1:
+                        loss *= WORLD_SIZE  # gradient averaged between devices in DDP mode
+                    if opt.quad:
+                        loss *= 4.
+
+                # Backward
+                scaler.scale(loss).backward()
+
+                # Optimize
+                if ni - last_opt_step >= accumulate:
+                    scaler.step(optimizer)  # optimizer.step
+                    scaler.update()
+                    optimizer.zero_grad()
+                    if ema and RANK in {-1, 0}:
+                        ema.update(model)
+                    last_opt_step = ni
+
+                # Log
+                if RANK in {-1, 0}:
+                    mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
+                    mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
+                    pbar.set_description(('%10s' * 2 + '%10.4g' * 5) %
+                                         (f'{epoch}/{epochs - 1}', mem, *mloss, targets.shape[0], imgs.shape[-1]))
+                    callbacks.run('on_train_batch_end', ni, model, imgs, targets, paths, plots)
+                    if callbacks.stop_training:
+                        return
+                # end batch --------------------------------------------------------------------------------------------
+
+            # Scheduler
+            lr = [x['lr'] for x in optimizer.param_groups]  # for loggers
+            scheduler.step()
+            if dataset.lru is not None and RANK in {-1, 0}:
+                LOGGER.info(f'{colorstr("train: ")}Image cache {dataset.lru}')
+
+            if async_val:
+                # mAP of an EMA snapshot on a background thread while the next epoch trains, reported in epoch order
+                callbacks.run('on_train_epoch_end', epoch=epoch)
+                ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
+                final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
+                snapshot, job = None, None
+                if not noval or final_epoch:
+                    snapshot = deepcopy(ema.ema)
+                    job = val_pool.apply_async(val.run, (data_dict,), {
+                        'batch_size': batch_size // WORLD_SIZE * 2,
+                        'imgsz': imgsz,
+                        'model': snapshot,
+                        'single_cls': single_cls,
+                        'dataloader': val_loader,
+                        'save_dir': save_dir,
+                        'plots': False,
+                        'callbacks': Callbacks(),  # loggers only run on this thread
+                        'compute_loss': compute_loss,
+                        'probabilistic': opt.prob_metrics})
+                val_jobs.append((epoch, list(mloss), lr, snapshot, ema.updates, final_epoch, job))
+
+                # Report finished validations, wait for the oldest beyond --async-val in flight and for all at the end
+                while val_jobs and (val_jobs[0][-1] is None or val_jobs[0][-1].ready() or final_epoch or stop or
+                                    sum(x[-1] is not None for x in val_jobs) > async_val):
+                    e, mloss_e, lr_e, snapshot, updates, final_e, job = val_jobs.popleft()
+                    if job:
+                        results, maps, _ = job.get()
+                    fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+                    stop |= stopper(epoch=e, fitness=fi)  # early stop check
+                    if fi > best_fitness:
+                        best_fitness = fi
+                    callbacks.run('on_fit_epoch_end', mloss_e + list(results) + lr_e, e, best_fitness, fi)
+                    if snapshot is not None and best_fitness == fi and ((not nosave) or (final_e and not evolve)):
+                        torch.save({
+                            'epoch': e,
+                            'best_fitness': best_fitness,
+                            'model': snapshot.half(),  # validated EMA, no optimizer state of that epoch
+                            'updates': updates,
+                            'wandb_id': loggers.wandb.wandb_run.id if loggers.wandb else None,
+                            'date': datetime.now().isoformat()}, best)
+
+                # Save last model now, best model when its validation is reported
+                if (not nosave) or (final_epoch and not evolve):  # if save
+                    ckpt = {
+                        'epoch': epoch,
+                        'best_fitness': best_fitness,
+                        'model': deepcopy(de_parallel(model)).half(),
+                        'ema': deepcopy(ema.ema).half(),
+                        'updates': ema.updates,
+                        'optimizer': optimizer.state_dict(),
+                        'wandb_id': loggers.wandb.wandb_run.id if loggers.wandb else None,
+                        'date': datetime.now().isoformat()}
+                    torch.save(ckpt, last)
+                    if opt.save_period > 0 and epoch % opt.save_period == 0:
+                        torch.save(ckpt, w / f'epoch{epoch}.pt')
+                    del ckpt
+                    callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
+
+            elif RANK in {-1, 0} or shard_val:
+                # mAP
+                callbacks.run('on_train_epoch_end', epoch=epoch)
+                ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
+                final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
+                if shard_val:  # all ranks validate the rank 0 EMA
+                    broadcast_list = [final_epoch]
+                    dist.broadcast_object_list(broadcast_list, 0)
+                    final_epoch = broadcast_list[0]
+                    for x in ema.ema.state_dict().values():
+                        dist.broadcast(x, 0)
+                if not noval or final_epoch:  # Calculate mAP
+                    results, maps, _ = val.run(data_dict,
+                                               batch_size=batch_size // WORLD_SIZE * 2,
+                                               imgsz=imgsz,
+                                               model=ema.ema,
+                                               single_cls=single_cls,
+                                               dataloader=val_loader,
+                                               save_dir=save_dir,
+                                               plots=False,
+                                               callbacks=callbacks,
+                                               compute_loss=compute_loss,
+                                               shard=shard_val,
+                                               probabilistic=opt.prob_metrics)
+
+            if RANK in {-1, 0} and not async_val:
+                # Update best mAP
+                fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+                stop = stopper(epoch=epoch, fitness=fi)  # early stop check
+                if fi > best_fitness:
+                    best_fitness = fi
+                log_vals = list(mloss) + list(results) + lr
+                callbacks.run('on_fit_epoch_end', log_vals, epoch, best_fitness, fi)
+
+                # Save model
+                if (not nosave) or (final_epoch and not evolve):  # if save
+                    ckpt = {
+                        'epoch': epoch,
+                        'best_fitness': best_fitness,
+                        'model': deepcopy(de_parallel(model)).half(),
+                        'ema': deepcopy(ema.ema).half(),
+                        'updates': ema.updates,
+                        'optimizer': optimizer.state_dict(),
+                        'wandb_id': loggers.wandb.wandb_run.id if loggers.wandb else None,
+                        'date': datetime.now().isoformat()}
+
+                    # Save last, best and delete
+                    torch.save(ckpt, last)
+                    if best_fitness == fi:
+                        torch.save(ckpt, best)
+                    if opt.save_period > 0 and epoch % opt.save_period == 0:
+                        torch.save(ckpt, w / f'epoch{epoch}.pt')
+                    del ckpt
+                    callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
+
+            # EarlyStopping
+            if RANK != -1:  # if DDP training
+                broadcast_list = [stop if RANK == 0 else None]
+                dist.broadcast_object_list(broadcast_list, 0)  # broadcast 'stop' to all ranks
+                if RANK != 0:
+                    stop = broadcast_list[0]
+            if stop:
+                break  # must break all DDP ranks
+
+            # end epoch ------------------------------------------------------------------------------------------------
+    finally:  # finish background validations still in flight before the final validation or return
+        for *_, job in val_jobs:
+            if job:
+                job.wait()
+        if val_pool:
+            val_pool.close()
+            val_pool.join()
     # end training -----------------------------------------------------------------------------------------------------
     if RANK in {-1, 0}:
         LOGGER.info(f'\n{epoch - start_epoch + 1} epochs completed in {(time.time() - t0) / 3600:.3f} hours.')
         for f in last, best:
             if f.exists():
                 strip_optimizer(f)  # strip optimizers
-                if f is best:
-                    LOGGER.info(f'\nValidating {f}...')
-                    results, _, _ = val.run(
-                        data_dict,
-                        batch_size=batch_size // WORLD_SIZE * 2,
-                        imgsz=imgsz,
-                        model=attempt_load(f, device).half(),
-                        iou_thres=0.65 if is_coco else 0.60,  # best pycocotools results at 0.65
-                        single_cls=single_cls,
-                        dataloader=val_loader,
-                        save_dir=save_dir,
-                        save_json=is_coco,
-                        verbose=True,
-                        plots=plots,
-                        callbacks=callbacks,
-                        compute_loss=compute_loss)  # val best model with plots
-                    if is_coco:
-                        callbacks.run('on_fit_epoch_end', list(mloss) + list(results) + lr, epoch, best_fitness, fi)
-
+    if shard_val:
+        dist.barrier()  # stripped best.pt ready for all ranks
+    if (RANK in {-1, 0} or shard_val) and best.exists():
+        LOGGER.info(f'\nValidating {best}...')
+        results, _, _ = val.run(
+            data_dict,
+            batch_size=batch_size // WORLD_SIZE * 2,
+            imgsz=imgsz,
+            model=attempt_load(best, device).half(),
+            iou_thres=0.65 if is_coco else 0.60,  # best pycocotools results at 0.65
+            single_cls=single_cls,
+            dataloader=val_loader,
+            save_dir=save_dir,
+            save_json=is_coco,
+            verbose=True,
+            plots=plots,
+            callbacks=callbacks,
+            compute_loss=compute_loss,
+            shard=shard_val,
+            probabilistic=opt.prob_metrics)  # val best model with plots
+        if is_coco and RANK in {-1, 0}:
+            callbacks.run('on_fit_epoch_end', list(mloss) + list(results) + lr, epoch, best_fitness, fi)
+    if RANK in {-1, 0}:
         callbacks.run('on_train_end', last, best, plots, epoch, results)
 
     torch.cuda.empty_cache()
@@ -487,13 +585,18 @@ def parse_opt(known=False):
     parser.add_argument('--noplots', action='store_true', help='save no plot files')
     parser.add_argument('--evolve', type=int, nargs='?', const=300, help='evolve hyperparameters for x generations')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='--cache images in "ram" (default) or "disk"')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram',
+                        help='--cache images in "ram" (default), "disk" or "lru"')
+    parser.add_argument('--cache-gb', type=float, default=4.0, help='--cache lru image budget (GB) shared by workers')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
     parser.add_argument('--single-cls', action='store_true', help='train multi-class data as single-class')
     parser.add_argument('--optimizer', type=str, choices=['SGD', 'Adam', 'AdamW'], default='SGD', help='optimizer')
     parser.add_argument('--sync-bn', action='store_true', help='use SyncBatchNorm, only available in DDP mode')
+    parser.add_argument('--shard-val', action='store_true', help='validate on all DDP ranks, only in DDP mode')
+    parser.add_argument('--prob-metrics', action='store_true', help='log output redundancy NLL, calibration, MUE')
+    parser.add_argument('--async-val', type=int, default=0, help='validate EMA snapshots in the background, max N')
     parser.add_argument('--workers', type=int, default=8, help='max dataloader workers (per RANK in DDP mode)')
     parser.add_argument('--project', default=ROOT / 'runs/train', help='save to project/name')
     parser.add_argument('--name', default='exp', help='save to project/name')
@@ -644,7 +747,7 @@ def main(opt, callbacks=Callbacks()):
             results = train(hyp.copy(), opt, device, callbacks)
             callbacks = Callbacks()
             # Write mutation results
-            print_mutation(results, hyp.copy(), save_dir, opt.bucket)
+            print_mutation(results[:7], hyp.copy(), save_dir, opt.bucket)
 
         # Plot results
         plot_evolve(evolve_csv)
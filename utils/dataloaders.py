@@ -3,18 +3,23 @@
 Dataloaders and dataset utils
 """
 
+import atexit
 import glob
 import hashlib
 import json
 import math
+import multiprocessing as mp
 import os
 import random
 import shutil
+import tempfile
 import time
+from collections import defaultdict, deque
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
+from multiprocessing.util import Finalize
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
@@ -91,6 +96,25 @@ def exif_transpose(image):
     return image
 
 
+def imread_reduced(path, img_size=640):
+    # Read image, decoding JPEGs straight to 1/2, 1/4 or 1/8 scale while the result still covers img_size (long side or
+    # (h, w) letterbox shape). Returns BGR image and original hw, (None, None) if the image can not be read
+    if path.split('.')[-1].lower() in ('jpg', 'jpeg'):
+        try:
+            with Image.open(path) as im:
+                w0, h0 = exif_size(im)  # header only
+        except Exception:
+            w0 = h0 = 0
+        if w0 and h0:
+            s = img_size if isinstance(img_size, (list, tuple)) else (img_size, img_size)
+            r = min(s[0] / h0, s[1] / w0)  # resize ratio (new / old)
+            for f in 8, 4, 2:  # decode scale factor
+                if f * r <= 1:
+                    return cv2.imread(path, getattr(cv2, f'IMREAD_REDUCED_COLOR_{f}')), (h0, w0)
+    im = cv2.imread(path)  # BGR
+    return (im, im.shape[:2]) if im is not None else (None, None)
+
+
 def create_dataloader(path,
                       imgsz,
                       batch_size,
@@ -99,6 +123,7 @@ def create_dataloader(path,
                       hyp=None,
                       augment=False,
                       cache=False,
+                      cache_gb=4.0,
                       pad=0.0,
                       rect=False,
                       rank=-1,
@@ -106,7 +131,8 @@ def create_dataloader(path,
                       image_weights=False,
                       quad=False,
                       prefix='',
-                      shuffle=False):
+                      shuffle=False,
+                      shard=None):
     if rect and shuffle:
         LOGGER.warning('WARNING: --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -119,6 +145,7 @@ def create_dataloader(path,
             hyp=hyp,  # hyperparameters
             rect=rect,  # rectangular batches
             cache_images=cache,
+            cache_gb=cache_gb,
             single_cls=single_cls,
             stride=int(stride),
             pad=pad,
@@ -128,7 +155,10 @@ def create_dataloader(path,
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
     nw = min([os.cpu_count() // max(nd, 1), batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
+    if shard:  # (rank, world_size) validation shard of whole batches
+        sampler = ShardedBatchSampler(len(dataset), batch_size, *shard)
+    else:
+        sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
     loader = DataLoader if image_weights else InfiniteDataLoader  # only DataLoader allows for attribute updates
     return loader(dataset,
                   batch_size=batch_size,
@@ -139,6 +169,25 @@ def create_dataloader(path,
                   collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn), dataset
 
 
+class ShardedBatchSampler(torch.utils.data.Sampler):
+    """ Sampler that assigns whole batches b = rank, rank + world_size, ... of an unshuffled dataset to a rank
+
+    Every rank sees exactly the batches (and rect batch shapes) of a single-process run, so merged statistics are
+    identical to it
+    """
+
+    def __init__(self, n, batch_size, rank, world_size):
+        self.n, self.batch_size, self.rank, self.world_size = n, batch_size, rank, world_size
+
+    def __iter__(self):
+        for b in range(self.rank, math.ceil(self.n / self.batch_size), self.world_size):
+            yield from range(b * self.batch_size, min((b + 1) * self.batch_size, self.n))
+
+    def __len__(self):
+        return sum(min(self.batch_size, self.n - b * self.batch_size)
+                   for b in range(self.rank, math.ceil(self.n / self.batch_size), self.world_size))
+
+
 class InfiniteDataLoader(dataloader.DataLoader):
     """ Dataloader that reuses workers
 
@@ -175,7 +224,25 @@ class _RepeatSampler:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, test_time_augmentation=False):
+    def __init__(self, path, img_size=640, stride=32, auto=True, test_time_augmentation=False, workers=0, prefetch=8,
+                 lazy=False, reduced_decode=False, vid_stride=1, vid_start=0.0, vid_end=None):
+        self.img_size = img_size
+        self.stride = stride
+        self.mode = 'image'
+        self.auto = auto
+        self.test_time_augmentation = test_time_augmentation
+        self.path = path
+        self.lazy = lazy  # stream file enumeration instead of listing and sorting upfront
+        self.reduced_decode = reduced_decode  # decode JPEGs at reduced scale, im0 is then the reduced image
+        self.vid_stride = max(vid_stride, 1)  # video: decode every vid_stride-th frame, skipped frames are only grabbed
+        self.vid_start, self.vid_end = vid_start, vid_end  # video: time range (s) to decode, vid_end None for all
+        self.prefetch = max(prefetch, 1)  # images decoded ahead of the consumer
+        self.workers, self.pool = workers, None  # image decode and letterbox threads, started for every pass
+        self.cap, self.cap_path = None, None
+        if lazy:  # files in enumeration order, images and videos interleaved, number of files unknown
+            self.files, self.video_flag, self.nf = None, None, None
+            return
+
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
@@ -192,73 +259,203 @@ class LoadImages:
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
         ni, nv = len(images), len(videos)
 
-        self.img_size = img_size
-        self.stride = stride
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
-        self.mode = 'image'
-        self.auto = auto
 
-        self.test_time_augmentation = test_time_augmentation
         if any(videos):
             self.new_video(videos[0])  # new video
-        else:
-            self.cap = None
         assert self.nf > 0, f'No images or videos found in {p}. ' \
                             f'Supported formats are:\nimages: {IMG_FORMATS}\nvideos: {VID_FORMATS}'
 
+    def scan(self):
+        # Lazily enumerate (file, is_video), directories are streamed with os.scandir in directory order
+        for p in self.path if isinstance(self.path, (list, tuple)) else [self.path]:
+            p = str(Path(p).resolve())
+            if '*' in p:
+                files = glob.iglob(p, recursive=True)  # glob
+            elif os.path.isdir(p):
+                files = (x.path for x in os.scandir(p) if x.is_file())  # dir
+            elif os.path.isfile(p):
+                files = [p]  # files
+            else:
+                raise FileNotFoundError(f'{p} does not exist')
+            for f in files:
+                suffix = f.split('.')[-1].lower()
+                if suffix in IMG_FORMATS or suffix in VID_FORMATS:
+                    yield f, suffix in VID_FORMATS
+
     def __iter__(self):
         self.count = 0
+        self.start_pool()
+        self.sources = self.scan() if self.lazy else zip(self.files, self.video_flag)
+        self.queue = deque()  # (path, is_video, pending image decode)
+        self.fill()
         return self
 
-    def __next__(self):
-        if self.count == self.nf:
-            raise StopIteration
-        path = self.files[self.count]
+    def fill(self):
+        # Keep `prefetch` files queued, images start decoding in the thread pool as soon as they are queued
+        while len(self.queue) < self.prefetch:
+            source = next(self.sources, None)
+            if source is None:
+                break
+            path, video = source
+            self.queue.append((path, video, None if video or not self.pool else self.pool.apply_async(self.load,
+                                                                                                       (path,))))
+
+    def load(self, path):
+        # Read image and letterbox it
+        img0 = imread_reduced(path, self.img_size)[0] if self.reduced_decode else cv2.imread(path)  # BGR
+        assert img0 is not None, f'Image Not Found {path}'
+        return self.letterbox(img0), img0
+
+    def letterbox(self, img0):
+        if self.test_time_augmentation:
+            return torch.tensor([])
 
-        if self.video_flag[self.count]:
-            # Read video
-            self.mode = 'video'
-            ret_val, img0 = self.cap.read()
-            while not ret_val:
-                self.count += 1
-                self.cap.release()
-                if self.count == self.nf:  # last video
-                    raise StopIteration
-                path = self.files[self.count]
-                self.new_video(path)
-                ret_val, img0 = self.cap.read()
-
-            self.frame += 1
-            s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
-
-        else:
-            # Read image
-            self.count += 1
-            img0 = cv2.imread(path)  # BGR
-            assert img0 is not None, f'Image Not Found {path}'
-            s = f'image {self.count}/{self.nf} {path}: '
-        
-        img = torch.tensor([])
+        # Padded resize
+        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
 
-        if not self.test_time_augmentation:
-            # Padded resize
-            img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+        # Convert
+        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(img)
 
-            # Convert
-            img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-            img = np.ascontiguousarray(img)
+    def __next__(self):
+        nf = self.nf or '?'
+        while self.queue:
+            path, video, pending = self.queue[0]
+            if video:
+                # Read video
+                self.mode = 'video'
+                if self.cap_path != path:
+                    self.new_video(path)
+                img0 = self.read_frame()
+                if img0 is None:  # next file
+                    self.count += 1
+                    self.cap.release()
+                    self.cap_path = None
+                    self.queue.popleft()
+                    self.fill()
+                    continue
+
+                s = f'video {self.count + 1}/{nf} ({self.frame}/{self.frames}) {path}: '
+                img = self.letterbox(img0)
 
-        return path, img, img0, self.cap, s
+            else:
+                # Read image
+                self.mode = 'image'
+                self.count += 1
+                self.queue.popleft()
+                self.fill()
+                img, img0 = pending.get() if pending else self.load(path)
+                s = f'image {self.count}/{nf} {path}: '
+
+            return path, img, img0, self.cap, s
+        self.close()
+        raise StopIteration
+
+    def start_pool(self):
+        self.close()
+        self.pool = ThreadPool(self.workers) if self.workers else None
+
+    def close(self):
+        # Stops the decode threads, images still being prefetched by a pass that ended early are dropped
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+    def read_frame(self):
+        # Advance to the next frame to decode with grab() (demux only, no decode) and decode it, None at end of range
+        while self.frame < self.next:
+            if not self.cap.grab():
+                return None
+            self.frame += 1
+        if self.frame >= self.end:
+            return None
+        ret_val, img0 = self.cap.read()
+        if not ret_val:
+            return None
+        self.frame += 1  # frame number of img0, counted from the start of the video
+        self.next += self.vid_stride
+        return img0
 
     def new_video(self, path):
-        self.frame = 0
+        self.frame = 0  # frames consumed
         self.cap = cv2.VideoCapture(path)
+        self.cap_path = path
         self.frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = self.cap.get(cv2.CAP_PROP_FPS) % 100 or 30  # 30 FPS fallback
+        self.next = round(self.vid_start * fps)  # first frame to decode
+        self.end = min(math.ceil(self.vid_end * fps), self.frames or math.inf) if self.vid_end else math.inf
+        if self.next and self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.next) and \
+                self.cap.get(cv2.CAP_PROP_POS_FRAMES) == self.next:  # seek if the container allows it, else grab()
+            self.frame = self.next
+        elif self.next:
+            self.cap.release()
+            self.cap = cv2.VideoCapture(path)
 
     def __len__(self):
-        return self.nf  # number of files
+        return self.nf if self.nf is not None else self.count  # number of files
+
+
+class LoadRectBatches(LoadImages):
+    # YOLOv5 rectangular batch inference dataloader, i.e. `python detect.py --source images/ --rect-batch 16`
+    # Images are sorted by aspect ratio and letterboxed to the minimal stride-multiple shape of their batch. Images are
+    # still yielded one at a time, with the stacked batch in self.batch and the image position in it in self.batch_i
+    def __init__(self, path, img_size=640, stride=32, batch_size=16, pad=0.0, workers=0):
+        super().__init__(path, img_size, stride, auto=False, workers=workers)
+        assert not any(self.video_flag), 'rect batch inference supports image sources only'
+        self.batch_size = batch_size
+        s = []
+        for f in self.files:
+            with Image.open(f) as im:
+                s.append(exif_size(im))  # header only
+        s = np.array(s, dtype=np.float64)  # wh
+        ar = s[:, 1] / s[:, 0]  # aspect ratio
+        self.order = ar.argsort()  # file indices in inference order
+        ar = ar[self.order]
+
+        # Set batch shapes
+        nb = math.ceil(self.nf / batch_size)  # number of batches
+        shapes = [[1, 1]] * nb
+        for i in range(nb):
+            ari = ar[i * batch_size:(i + 1) * batch_size]
+            mini, maxi = ari.min(), ari.max()
+            if maxi < 1:
+                shapes[i] = [maxi, 1]
+            elif mini > 1:
+                shapes[i] = [1, 1 / mini]
+        img_size = max(img_size) if isinstance(img_size, (list, tuple)) else img_size
+        self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
+
+    def __iter__(self):
+        self.n = 0  # images yielded
+        self.start_pool()
+        return self
+
+    def __next__(self):
+        if self.n == self.nf:
+            self.close()
+            raise StopIteration
+        b, self.batch_i = divmod(self.n, self.batch_size)
+        if self.batch_i == 0:  # read and letterbox the next batch
+            files = [self.files[j] for j in self.order[b * self.batch_size:(b + 1) * self.batch_size]]
+            self.im0s = self.pool.map(cv2.imread, files) if self.pool else [cv2.imread(f) for f in files]  # BGR
+            for f, im0 in zip(files, self.im0s):
+                assert im0 is not None, f'Image Not Found {f}'
+            shape = tuple(self.batch_shapes[b])
+            ims = [letterbox(im0, shape, stride=self.stride, auto=False)[0] for im0 in self.im0s]
+            self.batch = np.ascontiguousarray(np.stack(ims).transpose((0, 3, 1, 2))[:, ::-1])  # BHWC to BCHW, BGR to RGB
+
+        j = self.order[self.n]
+        self.n += 1
+        self.count = j + 1  # file index as in LoadImages, i.e. for image ids
+        path = self.files[j]
+        return path, self.batch[self.batch_i], self.im0s[self.batch_i], None, f'image {self.n}/{self.nf} {path}: '
 
 
 class LoadWebcam:  # for inference
@@ -319,6 +516,8 @@ class LoadStreams:
         n = len(sources)
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.stream_ids = list(range(n))  # stream index of every frame of the last batch
+        self.vid_stride = [1] * n  # per stream, decode every vid_stride-th frame (others are grabbed only)
         self.auto = auto
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
@@ -353,12 +552,12 @@ class LoadStreams:
 
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
-        n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
+        n, f = 0, self.frames[i]  # frame number, frame array
         while cap.isOpened() and n < f:
             n += 1
             # _, self.imgs[index] = cap.read()
             cap.grab()
-            if n % read == 0:
+            if n % self.vid_stride[i] == 0:  # decode every 'vid_stride' frame
                 success, im = cap.retrieve()
                 if success:
                     self.imgs[i] = im
@@ -395,12 +594,274 @@ class LoadStreams:
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class StreamScheduler(LoadStreams):
+    # YOLOv5 multi-stream loader with per-stream ring buffers and deadline-aware batching of same-shape frames
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, buffer=4, batch_size=8, deadline=0.05,
+                 drop_oldest=True):
+        self.buffer = buffer  # ring buffer size per stream
+        self.batch_size = batch_size  # maximum frames per batch
+        self.deadline = deadline  # maximum wait (s) after the oldest pending frame was captured before batching
+        self.drop_oldest = drop_oldest  # drop policy on full buffer, oldest frame or incoming frame
+        self.cond = Condition()  # guards queues and statistics
+        self.queues = defaultdict(deque)  # per stream (capture time, im, im0)
+        self.read, self.dropped = defaultdict(int), defaultdict(int)  # per stream frames read, frames dropped
+        self.latency = defaultdict(lambda: deque(maxlen=1000))  # per stream capture to next-batch latencies (s)
+        self.pending = []  # (stream, capture time) of the last batch
+        super().__init__(sources, img_size, stride, auto)
+
+    def update(self, i, cap, stream):
+        # Read stream `i` frames in daemon thread into its ring buffer
+        self.put(i, self.imgs[i])  # first frame read on init
+        n, f = 1, self.frames[i]  # frame number, frames
+        while cap.isOpened() and n < f:
+            n += 1
+            if n % self.vid_stride[i]:  # grab only, decode every 'vid_stride' frame
+                cap.grab()
+                continue
+            success, im0 = cap.read()
+            if success:
+                self.put(i, im0)
+            else:
+                LOGGER.warning('WARNING: Video stream unresponsive, please check your IP camera connection.')
+                cap.open(stream)  # re-open stream if signal was lost
+
+    def put(self, i, im0):
+        # Letterbox frame in the reader thread and push it to stream `i` ring buffer following the drop policy
+        t = time.time()
+        im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]
+        im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+        with self.cond:
+            q = self.queues[i]
+            self.read[i] += 1
+            if len(q) >= self.buffer:
+                self.dropped[i] += 1
+                if not self.drop_oldest:
+                    return
+                q.popleft()
+            q.append((t, im, im0))
+            self.cond.notify()
+
+    def _candidates(self, shape):
+        # Pending frames with batch shape, oldest first, at the front of every stream buffer
+        c = []
+        for i, q in self.queues.items():
+            for t, im, _ in q:
+                if im.shape != shape:
+                    break
+                c.append((t, i))
+        return sorted(c)[:self.batch_size]
+
+    def __next__(self):
+        self.count += 1
+        now = time.time()
+        with self.cond:
+            for t, i in self.pending:  # previous batch is done
+                self.latency[i].append(now - t)
+            while not any(self.queues.values()):
+                if not any(x.is_alive() for x in self.threads):
+                    raise StopIteration
+                self.cond.wait(0.1)
+
+            # Oldest pending frame sets batch shape and deadline
+            t0, i0 = min((q[0][0], i) for i, q in self.queues.items() if q)
+            shape = self.queues[i0][0][1].shape
+            while len(self._candidates(shape)) < self.batch_size and time.time() < t0 + self.deadline:
+                self.cond.wait(t0 + self.deadline - time.time())
+            self.pending = self._candidates(shape)
+            frames = [self.queues[i].popleft() for _, i in self.pending]
+
+        self.stream_ids = [i for _, i in self.pending]
+        sources = [self.sources[i] for i in self.stream_ids]
+        img = np.stack([x[1] for x in frames], 0)
+        img0 = [x[2] for x in frames]
+        return sources, img, img0, None, ''
+
+    def stats(self):
+        # Per stream frames read, frames dropped and p50/p99 latency (s) from capture to batch completion
+        with self.cond:
+            return {
+                s: (self.read[i], self.dropped[i], *(np.percentile(self.latency[i], (50, 99)).tolist()
+                                                     if self.latency[i] else (0.0, 0.0)))
+                for i, s in enumerate(self.sources)}
+
+    def __len__(self):
+        return max(self.batch_size, len(self.sources))  # maximum batch size
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = f'{os.sep}images{os.sep}', f'{os.sep}labels{os.sep}'  # /images/, /labels/ substrings
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+def shared_cache_dir(nbytes):
+    # /dev/shm (shared memory) if it has room for nbytes, else the temporary directory (page cache backed file)
+    shm = Path('/dev/shm')
+    if os.access(shm, os.W_OK) and shutil.disk_usage(shm).free > 1.1 * nbytes:  # 10% margin
+        return shm
+    return Path(tempfile.gettempdir())
+
+
+class ImageArena:
+    """ Resized images of a dataset packed into one contiguous uint8 file with an (offset, shape) index
+
+    The file is memory-mapped read-only, so every DDP rank and dataloader worker on a host reads the same page cache
+    pages instead of holding its own copy of each image. Indexing returns zero-copy (h, w, c) views. The index stores a
+    hash of the image files and resizing, so a persistent arena (--cache disk) is rebuilt when the dataset changes
+    """
+
+    def __init__(self, file, hash=None):
+        self.file = Path(file)
+        x = np.load(self.index_file(self.file), allow_pickle=True).item()  # load dict
+        assert hash is None or x['hash'] == hash, 'stale image arena'  # identical images, order and resizing
+        assert self.file.exists(), 'missing image arena'
+        index = x['index']  # (n, 6) offset, h, w, c, h0, w0
+        self.offsets, self.shapes = index[:, 0], index[:, 1:4]
+        self.hw0 = [tuple(x) for x in index[:, 4:6].tolist()]  # original hw
+        self.hw = [tuple(x) for x in index[:, 1:3].tolist()]  # resized hw
+        self.buffer = None  # mapped on first access, also after unpickling in spawned workers
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if self.buffer is None:
+            self.buffer = np.memmap(self.file, dtype=np.uint8, mode='r')
+        o, s = self.offsets[i], self.shapes[i]
+        return self.buffer[o:o + s.prod()].reshape(s)
+
+    def __getstate__(self):
+        return {**self.__dict__, 'buffer': None}  # pickle the index only, never the mapped images
+
+    @property
+    def nbytes(self):
+        return self.file.stat().st_size
+
+    @staticmethod
+    def index_file(file):
+        return file.with_suffix('.index.npy')
+
+    @staticmethod
+    def build(file, images, n, hash='', desc=None):
+        # Writes n (im, hw_original, hw_resized) images in order, then renames the file and its index into place
+        file, index = Path(file), np.zeros((n, 6), dtype=np.int64)
+        tmp = file.with_suffix(f'.{os.getpid()}.tmp')  # concurrent builders never share a partial file
+        try:
+            with open(tmp, 'wb') as f:
+                for i, (im, hw0, _) in enumerate(images):
+                    index[i] = f.tell(), *im.shape, *hw0
+                    f.write(np.ascontiguousarray(im).data)
+                    if desc:  # tqdm images, desc format with the GB written
+                        images.desc = desc.format(f.tell() / 1E9)
+            with open(tmp.with_suffix('.index.tmp'), 'wb') as f:
+                np.save(f, {'hash': hash, 'index': index})
+            ImageArena.unlink(file)  # replace a stale arena
+            tmp.rename(file)
+            tmp.with_suffix('.index.tmp').rename(ImageArena.index_file(file))  # index last, marks the arena complete
+        finally:
+            for f in tmp, tmp.with_suffix('.index.tmp'):
+                f.unlink(missing_ok=True)  # partial files of a failed build
+        return ImageArena(file)
+
+    @staticmethod
+    def unlink(file):
+        for f in file, ImageArena.index_file(file):
+            f.unlink(missing_ok=True)  # existing mappings stay valid
+
+
+class CompressedImageCache:
+    """ Cache of resized images stored encoded (lossless PNG by default) within a byte budget, shared by all processes
+
+    Entries live in one memory-mapped file (/dev/shm if it has room) with an (n, 7) header of offset, nbytes, h, w, c,
+    h0, w0 per image followed by the budget-sized data region, so the main process and every dataloader worker read
+    and fill the same cache. Images are admitted first come while the budget lasts and never evicted: the cache settles
+    on a fixed subset after the first epoch, and with shuffled sampling the expected hit rate is
+    min(1, budget / encoded dataset size) independent of the number of workers. Hits and misses are counted per
+    process and added to the shared counts every `flush` lookups and when a worker exits
+    """
+
+    def __init__(self, n, budget, fmt='.png', flush=256):
+        self.n, self.budget, self.fmt, self.flush = n, int(budget), fmt, flush  # fmt cv2.imencode() ext or 'raw'
+        self.params = [cv2.IMWRITE_PNG_COMPRESSION, 1] if fmt == '.png' else []  # fast encode, decode dominates
+        self.used = mp.Value('q', 0)  # allocated data bytes, its lock guards allocation and counts
+        self.counts = mp.Array('q', 2, lock=False)  # shared hits, misses
+        self.local, self.full, self.pid = [0, 0], False, os.getpid()  # per process unflushed hits, misses, full budget
+        fd, self.file = tempfile.mkstemp('.cache', 'yolov5_lru_', shared_cache_dir(self.budget))
+        os.ftruncate(fd, n * 56 + self.budget or 1)  # sparse, pages are only allocated when written
+        os.close(fd)
+        self.header = self.data = None  # mapped on first access in every process
+        atexit.register(self.unlink)  # only runs in the main process, workers exit without atexit handlers
+
+    def _map(self):
+        if self.pid != os.getpid():  # first access in a worker, counts its own lookups and adds the rest on exit
+            self.local, self.full, self.pid = [0, 0], False, os.getpid()
+            Finalize(self, self.aggregate, exitpriority=10)
+        if self.header is None:
+            buffer = np.memmap(self.file, dtype=np.uint8, mode='r+')
+            self.header = buffer[:self.n * 56].view(np.int64).reshape(self.n, 7)  # nbytes 0 empty, -1 being written
+            self.data = buffer[self.n * 56:]
+
+    def get(self, i):
+        # Returns (im, hw_original) of image i, or None
+        self._map()
+        o, nbytes, *shape, h0, w0 = self.header[i].tolist()
+        self.count(nbytes > 0)
+        if nbytes <= 0:
+            return None
+        buf = self.data[o:o + nbytes]
+        im = buf.reshape(shape).copy() if self.fmt == 'raw' else cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+        return im, (h0, w0)
+
+    def put(self, i, im, hw0):
+        self._map()
+        if self.full or self.header[i, 1]:  # budget exhausted or already cached by another process
+            return
+        buf = np.ascontiguousarray(im).reshape(-1) if self.fmt == 'raw' else cv2.imencode(self.fmt, im, self.params)[1]
+        with self.used.get_lock():  # claim a slot
+            if self.header[i, 1]:
+                return
+            o = self.used.value
+            if o + buf.nbytes > self.budget:
+                self.full = True  # stop encoding in this process, the remainder fits few images
+                return
+            self.used.value += buf.nbytes
+            self.header[i] = o, -1, *im.shape[:2], im.shape[2] if im.ndim == 3 else 1, *hw0
+        self.data[o:o + buf.nbytes] = buf.reshape(-1)
+        self.header[i, 1] = buf.nbytes  # written last, marks the entry readable
+
+    def count(self, hit):
+        self.local[int(not hit)] += 1
+        if sum(self.local) >= self.flush:
+            self.aggregate()
+
+    def aggregate(self):
+        # Adds the hits and misses of this process to the shared counts
+        with self.used.get_lock():
+            self.counts[0] += self.local[0]
+            self.counts[1] += self.local[1]
+        self.local = [0, 0]
+
+    def unlink(self):
+        Path(self.file).unlink(missing_ok=True)  # existing mappings stay valid
+
+    def __getstate__(self):
+        return {**self.__dict__, 'header': None, 'data': None}  # never pickle the mapped images
+
+    @property
+    def nbytes(self):
+        return self.used.value
+
+    @property
+    def hit_rate(self):
+        hits, misses = self.counts[0] + self.local[0], self.counts[1] + self.local[1]
+        return hits / max(hits + misses, 1)
+
+    def __repr__(self):
+        hits, misses = self.counts[0] + self.local[0], self.counts[1] + self.local[1]
+        return f'{self.hit_rate:.1%} hit rate ({hits} hits, {misses} misses, ' \
+               f'{self.nbytes / 1E9:.1f}/{self.budget / 1E9:.1f}GB {self.fmt})'
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
     cache_version = 0.6  # dataset labels *.cache version
@@ -415,6 +876,7 @@ class LoadImagesAndLabels(Dataset):
                  rect=False,
                  image_weights=False,
                  cache_images=False,
+                 cache_gb=4.0,
                  single_cls=False,
                  stride=32,
                  pad=0.0,
@@ -524,21 +986,14 @@ class LoadImagesAndLabels(Dataset):
 
         # Cache images into RAM/disk for faster training (WARNING: large datasets may exceed system resources)
         self.ims = [None] * n
-        self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
-        if cache_images:
-            gb = 0  # Gigabytes of cached images
-            self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
-            pbar = tqdm(enumerate(results), total=n, bar_format=BAR_FORMAT, disable=LOCAL_RANK > 0)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    gb += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    gb += self.ims[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {cache_images})'
-            pbar.close()
+        self.lru = None  # compressed image cache
+        if cache_images == 'lru':  # filled by all dataloader processes, for datasets larger than RAM
+            self.lru = CompressedImageCache(n, cache_gb * 1E9)
+        elif cache_images:  # one arena per host shared by all ranks and workers, 'disk' persists beside the *.cache
+            file = Path(f"{cache_path.with_suffix('')}_{img_size}{'_augment' if augment else ''}.arena")
+            arena = self.cache_images_to_arena(file if cache_images == 'disk' else None, prefix)
+            if arena:
+                self.ims, self.im_hw0, self.im_hw = arena, arena.hw0, arena.hw
 
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
         # Cache dataset labels, check images and read shapes
@@ -663,27 +1118,63 @@ class LoadImagesAndLabels(Dataset):
 
     def load_image(self, i):
         # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
+        im, f = self.ims[i], self.im_files[i]
         if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
+            x = self.lru.get(i) if self.lru is not None else None
+            if x is not None:  # LRU cache hit
+                return x[0], x[1], x[0].shape[:2]  # im, hw_original, hw_resized
+            im, hw0 = imread_reduced(f, self.img_size)  # BGR, JPEGs decoded at reduced scale when still larger
+            assert im is not None, f'Image Not Found {f}'
+            h0, w0 = hw0  # orig hw
             r = self.img_size / max(h0, w0)  # ratio
-            if r != 1:  # if sizes are not equal
+            h, w = im.shape[:2]  # decoded hw
+            if (h, w) != (int(h0 * r), int(w0 * r)):  # if sizes are not equal
                 interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
                 im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
+            if self.lru is not None:
+                self.lru.put(i, im, (h0, w0))
             return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
         else:
             return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
 
-    def cache_images_to_disk(self, i):
-        # Saves an image as an *.npy file for faster loading
-        f = self.npy_files[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files[i]))
+    def cache_images_to_arena(self, file=None, prefix=''):
+        # Packs the resized images into an ImageArena, built by the first process of a host and mapped by the others.
+        # A given file persists between runs (disk cache), otherwise the arena lives in /dev/shm (shared memory) if it
+        # has room for the estimated size, else in the temporary directory
+        h = hashlib.md5(f'{get_hash(self.im_files)} {self.img_size} {self.augment}'.encode()).hexdigest()
+        shm = file is None
+        if shm:  # same images, order and resizing, mapped where another rank or run built it
+            files = [d / f'yolov5_{h}.arena' for d in (Path('/dev/shm'), Path(tempfile.gettempdir()))]
+            file = next((f for f in files if ImageArena.index_file(f).exists()), None) or \
+                shared_cache_dir(self.cache_nbytes()) / files[0].name
+        kind = ('ram' if file.parent == Path('/dev/shm') else 'tmp') if shm else 'disk'
+        try:
+            arena = ImageArena(file, h)  # built by another rank or run
+            LOGGER.info(f'{prefix}Mapped cached images ({arena.nbytes / 1E9:.1f}GB {kind}) from {file}')
+            return arena
+        except FileNotFoundError:  # no arena yet
+            pass
+        except AssertionError as e:  # stale or incomplete, other errors are real failures
+            LOGGER.info(f'{prefix}Rebuilding image cache {file}: {e}')
+        desc = f'{prefix}Caching images ({{:.1f}}GB {kind})'
+        with ThreadPool(NUM_THREADS) as pool:
+            results = pool.imap(self.load_image, range(self.n))  # parallel decode, sequential write
+            pbar = tqdm(results, desc=desc.format(0), total=self.n, bar_format=BAR_FORMAT, disable=LOCAL_RANK > 0)
+            try:
+                arena = ImageArena.build(file, pbar, self.n, h, desc)
+            except OSError as e:
+                LOGGER.warning(f'{prefix}WARNING: Images not cached, could not write {file}: {e}')
+                return None
+            finally:
+                pbar.close()
+        if shm:
+            atexit.register(ImageArena.unlink, file)  # the builder owns the shared memory
+        return arena
+
+    def cache_nbytes(self, n=30):
+        # Resized image bytes of the dataset, estimated from n evenly spaced images
+        i = np.linspace(0, self.n - 1, min(n, self.n)).astype(int)
+        return sum(self.load_image(j)[0].nbytes for j in i) * self.n / len(i)
 
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
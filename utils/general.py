@@ -788,11 +788,15 @@ def non_max_suppression(prediction,
                         agnostic=False,
                         multi_label=False,
                         labels=(),
-                        max_det=300):
+                        max_det=300,
+                        return_indices=False,
+                        merge=False):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping bounding boxes
+    Candidates of all images are filtered together and suppressed in a single batched NMS grouped by image and class
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         list of prediction anchor indices, on (n,) tensor per image (-1 for apriori labels), if return_indices
     """
 
     bs = prediction.shape[0]  # batch size
@@ -805,84 +809,122 @@ def non_max_suppression(prediction,
 
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
-    max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 0.3 + 0.03 * bs  # seconds to quit after
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
+    time_limit = 0.3 + 0.03 * bs  # seconds to warn after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * bs
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            lb = labels[xi]
-            v = torch.zeros((len(lb), nc + 5), device=x.device)
-            v[:, :4] = lb[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            teste = conf.view(-1)
-            teste = conf.view(-1) > conf_thres
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            LOGGER.warning(f'WARNING: NMS time limit {time_limit:.3f}s exceeded')
-            break  # time limit exceeded
-
-    return output
+    device = prediction.device
+    bi, ai = xc.nonzero(as_tuple=True)  # image and anchor index of candidates
+    x = prediction[bi, ai]  # confidence
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        lb = torch.cat([lb for lb in labels if len(lb)], 0)
+        v = torch.zeros((len(lb), nc + 5), device=device)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        bi = torch.cat((bi, torch.cat([torch.full((len(lb),), i, device=device) for i, lb in enumerate(labels)])))
+        ai = torch.cat((ai, torch.full((len(lb),), -1, device=device)))
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[i]
+    bi, ai = bi[i], ai[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=device)).any(1)
+        x, bi, ai = x[i], bi[i], ai[i]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     x = x[torch.isfinite(x).all(1)]
+
+    # Check shape
+    n = x.shape[0]  # number of boxes
+    if n and torch.bincount(bi, minlength=bs).max() > max_nms:  # excess boxes
+        i = x[:, 4].argsort(descending=True)  # sort by confidence
+        i = i[bi[i].sort(stable=True)[1]]  # then by image
+        x, bi, ai = x[i], bi[i], ai[i]
+        i = _image_rank(bi, bs) < max_nms
+        x, bi, ai = x[i], bi[i], ai[i]
+
+    # Batched NMS, groups are (image, class) pairs or images if agnostic
+    g = bi if agnostic else bi * nc + x[:, 5].long()  # groups
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], g, iou_thres)  # NMS, sorted by decreasing score
+    i = i[bi[i].sort(stable=True)[1]]  # by image, then by score
+    i = i[_image_rank(bi[i], bs) < max_det]  # limit detections
+    if merge and n > 1:  # Merge NMS (boxes merged using weighted mean)
+        # update boxes as boxes(i,4) = sum(weights(m) * boxes(m,4)) over the members m of each kept box
+        k, j = box_members(x[:, :4], i, iou_thres, g)  # sparse iou matrix within groups
+        weights = x[j, 4:5]  # box weights
+        w = torch.zeros((len(i), 1), device=device).index_add_(0, k, weights.float())
+        x[i, :4] = (torch.zeros((len(i), 4), device=device).index_add_(0, k, x[j, :4].float() * weights) / w).type_as(x)
+        if redundant:
+            i = i[torch.bincount(k, minlength=len(i)) > 1]  # require redundancy
+    if (time.time() - t) > time_limit:
+        LOGGER.warning(f'WARNING: NMS time limit {time_limit:.3f}s exceeded')
+
+    counts = torch.bincount(bi[i], minlength=bs).tolist()  # detections per image
+    output = list(x[i].split(counts))
+    return (output, list(ai[i].split(counts))) if return_indices else output
+
+
+def box_members(boxes, keep, iou_thres, groups=None, chunk=256):
+    """Sparse IoU membership of kept boxes, i.e. the merge-NMS or cluster members of NMS survivors
+    Boxes are sorted by x1 with groups laid out side by side along x, so each chunk of kept boxes is only compared to the
+    candidates that can overlap its x-span. Memory is O(chunk * window) instead of the dense O(len(keep) * n) matrix
+
+    Returns:
+         k, j index tensors of all pairs with box_iou(boxes[keep[k]], boxes[j]) > iou_thres (and groups[keep[k]] ==
+         groups[j]), sorted by k then j
+    """
+    e = torch.zeros(0, dtype=torch.long, device=boxes.device)
+    if not len(boxes) or not len(keep):
+        return e, e
+    x = boxes[:, [0, 2]].double()  # x1, x2 sort keys
+    if groups is not None:
+        x += (groups.double() * (x[:, 1].max() - x[:, 0].min() + 1))[:, None]  # groups never overlap
+    order = x[:, 0].argsort()
+    x1 = x[order, 0].contiguous()  # sorted x1
+    w = (x[:, 1] - x[:, 0]).max()  # max width, candidates need x1 > x1_min - w to reach a box
+    keep = torch.as_tensor(keep, dtype=torch.long, device=boxes.device)
+    kx = x[keep]
+    ks, js = [e], [e]
+    for c in kx[:, 0].argsort().split(chunk):  # chunks of kept boxes sorted by x1
+        lo = int(torch.searchsorted(x1, (kx[c, 0].min() - w).view(1)))
+        hi = int(torch.searchsorted(x1, kx[c, 1].max().view(1)))
+        j = order[lo:hi]  # window of candidates overlapping the chunk along x
+        m = box_iou(boxes[keep[c]], boxes[j]) > iou_thres
+        if groups is not None:
+            m &= groups[keep[c], None] == groups[None, j]
+        a, b = m.nonzero(as_tuple=True)
+        ks.append(c[a])
+        js.append(j[b])
+    k, j = torch.cat(ks), torch.cat(js)
+    i = (k * len(boxes) + j).argsort()
+    return k[i], j[i]
+
+
+def _image_rank(bi, bs):
+    # Rank of each element within its image for image indices bi sorted in ascending order, i.e. [0, 0, 2] -> [0, 1, 0]
+    counts = torch.bincount(bi, minlength=bs)
+    return torch.arange(len(bi), device=bi.device) - (counts.cumsum(0) - counts)[bi]
 
 
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
@@ -10,6 +10,7 @@ import pkg_resources as pkg
 import torch
 from torch.utils.tensorboard import SummaryWriter
 
+from new_utils.streaming_metrics import PROB_KEYS
 from utils.general import colorstr, cv2, emojis
 from utils.loggers.wandb.wandb_utils import WandbLogger
 from utils.plots import plot_images, plot_results
@@ -56,6 +57,8 @@ class Loggers():
             'x/lr0',
             'x/lr1',
             'x/lr2']  # params
+        if getattr(opt, 'prob_metrics', False):
+            self.keys[10:10] = PROB_KEYS  # output redundancy metrics after the val losses
         self.best_keys = ['best/epoch', 'best/precision', 'best/recall', 'best/mAP_0.5', 'best/mAP_0.5:0.95']
         for k in LOGGERS:
             setattr(self, k, None)  # init empty logger dictionary
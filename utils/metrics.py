@@ -4,12 +4,16 @@ Model validation metrics
 """
 
 import math
+import tempfile
 import warnings
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
+
+trapz = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz is np.trapezoid from NumPy 2.0
 
 
 def fitness(x):
@@ -26,7 +30,7 @@ def smooth(y, f=0.05):
     return np.convolve(yp, np.ones(nf) / nf, mode='valid')  # y-smoothed
 
 
-def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16):
+def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, n=None, chunks=None):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
@@ -36,13 +40,18 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
         target_cls:  True object classes (nparray).
         plot:  Plot precision-recall curve at mAP@0.5
         save_dir:  Plot save directory
+        n:  Predictions per row (nparray), tp then holds true positive counts, i.e. for confidence histogram bins
+        chunks:  Function returning the predictions of class c as (tp, conf) chunks in descending conf, replaces
+                 conf and pred_cls (None) so only one chunk per class is in memory, tp is then only used for its shape
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
 
     # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    if chunks is None:
+        i = np.argsort(-conf)
+        tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+        n = n if n is None else n[i]
 
     # Find unique classes
     unique_classes, nt = np.unique(target_cls, return_counts=True)
@@ -52,6 +61,13 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     px, py = np.linspace(0, 1, 1000), []  # for plotting
     ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
     for ci, c in enumerate(unique_classes):
+        if chunks is not None:  # streamed, bit-identical to the in-memory curves below
+            x = pr_curves_sorted(chunks(c), nt[ci], px, plot, eps)
+            if x is not None:
+                ap[ci], p[ci], r[ci] = x[:3]
+                if plot:
+                    py.append(x[3])
+            continue
         i = pred_cls == c
         n_l = nt[ci]  # number of labels
         n_p = i.sum()  # number of predictions
@@ -59,7 +75,7 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
             continue
 
         # Accumulate FPs and TPs
-        fpc = (1 - tp[i]).cumsum(0)
+        fpc = ((1 if n is None else n[i, None]) - tp[i]).cumsum(0)
         tpc = tp[i].cumsum(0)
 
         # Recall
@@ -93,6 +109,147 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     return tp, fp, p, r, f1, ap, unique_classes.astype(int)
 
 
+class StatsAccumulator:
+    """Accumulates val.py (correct, conf, pcls, tcls) statistics per image, i.e. stats.append(correct, conf, pcls, tcls)
+    Modes:
+        list: keep every tensor and concatenate at the end (exact)
+        hist: per-class confidence histograms on device (bins uniform in logit(conf) over [1e-5, 1 - 1e-5]), constant
+              memory, AP within the bin resolution
+        disk: exact, rows are spilled to files in runs sorted by class and confidence, ap_per_class then streams every
+              class as a merge of its runs, memory is bounded by chunk rows and a block per run
+    """
+
+    def __init__(self, nc, niou=10, mode='list', bins=1000, chunk=1000000):
+        assert mode in ('list', 'hist', 'disk'), f'invalid stats mode {mode}, valid modes are list, hist, disk'
+        self.nc, self.niou, self.mode, self.bins, self.chunk = nc, niou, mode, bins, chunk
+        self.span = 2 * math.log(1e5)  # logit range covered by the histogram bins
+        self.n = 0  # images appended
+        self.stats = []  # list mode, or rows pending a disk spill
+        self.pending = 0  # predictions and targets in self.stats (disk mode)
+        self.nt = np.zeros(nc, dtype=np.int64)  # targets per class (disk mode)
+        self.hist = None  # hist mode (nc, bins) predictions, (nc, bins, niou) true positives, (nc,) targets
+        self.dir = tempfile.TemporaryDirectory(prefix='val_stats_') if mode == 'disk' else None
+        self.rows = 0  # rows spilled to disk
+        self.runs = []  # (nc + 1,) class offsets of every spilled run, rows sorted by class then descending conf
+        self.tp = False  # any true positive spilled
+        self.marks = []  # list mode batch ends, the units merged by gather()
+
+    def __len__(self):
+        return self.n
+
+    def append(self, x):
+        correct, conf, pcls, tcls = x
+        self.n += 1
+        if self.mode == 'hist':
+            n, tp, nt = self.hist or self.init_hist(correct.device)
+            b = ((torch.logit(conf.double(), eps=1e-5) / self.span + 0.5) * self.bins).long().clamp(0, self.bins - 1)
+            i = pcls.long() * self.bins + b  # class, confidence bin
+            n.index_add_(0, i, torch.ones_like(conf, dtype=n.dtype))
+            tp.index_add_(0, i, correct.to(tp.dtype))
+            nt.index_add_(0, tcls.long(), torch.ones_like(tcls, dtype=nt.dtype))
+            return
+        self.stats.append(x)
+        if self.mode == 'disk':
+            self.pending += len(correct) + len(tcls)
+            if self.pending >= self.chunk:
+                self.spill()
+
+    def init_hist(self, device):
+        kw = {'device': device, 'dtype': torch.float64}  # exact counts
+        nb = self.nc * self.bins
+        self.hist = torch.zeros(nb, **kw), torch.zeros((nb, self.niou), **kw), torch.zeros(self.nc, **kw)
+        return self.hist
+
+    def mark(self):
+        # End of a batch
+        if self.mode == 'list':
+            self.marks.append(len(self.stats))
+
+    def gather(self, world_size, device):
+        """Merges the statistics of all ranks of a batch-sharded run (batch b on rank b % world_size) into every rank,
+        list mode reassembles the single-process order and hist mode sums the exact counts, both bit-identical"""
+        from utils.torch_utils import all_gather_batches
+
+        assert self.mode != 'disk', 'disk stats mode does not support sharded validation, use list or hist'
+        if self.mode == 'hist':
+            for x in self.hist or self.init_hist(device):
+                dist.all_reduce(x)
+            n = torch.tensor(self.n, device=device)
+            dist.all_reduce(n)
+            self.n = int(n)
+            return
+        i = [0] + self.marks
+        batches = [[tuple(x.cpu() for x in s) for s in self.stats[a:b]] for a, b in zip(i[:-1], i[1:])]
+        self.stats = [s for b in all_gather_batches(batches, world_size) for s in b]
+        self.n, self.marks = len(self.stats), []
+
+    def spill(self):
+        # Append pending rows to the disk files
+        if not self.stats:
+            return
+        correct, conf, pcls, tcls = (torch.cat(x, 0).cpu().numpy() for x in zip(*self.stats))
+        self.stats, self.pending = [], 0
+        conf, pcls = conf.astype(np.float32), pcls.astype(np.int32)
+        i = np.lexsort((-conf, pcls))  # sorted run, by class then descending conf
+        for name, x in zip(('correct', 'conf'), (correct[i], conf[i])):
+            with open(Path(self.dir.name) / name, 'ab') as f:
+                f.write(np.ascontiguousarray(x).tobytes())
+        self.runs.append(self.rows + np.searchsorted(pcls[i], np.arange(self.nc + 1)))
+        self.rows += len(conf)
+        self.tp |= bool(correct.any())
+        self.nt += np.bincount(tcls.astype(int), minlength=self.nc)[:self.nc]
+
+    def chunks(self, c, block=65536):
+        # Yields the class c rows of every spilled run as (correct, conf) chunks in descending conf, a block per run
+        d = Path(self.dir.name)
+        correct = np.memmap(d / 'correct', dtype=bool, mode='r', shape=(self.rows, self.niou))
+        conf = np.memmap(d / 'conf', dtype=np.float32, mode='r', shape=(self.rows,))
+        a, b = [x[c] for x in self.runs], [x[c + 1] for x in self.runs]  # next unread row, end of class c per run
+        tp, cf = [correct[:0]] * len(a), [conf[:0]] * len(a)  # buffered rows per run
+        while True:
+            for k in range(len(a)):  # refill empty buffers
+                if not len(cf[k]) and a[k] < b[k]:
+                    e = min(a[k] + block, b[k])
+                    tp[k], cf[k], a[k] = np.array(correct[a[k]:e]), np.array(conf[a[k]:e]), e
+            if not any(len(x) for x in cf):
+                return
+            t = max((cf[k][-1] for k in range(len(a)) if a[k] < b[k]), default=-np.inf)  # unread rows are <= t
+            m = [np.searchsorted(-x, -t, side='right') for x in cf]  # buffered rows >= t, merged now
+            x = np.concatenate([x[:k] for x, k in zip(cf, m)])
+            i = np.argsort(-x, kind='stable')
+            yield np.concatenate([x[:k] for x, k in zip(tp, m)])[i], x[i]
+            tp, cf = [x[k:] for x, k in zip(tp, m)], [x[k:] for x, k in zip(cf, m)]
+
+    def result(self):
+        """Returns (args, kwargs) for ap_per_class() and the number of targets per class, args is empty without TPs"""
+        if self.mode == 'hist':
+            if self.hist is None:
+                return (), {}, np.zeros(self.nc, dtype=np.int64)
+            n, tp, nt = (x.cpu().numpy() for x in self.hist)
+            nt = nt.round().astype(np.int64)
+            i = n > 0  # occupied (class, bin)
+            c = ((np.arange(self.bins) + 0.5) / self.bins - 0.5) * self.span  # bin centres in logit space
+            conf = np.tile(1 / (1 + np.exp(-c)), self.nc)[i]
+            pcls = np.repeat(np.arange(self.nc), self.bins)[i]
+            args = (tp[i], conf, pcls, np.repeat(np.arange(self.nc), nt)) if tp.any() else ()
+            return args, {'n': n[i]}, nt
+        if self.mode == 'disk':
+            self.spill()
+            if not self.tp:
+                return (), {}, self.nt
+            tp = np.zeros((0, self.niou), dtype=bool)  # shape only, classes are streamed by chunks()
+            return (tp, None, None, np.repeat(np.arange(self.nc), self.nt)), {'chunks': self.chunks}, self.nt
+        stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*self.stats)]  # to numpy
+        if not len(stats):
+            return (), {}, np.zeros(self.nc, dtype=np.int64)
+        nt = np.bincount(stats[3].astype(int), minlength=self.nc)  # number of targets per class
+        return (tuple(stats) if stats[0].any() else ()), {}, nt
+
+    def close(self):
+        if self.dir:
+            self.dir.cleanup()
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -113,7 +270,7 @@ def compute_ap(recall, precision):
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
         x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        ap = trapz(np.interp(x, mrec, mpre), x)  # integrate
     else:  # 'continuous'
         i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
@@ -121,10 +278,88 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+def pr_curves_sorted(chunks, n_l, px, plot=False, eps=1e-16):
+    """ Streamed ap_per_class() curves of one class, from its (tp, conf) chunks in descending conf
+    # Returns
+        AP per IoU threshold, precision and recall at px confidences, precision at px recalls (plot), None if no chunks
+    """
+    x = np.linspace(0, 1, 101)  # 101-point interp (COCO), see compute_ap()
+    r, p = StreamInterp(-px, left=0), StreamInterp(-px, left=1)  # negative x, xp because xp decreases
+    ap, py = None, StreamInterp(px, start=(0.0, 1.0), envelope=True) if plot else None
+    tpc, n = 0, 0  # true positives, predictions before the current chunk
+    for tp, conf in chunks:
+        if ap is None:
+            ap = [StreamInterp(x, start=(0.0, 1.0), envelope=True) for _ in range(tp.shape[1])]  # compute_ap sentinels
+        tpc = tp.cumsum(0) + tpc
+        fpc = np.arange(n + 1, n + len(tp) + 1)[:, None] - tpc
+        n += len(tp)
+        recall = tpc / (n_l + eps)  # recall curve
+        precision = tpc / (tpc + fpc)  # precision curve
+        r.update(-conf.astype(np.float64), recall[:, 0])
+        p.update(-conf.astype(np.float64), precision[:, 0])
+        for j, f in enumerate(ap):
+            f.update(recall[:, j], precision[:, j])
+        if py:
+            py.update(recall[:, 0], precision[:, 0])
+        tpc = tpc[-1]
+    if not n or n_l == 0:
+        return None
+    for f in ap + [py] if py else ap:
+        f.update(np.array([1.0]), np.array([0.0]))  # compute_ap end sentinel
+    return np.array([trapz(f.result(), x) for f in ap]), p.result(), r.result(), py.result() if py else None
+
+
+class StreamInterp:
+    """ np.interp(x, xp, fp, left, right) with xp, fp arriving in chunks of non-decreasing xp, bit-identical to the
+    in-memory result. With envelope=True fp is replaced by its precision envelope max(fp[i:]) as in compute_ap(), it
+    is resolved once the whole stream has been seen. start is an optional first (xp, fp) point
+    """
+
+    def __init__(self, x, left=None, right=None, start=None, envelope=False):
+        self.i = np.argsort(x, kind='stable')
+        self.x = np.asarray(x, dtype=np.float64)[self.i]  # sorted queries
+        self.k = 0  # queries before k are located between two xp points
+        self.j = np.zeros(len(x), dtype=np.int64)  # -1 where left of xp
+        self.x0, self.y0, self.x1, self.y1 = (np.zeros(len(x)) for _ in range(4))  # bracketing xp, fp points
+        self.left, self.right, self.envelope = left, right, envelope
+        self.first, self.last = None if start is None else start[1], start  # first fp, last (xp, fp) point seen
+
+    def update(self, xp, fp):
+        if not len(xp):
+            return
+        if self.envelope:  # envelope of the located queries and of the first point also covers these points
+            self.y1[:self.k] = np.maximum(self.y1[:self.k], fp.max())
+            self.first = fp.max() if self.first is None else max(self.first, fp.max())
+        if self.last is not None:
+            xp, fp = np.concatenate(([self.last[0]], xp)), np.concatenate(([self.last[1]], fp))
+        elif self.first is None:
+            self.first = fp[0]
+        k = self.k + np.searchsorted(self.x[self.k:], xp[-1])  # queries before xp[-1] are located in this chunk
+        x = self.x[self.k:k]
+        j = np.searchsorted(xp, x, side='right') - 1  # last xp <= x, -1 left of the first chunk
+        i, i1 = np.maximum(j, 0), j + 1  # x < xp[-1] so j + 1 is in this chunk
+        self.j[self.k:k] = j
+        self.x0[self.k:k], self.y0[self.k:k], self.x1[self.k:k] = xp[i], fp[i], xp[i1]
+        self.y1[self.k:k] = np.flip(np.maximum.accumulate(np.flip(fp)))[i1] if self.envelope else fp[i1]
+        self.k, self.last = k, (xp[-1], fp[-1])
+
+    def result(self):
+        xl, yl = self.last  # queries from k on are at or right of the last xp
+        y0 = np.maximum(self.y0, self.y1) if self.envelope else self.y0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.where(self.x == self.x0, y0, (self.y1 - y0) / (self.x1 - self.x0) * (self.x - self.x0) + y0)
+        y[:self.k][self.j[:self.k] < 0] = self.first if self.left is None else self.left
+        y[self.k:] = np.where(self.x[self.k:] == xl, yl, yl if self.right is None else self.right)
+        out = np.empty_like(y)
+        out[self.i] = y
+        return out
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
         self.matrix = np.zeros((nc + 1, nc + 1))
+        self.counts = None  # pending device-side counts, folded into self.matrix by sync()
         self.nc = nc  # number of classes
         self.conf = conf
         self.iou_thres = iou_thres
@@ -133,52 +368,57 @@ class ConfusionMatrix:
         """
         Return intersection-over-union (Jaccard index) of boxes.
         Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
+        Every detection is matched to its highest-IoU label and each label keeps its highest-IoU matched detection.
+        Counts are scatter-added on the input device, call sync() before reading self.matrix
         Arguments:
             detections (Array[N, 6]), x1, y1, x2, y2, conf, class
             labels (Array[M, 5]), class, x1, y1, x2, y2
         Returns:
             None, updates confusion matrix accordingly
         """
-        detections = detections[detections[:, 4] > self.conf]
-        gt_classes = labels[:, 0].int()
-        detection_classes = detections[:, 5].int()
-        iou = box_iou(labels[:, 1:], detections[:, :4])
-
-        x = torch.where(iou > self.iou_thres)
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+        nl, nd = labels.shape[0], detections.shape[0]
+        if not nl:
+            return
+        device = labels.device
+        if self.counts is None:
+            self.counts = torch.zeros((self.nc + 1) ** 2, device=device)
+        gt_classes = labels[:, 0].long()
+        detection_classes = detections[:, 5].long()
+        iou = box_iou(labels[:, 1:], detections[:, :4]) * (detections[:, 4] > self.conf)  # 0 below conf
+
+        if nd:
+            v, m = iou.max(0)  # best label and its IoU per detection
+            matched = v > self.iou_thres
+            j = torch.where((m == torch.arange(nl, device=device)[:, None]) & matched, v, v.new_tensor(-1)).argmax(1)
+            j = torch.where(matched[j] & (m[j] == torch.arange(nl, device=device)), j, -1)  # matched detection/label
+            matched &= j[m] == torch.arange(nd, device=device)  # detections kept by their label
         else:
-            matches = np.zeros((0, 3))
-
-        n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(int)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[detection_classes[m1[j]], gc] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # background FP
-
-        if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # background FN
+            j, matched = torch.full((nl,), -1, device=device), torch.zeros(0, dtype=torch.bool, device=device)
+
+        # correct or background FP per label, background FN per unmatched detection above conf if anything matched
+        pred = torch.where(j >= 0, detection_classes[j.clamp(0)] if nd else j, self.nc)
+        fn = (~matched & (detections[:, 4] > self.conf) & matched.any()).float()
+        self.counts.index_add_(0, pred * (self.nc + 1) + gt_classes, torch.ones(nl, device=device))
+        self.counts.index_add_(0, detection_classes * (self.nc + 1) + self.nc, fn)
+
+    def sync(self):
+        # Fold pending device-side counts into self.matrix
+        if self.counts is not None:
+            self.matrix += self.counts.view(self.nc + 1, -1).cpu().numpy()
+            self.counts = None
 
     def matrix(self):
         return self.matrix
 
     def tp_fp(self):
+        self.sync()
         tp = self.matrix.diagonal()  # true positives
         fp = self.matrix.sum(1) - tp  # false positives
         # fn = self.matrix.sum(0) - tp  # false negatives (missed detections)
         return tp[:-1], fp[:-1]  # remove background class
 
     def plot(self, normalize=True, save_dir='', names=()):
+        self.sync()
         try:
             import seaborn as sn
 
@@ -209,6 +449,7 @@ class ConfusionMatrix:
             print(f'WARNING: ConfusionMatrix plot failure: {e}')
 
     def print(self):
+        self.sync()
         for i in range(self.nc + 1):
             print(' '.join(map(str, self.matrix[i])))
 
@@ -7,6 +7,8 @@ import math
 import os
 from copy import copy
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 from urllib.error import URLError
 
 import cv2
@@ -125,6 +127,73 @@ class Annotator:
         return np.asarray(self.im)
 
 
+class ResultsWriter:
+    # Renders and encodes annotated detect.py results on a background thread, i.e. writer.write(im0, boxes, 'im.jpg')
+    # A bounded queue applies back-pressure to the inference loop, queue=0 renders and encodes synchronously
+    def __init__(self, queue=0, line_width=None, example='abc'):
+        self.line_width, self.example = line_width, example
+        self.vid_path, self.vid_writer = {}, {}  # per stream index
+        self.error = None  # first exception raised on the writer thread
+        self.queue = Queue(maxsize=queue) if queue else None
+        if self.queue:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def render(self, im, boxes):
+        # Draw [(xyxy, label, color), ...] on im in place and return it
+        if not boxes:
+            return im
+        annotator = Annotator(im, line_width=self.line_width, example=self.example)
+        for box in boxes:
+            annotator.box_label(*box)
+        return annotator.result()
+
+    def write(self, im, boxes, save_path, i=0, video=None):
+        # Queue an image for saving, video=(fps, w, h) appends it to the stream i video, blocks while the queue is full
+        if self.error:
+            raise self.error
+        if self.queue:
+            self.queue.put((im, boxes, save_path, i, video))
+        else:
+            self.save(im, boxes, save_path, i, video)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if not self.error:  # drain without writing after a failure
+                try:
+                    self.save(*item)
+                except Exception as e:
+                    self.error = e
+
+    def save(self, im, boxes, save_path, i, video):
+        im = self.render(im, boxes)
+        if video is None:  # image
+            cv2.imwrite(save_path, im)
+            return
+        if self.vid_path.get(i) != save_path:  # new video
+            self.vid_path[i] = save_path
+            if i in self.vid_writer:
+                self.vid_writer[i].release()  # release previous video writer
+            fps, w, h = video
+            save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+            self.vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        self.vid_writer[i].write(im)
+
+    def close(self):
+        # Flush queued results and release video writers
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+        for vid_writer in self.vid_writer.values():
+            vid_writer.release()
+        self.vid_path, self.vid_writer = {}, {}
+        if self.error:
+            raise self.error
+
+
 def feature_visualization(x, module_type, stage, n=32, save_dir=Path('runs/detect/exp')):
     """
     x:              Features to be visualized
@@ -39,6 +39,13 @@ def torch_distributed_zero_first(local_rank: int):
         dist.barrier(device_ids=[0])
 
 
+def all_gather_batches(batches, world_size):
+    # All-gather per-batch results of a batch-sharded loop (batch b on rank b % world_size), returned in batch order
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, batches)
+    return [x[i] for i in range(len(gathered[0])) for x in gathered if i < len(x)]  # rank 0 holds the most batches
+
+
 def device_count():
     # Returns number of CUDA devices available. Safe version of torch.cuda.device_count(). Supports Linux and Windows
     assert platform.system() in ('Linux', 'Windows'), 'device_count() only supported on Linux or Windows'
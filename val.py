@@ -20,12 +20,15 @@ Usage - formats:
 
 import argparse
 import json
+import logging
 import os
 import sys
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from tqdm import tqdm
 
 FILE = Path(__file__).resolve()
@@ -35,14 +38,15 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from new_utils.streaming_metrics import PROB_KEYS, ProbabilisticStats
 from utils.callbacks import Callbacks
 from utils.dataloaders import create_dataloader
 from utils.general import (LOGGER, check_dataset, check_img_size, check_requirements, check_yaml,
                            coco80_to_coco91_class, colorstr, emojis, increment_path, non_max_suppression, print_args,
                            scale_coords, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
+from utils.metrics import ConfusionMatrix, StatsAccumulator, ap_per_class, box_iou
 from utils.plots import output_to_target, plot_images, plot_val_study
-from utils.torch_utils import select_device, time_sync
+from utils.torch_utils import all_gather_batches, select_device, time_sync
 
 
 def save_one_txt(predn, save_conf, shape, file):
@@ -71,26 +75,22 @@ def save_one_json(predn, jdict, path, class_map):
 def process_batch(detections, labels, iouv):
     """
     Return correct predictions matrix. Both sets of boxes are in (x1, y1, x2, y2) format.
+    Every detection is matched to its highest-IoU label of the same class, which is the same label at every IoU level
+    it passes, and each label keeps its first (highest confidence) matched detection. All levels are resolved at once
+    on the input device
     Arguments:
         detections (Array[N, 6]), x1, y1, x2, y2, conf, class
         labels (Array[M, 5]), class, x1, y1, x2, y2
     Returns:
         correct (Array[N, 10]), for 10 IoU levels
     """
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
-    iou = box_iou(labels[:, 1:], detections[:, :4])
-    correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    iou = box_iou(labels[:, 1:], detections[:, :4]) * (labels[:, 0:1] == detections[:, 5])  # 0 unless classes match
+    if not iou.numel():
+        return torch.zeros((detections.shape[0], iouv.shape[0]), dtype=torch.bool, device=iouv.device)
+    v, m = iou.max(0)  # best label and its IoU per detection
+    valid = v[:, None] >= iouv  # (N, 10) IoU > threshold and classes match
+    first = ((m == torch.arange(iou.shape[0], device=m.device)[:, None])[..., None] & valid).byte().argmax(1)  # (M, 10)
+    return valid & (first[m] == torch.arange(iou.shape[1], device=m.device)[:, None])  # first detection per label
 
 
 @torch.no_grad()
@@ -122,6 +122,10 @@ def run(
         plots=True,
         callbacks=Callbacks(),
         compute_loss=None,
+        pipeline=False,  # run NMS and metrics of batch k on a worker thread during the forward pass of batch k+1
+        stats_mode='list',  # statistics accumulation: list (in RAM), hist (constant memory, binned AP) or disk (exact)
+        shard=False,  # split batches across the initialized torch.distributed ranks and merge their statistics
+        probabilistic=False,  # output redundancy NLL, calibration and MUE from the same forward pass
 ):
     # Initialize/load model and set device
     training = model is not None
@@ -159,6 +163,7 @@ def run(
     nc = 1 if single_cls else int(data['nc'])  # number of classes
     iouv = torch.linspace(0.5, 0.95, 10, device=device)  # iou vector for mAP@0.5:0.95
     niou = iouv.numel()
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if shard else (0, 1)
 
     # Dataloader
     if not training:
@@ -178,7 +183,8 @@ def run(
                                        pad=pad,
                                        rect=rect,
                                        workers=workers,
-                                       prefix=colorstr(f'{task}: '))[0]
+                                       prefix=colorstr(f'{task}: '),
+                                       shard=(rank, world_size) if shard else None)[0]
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
@@ -186,35 +192,26 @@ def run(
     class_map = coco80_to_coco91_class() if is_coco else list(range(1000))
     s = ('%20s' + '%11s' * 6) % ('Class', 'Images', 'Labels', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
     dt, p, r, f1, mp, mr, map50, map = [0.0, 0.0, 0.0], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
-    loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
-    callbacks.run('on_val_start')
-    pbar = tqdm(dataloader, desc=s, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
-    for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
-        callbacks.run('on_val_batch_start')
-        t1 = time_sync()
-        if cuda:
-            im = im.to(device, non_blocking=True)
-            targets = targets.to(device)
-        im = im.half() if half else im.float()  # uint8 to fp16/32
-        im /= 255  # 0 - 255 to 0.0 - 1.0
+    loss, losses = torch.zeros(3, device=device), []  # per-batch losses, summed in batch order
+    jdict, jmarks, ap, ap_class = [], [], [], []
+    stats = StatsAccumulator(nc, niou, mode=stats_mode)  # (correct, conf, pcls, tcls) per image
+    assert not (probabilistic and single_cls), 'probabilistic metrics need the class probabilities of the model'
+    prob_stats = ProbabilisticStats(nc) if probabilistic else None
+
+    def process(batch_i, im, targets, paths, shapes, out):
+        # NMS, metrics, plots and callbacks of one batch, in batch order on the pipeline thread if pipelined
+        nonlocal seen
+        callbacks.run('on_val_batch_start')  # here so batch callbacks never interleave across batches
         nb, _, height, width = im.shape  # batch size, channels, height, width
-        t2 = time_sync()
-        dt[0] += t2 - t1
-
-        # Inference
-        out, train_out = model(im) if training else model(im, augment=augment, val=True)  # inference, loss outputs
-        dt[1] += time_sync() - t2
-
-        # Loss
-        if compute_loss:
-            loss += compute_loss([x.float() for x in train_out], targets)[1]  # box, obj, cls
 
         # NMS
         targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
         lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
         t3 = time_sync()
-        out = non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls)
+        raw, out = out, non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls)
+        if prob_stats:  # output redundancy cluster centers
+            keep = non_max_suppression(raw, prob_stats.conf_thres, prob_stats.iou_thres, max_det=1000,
+                                       return_indices=True)[1]
         dt[2] += time_sync() - t3
 
         # Metrics
@@ -224,6 +221,10 @@ def run(
             path, shape = Path(paths[si]), shapes[si][0]
             correct = torch.zeros(npr, niou, dtype=torch.bool, device=device)  # init
             seen += 1
+            if prob_stats:
+                tbox = scale_coords(im[si].shape[1:], xywh2xyxy(labels[:, 1:5]), shape, shapes[si][1])
+                prob_stats.update(raw[si], keep[si], im[si].shape[1:], shape, shapes[si][1],
+                                  torch.cat((labels[:, 0:1], tbox), 1))
 
             if npr == 0:
                 if nl:
@@ -253,6 +254,9 @@ def run(
                 save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
             callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
 
+        stats.mark()
+        jmarks.append(len(jdict))
+
         # Plot images
         if plots and batch_i < 3:
             plot_images(im, targets, paths, save_dir / f'val_batch{batch_i}_labels.jpg', names)  # labels
@@ -260,20 +264,76 @@ def run(
 
         callbacks.run('on_val_batch_end')
 
+    callbacks.run('on_val_start')
+    pool, pending = ThreadPool(1) if pipeline else None, None  # single thread keeps stats and callbacks in batch order
+    pbar = tqdm(dataloader, desc=s, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', disable=rank > 0)  # progress bar
+    for i, (im, targets, paths, shapes) in enumerate(pbar):
+        batch_i = i * world_size + rank  # batch index of a single-process run
+        t1 = time_sync()
+        if cuda:
+            im = im.to(device, non_blocking=True)
+            targets = targets.to(device)
+        im = im.half() if half else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        t2 = time_sync()
+        dt[0] += t2 - t1
+
+        # Inference
+        out, train_out = model(im) if training else model(im, augment=augment, val=True)  # inference, loss outputs
+        dt[1] += time_sync() - t2
+
+        # Loss
+        if compute_loss:
+            losses.append(compute_loss([x.float() for x in train_out], targets)[1])  # box, obj, cls
+
+        if pipeline:  # wait for batch k-1, then process batch k while batch k+1 is loaded and inferred
+            if pending:
+                pending.get()
+            pending = pool.apply_async(process, (batch_i, im, targets, paths, shapes, out))
+        else:
+            process(batch_i, im, targets, paths, shapes, out)
+    if pipeline:
+        if pending:
+            pending.get()
+        pool.close()
+
+    # Merge shards
+    if shard:
+        stats.gather(world_size, device)
+        if prob_stats:
+            prob_stats.all_reduce(device)
+        i = [0] + jmarks
+        jdict = [d for b in all_gather_batches([jdict[a:b] for a, b in zip(i[:-1], i[1:])], world_size) for d in b]
+        losses = all_gather_batches([x.cpu() for x in losses], world_size)
+        confusion_matrix.sync()
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (seen, dt, confusion_matrix.matrix))
+        seen = sum(x[0] for x in gathered)
+        dt = [sum(x) for x in zip(*(x[1] for x in gathered))]
+        confusion_matrix.matrix = sum(x[2] for x in gathered)
+        plots &= rank == 0  # shared plots and files from rank 0
+        save_json &= rank == 0
+    for x in losses:
+        loss += x.to(device)
+
     # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    args, kwargs, nt = stats.result()  # ap_per_class() inputs, number of targets per class
+    if len(args):
+        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*args, plot=plots, save_dir=save_dir, names=names, **kwargs)
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-        nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
     else:
         nt = torch.zeros(1)
+    stats.close()
 
     # Print results
     pf = '%20s' + '%11i' * 2 + '%11.3g' * 4  # print format
     LOGGER.info(pf % ('all', seen, nt.sum(), mp, mr, map50, map))
 
+    prob = prob_stats.result() if prob_stats else ()  # NLL, calibration errors, MUE
+    if prob:
+        LOGGER.info('Probabilistic: ' + ', '.join(f"{k.split('/')[1]} {v:.4g}" for k, v in zip(PROB_KEYS, prob)))
+
     # Print results per class
     if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
         for i, c in enumerate(ap_class):
@@ -324,7 +384,7 @@ def run(
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
-    return (mp, mr, map50, map, *(loss.cpu() / len(dataloader)).tolist()), maps, t
+    return (mp, mr, map50, map, *(loss.cpu() / max(len(losses), 1)).tolist(), *prob), maps, t
 
 
 def parse_opt():
@@ -350,6 +410,10 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--pipeline', action='store_true', help='overlap NMS and metrics with the next forward pass')
+    parser.add_argument('--stats-mode', default='list', choices=['list', 'hist', 'disk'], help='stats accumulation')
+    parser.add_argument('--probabilistic', action='store_true', help='report output redundancy NLL, calibration, MUE')
+    parser.add_argument('--processes', type=int, default=1, help='shard batches across N local CPU processes (gloo)')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     opt.save_json |= opt.data.endswith('coco.yaml')
@@ -358,13 +422,31 @@ def parse_opt():
     return opt
 
 
+def run_shard(rank, processes, opt):
+    # Validate batches rank, rank + processes, ... in a CPU process of a gloo group, results are merged on all ranks
+    dist.init_process_group('gloo', rank=rank, world_size=processes)
+    torch.set_num_threads(max(os.cpu_count() // processes, 1))
+    if rank > 0:
+        LOGGER.setLevel(logging.WARNING)  # log from rank 0 only
+    run(**vars(opt), shard=True)
+    dist.destroy_process_group()
+
+
 def main(opt):
     check_requirements(requirements=ROOT / 'requirements.txt', exclude=('tensorboard', 'thop'))
+    processes = vars(opt).pop('processes')  # not a run() argument
 
     if opt.task in ('train', 'val', 'test'):  # run normally
         if opt.conf_thres > 0.001:  # https://github.com/ultralytics/yolov5/issues/1466
             LOGGER.info(emojis(f'WARNING: confidence threshold {opt.conf_thres} > 0.001 produces invalid results ⚠️'))
-        run(**vars(opt))
+        if processes > 1:  # sharded CPU validation, every process writes to the same save_dir
+            opt.name = increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok).name
+            opt.exist_ok, opt.device = True, 'cpu'
+            os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+            os.environ.setdefault('MASTER_PORT', '29500')
+            torch.multiprocessing.spawn(run_shard, args=(processes, opt), nprocs=processes)
+        else:
+            run(**vars(opt))
 
     else:
         weights = opt.weights if isinstance(opt.weights, list) else [opt.weights]